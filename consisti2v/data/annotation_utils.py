@@ -0,0 +1,128 @@
+import json
+import os
+import shutil
+
+import numpy as np
+
+
+class AnnotationStore:
+    """
+    Column-oriented annotations. String columns are stored as one utf-8 byte array plus an offset array and
+    numeric columns as numpy arrays, so a store holds a handful of Python objects regardless of the number of
+    rows. Dataloader workers forked from the main process therefore share its pages instead of copying them
+    through refcount updates, and stores saved with `save` are memory-mapped on load.
+
+    Indexing returns the row as a dict, like the parsed json lines the datasets used before.
+
+    Args:
+        columns: dict of column name to a numpy array, or a (data, offsets) pair of numpy arrays for strings
+    """
+
+    def __init__(self, columns):
+        self.columns = columns
+        first = next(iter(columns.values()))
+        self.length = len(first[1]) - 1 if isinstance(first, tuple) else len(first)
+
+    @classmethod
+    def from_records(cls, records, string_fields, numeric_fields=None):
+        """
+        Builds a store from an iterable of dicts. `numeric_fields` maps field names to dtypes, missing
+        numeric values are stored as 0.
+        """
+        numeric_fields = numeric_fields or {}
+        strings = {field: [] for field in string_fields}
+        numbers = {field: [] for field in numeric_fields}
+        for record in records:
+            for field in string_fields:
+                strings[field].append(record[field].encode("utf-8"))
+            for field in numeric_fields:
+                numbers[field].append(record.get(field, 0))
+
+        columns = {}
+        for field, values in strings.items():
+            offsets = np.zeros(len(values) + 1, dtype=np.int64)
+            np.cumsum([len(value) for value in values], out=offsets[1:])
+            columns[field] = (np.frombuffer(b"".join(values), dtype=np.uint8), offsets)
+        for field, dtype in numeric_fields.items():
+            columns[field] = np.array(numbers[field], dtype=dtype)
+        return cls(columns)
+
+    @classmethod
+    def load(cls, path, mmap_mode="r"):
+        with open(os.path.join(path, "meta.json"), "r") as f:
+            meta = json.load(f)
+        columns = {}
+        for field, kind in meta["columns"].items():
+            load = lambda name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode=mmap_mode)
+            columns[field] = (load(field), load(f"{field}.offsets")) if kind == "str" else load(field)
+        return cls(columns)
+
+    def save(self, path, **meta):
+        # write to a temporary directory first so that concurrent readers never see a partial store
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        os.makedirs(tmp_path, exist_ok=True)
+        kinds = {}
+        for field, column in self.columns.items():
+            if isinstance(column, tuple):
+                np.save(os.path.join(tmp_path, f"{field}.npy"), column[0])
+                np.save(os.path.join(tmp_path, f"{field}.offsets.npy"), column[1])
+                kinds[field] = "str"
+            else:
+                np.save(os.path.join(tmp_path, f"{field}.npy"), column)
+                kinds[field] = str(column.dtype)
+        with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+            json.dump(dict(meta, columns=kinds), f)
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.replace(tmp_path, path)
+
+    def get(self, idx, field):
+        column = self.columns[field]
+        if isinstance(column, tuple):
+            data, offsets = column
+            return data[offsets[idx]:offsets[idx + 1]].tobytes().decode("utf-8")
+        return column[idx].item()
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, idx):
+        if idx < 0 or idx >= self.length:
+            raise IndexError(idx)
+        return {field: self.get(idx, field) for field in self.columns}
+
+
+def get_source_key(paths):
+    # identifies the versions of the source files a cached store was built from
+    return [[os.path.abspath(path), os.stat(path).st_mtime_ns, os.stat(path).st_size] for path in paths]
+
+
+def load_annotation_store(build_fn, source_paths, cache_path=None):
+    """
+    Loads the store cached at `cache_path` if it was built from the current `source_paths`, otherwise
+    builds it with `build_fn()` and caches it. Without `cache_path` the store is built in memory.
+    """
+    if cache_path is None:
+        return build_fn()
+
+    source_key = get_source_key(source_paths)
+    meta_path = os.path.join(cache_path, "meta.json")
+    if os.path.exists(meta_path):
+        with open(meta_path, "r") as f:
+            if json.load(f).get("source_key") == source_key:
+                return AnnotationStore.load(cache_path)
+
+    store = build_fn()
+    try:
+        store.save(cache_path, source_key=source_key)
+    except OSError:
+        # e.g. a read-only dataset folder, the store still works from memory
+        pass
+    return store
+
+
+def read_json_lines(json_path):
+    with open(json_path, 'rb') as json_file:
+        for json_str in json_file:
+            if json_str.strip():
+                yield json.loads(json_str)
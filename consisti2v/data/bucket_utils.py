@@ -0,0 +1,121 @@
+import math
+import random
+
+import numpy as np
+import torchvision.transforms.functional as TF
+from torch.utils.data import Sampler
+
+
+def get_buckets(sample_size, aspect_ratios, divisor=64):
+    """
+    (height, width) of one bucket per aspect ratio (height / width), all with about as many pixels as
+    `sample_size` and sides that are multiples of `divisor`, so that every bucket has the same number of
+    latent tokens up to rounding.
+    """
+    sample_size = tuple(sample_size) if not isinstance(sample_size, int) else (sample_size, sample_size)
+    area = sample_size[0] * sample_size[1]
+    buckets = []
+    for aspect_ratio in aspect_ratios:
+        width = max(divisor, round(math.sqrt(area / aspect_ratio) / divisor) * divisor)
+        height = max(divisor, round(width * aspect_ratio / divisor) * divisor)
+        if (height, width) not in buckets:
+            buckets.append((height, width))
+    return buckets
+
+
+def assign_buckets(heights, widths, buckets):
+    # index of the bucket with the closest aspect ratio, in log space, for every clip
+    bucket_ratios = np.log([height / width for height, width in buckets])
+    ratios = np.log(np.asarray(heights, dtype=np.float64) / np.asarray(widths, dtype=np.float64))
+    return np.abs(ratios[:, None] - bucket_ratios[None, :]).argmin(axis=1)
+
+
+def get_resize_size(height, width, target_size):
+    # short side that a `height` x `width` frame is resized to so that it covers `target_size`
+    scale = max(target_size[0] / height, target_size[1] / width)
+    return math.ceil(min(height, width) * scale)
+
+
+def resize_and_center_crop(pixel_values, target_size):
+    height, width = pixel_values.shape[-2:]
+    resize_size = get_resize_size(height, width, target_size)
+    if resize_size != min(height, width):
+        pixel_values = TF.resize(pixel_values, resize_size, antialias=True)
+    return TF.center_crop(pixel_values, list(target_size))
+
+
+class AspectRatioBucketBatchSampler(Sampler):
+    """
+    Batch sampler that only batches clips of the same bucket. Every epoch shuffles the clips within each
+    bucket, splits them into batches and shuffles the batches, so buckets are visited in proportion to
+    their size.
+
+    Args:
+        bucket_ids: bucket index of every clip
+        batch_size: number of clips per batch
+        shuffle: whether to shuffle clips and batches
+        drop_last: whether to drop the last incomplete batch of every bucket
+        seed: base seed of the per-epoch shuffling
+    """
+
+    def __init__(self, bucket_ids, batch_size, shuffle=True, drop_last=True, seed=0):
+        self.bucket_ids = np.asarray(bucket_ids)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+        self.bucket_indices = [np.flatnonzero(self.bucket_ids == bucket_id) for bucket_id in np.unique(self.bucket_ids)]
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        if self.drop_last:
+            return sum(len(indices) // self.batch_size for indices in self.bucket_indices)
+        return sum(math.ceil(len(indices) / self.batch_size) for indices in self.bucket_indices)
+
+    def __iter__(self):
+        rng = random.Random(self.seed + self.epoch)
+        # advance the epoch in case `set_epoch` is not called by the training loop
+        self.epoch += 1
+
+        batches = []
+        for indices in self.bucket_indices:
+            indices = indices.tolist()
+            if self.shuffle:
+                rng.shuffle(indices)
+            for start in range(0, len(indices), self.batch_size):
+                batch = indices[start:start + self.batch_size]
+                if len(batch) == self.batch_size or not self.drop_last:
+                    batches.append(batch)
+        if self.shuffle:
+            rng.shuffle(batches)
+        return iter(batches)
+
+
+class AspectRatioBuckets:
+    """
+    Assignment of the clips of a dataset to aspect ratio buckets.
+
+    Args:
+        sample_size: size whose area all buckets share
+        aspect_ratios: aspect ratio (height / width) of every bucket
+        heights: native height of every clip
+        widths: native width of every clip
+    """
+
+    def __init__(self, sample_size, aspect_ratios, heights, widths):
+        self.buckets = get_buckets(sample_size, aspect_ratios)
+        self.bucket_ids = assign_buckets(heights, widths, self.buckets)
+        self.bucket_indices = [np.flatnonzero(self.bucket_ids == bucket_id) for bucket_id in range(len(self.buckets))]
+
+    def get_target_size(self, idx):
+        return self.buckets[self.bucket_ids[idx]]
+
+    def get_resize_size(self, idx, height, width):
+        return get_resize_size(height, width, self.get_target_size(idx))
+
+    def get_replacement_indices(self, idx):
+        # replacements for a failed clip come from the same bucket, so that batches stay uniform
+        return self.bucket_indices[self.bucket_ids[idx]]
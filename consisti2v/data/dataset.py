@@ -1,8 +1,7 @@
-import os, io, csv, math, random
+import os, io, csv, glob, math, random
 import json
 import numpy as np
 from einops import rearrange
-from decord import VideoReader
 
 import torch
 import torchvision.transforms as transforms
@@ -10,20 +9,63 @@ from torch.utils.data.dataset import Dataset
 
 from diffusers.utils import logging
 
+from .annotation_utils import AnnotationStore, load_annotation_store, read_json_lines
+from .bucket_utils import AspectRatioBuckets, resize_and_center_crop
+from .video_utils import FailureRegistry, VideoIndex, VideoReaderPool, get_batch_with_retries, get_decode_size, get_video_length, read_frames, sample_clip_start
+
 logger = logging.get_logger(__name__)
 
+
+def load_webvid_annotations(json_path):
+    # cached next to the annotation file, rebuilt when it changes
+    build_fn = lambda: AnnotationStore.from_records(read_json_lines(json_path), string_fields=('file', 'text'))
+    return load_annotation_store(build_fn, [json_path], f"{json_path}.annotations")
+
+
+def load_pexels_annotations(json_path, caption_json_path, max_aspect_ratio=0.625):
+    # clips with height / width >= `max_aspect_ratio` are dropped, None keeps all clips
+    def build_fn():
+        logger.info(f"loading captions from {caption_json_path} ...")
+        caption_dict = {caption['id']: caption['text'] for caption in read_json_lines(caption_json_path)}
+        dataset = []
+        for data in read_json_lines(json_path):
+            if max_aspect_ratio is None or data['height'] / data['width'] < max_aspect_ratio:
+                dataset.append(dict(data, text=caption_dict[data['id']]))
+        return AnnotationStore.from_records(
+            dataset, string_fields=('file', 'text'), numeric_fields={'fps': np.float64, 'height': np.int32, 'width': np.int32}
+        )
+    cache_path = f"{json_path}.annotations" if max_aspect_ratio == 0.625 else f"{json_path}.annotations-{max_aspect_ratio}"
+    return load_annotation_store(build_fn, [json_path, caption_json_path], cache_path)
+
+
+def get_annotation_sizes(annotations, video_index, default_size):
+    # (heights, widths) of all clips from the annotations or the video index, `default_size` if unknown
+    if 'height' in annotations.columns:
+        return np.asarray(annotations.columns['height']), np.asarray(annotations.columns['width'])
+    heights = np.full(len(annotations), default_size[0])
+    widths = np.full(len(annotations), default_size[1])
+    if video_index is not None:
+        for idx in range(len(annotations)):
+            size = video_index.get_size(annotations.get(idx, 'file'))
+            if size is not None:
+                heights[idx], widths[idx] = size
+    return heights, widths
+
+
 class WebVid10M(Dataset):
     def __init__(
             self,
             json_path, video_folder=None,
             sample_size=256, sample_stride=4, sample_n_frames=16,
             is_image=False,
+            video_index_path=None, align_to_keyframes=False,
+            max_open_readers=8, max_open_bytes=None,
+            max_retries=10,
+            aspect_ratio_buckets=None,
             **kwargs,
         ):
         logger.info(f"loading annotations from {json_path} ...")
-        with open(json_path, 'rb') as json_file:
-            json_list = list(json_file)
-        self.dataset = [json.loads(json_str) for json_str in json_list]
+        self.dataset = load_webvid_annotations(json_path)
         self.length = len(self.dataset)
         logger.info(f"data scale: {self.length}")
 
@@ -31,15 +73,36 @@ class WebVid10M(Dataset):
         self.sample_stride   = sample_stride if isinstance(sample_stride, int) else tuple(sample_stride)
         self.sample_n_frames = sample_n_frames
         self.is_image        = is_image
+
+        self.video_index        = VideoIndex.load_for_annotations(json_path, video_index_path)
+        self.align_to_keyframes = align_to_keyframes
+        self.reader_pool        = VideoReaderPool(max_open_readers, max_open_bytes)
+        self.failure_registry   = FailureRegistry(self.length)
+        self.max_retries        = max_retries
         
         sample_size = tuple(sample_size) if not isinstance(sample_size, int) else (sample_size, sample_size)
+        self.sample_size = sample_size
+        # frames stay uint8, see `normalize_pixel_values`; Resize is a no-op when decord already decoded at
+        # the sample size
         self.pixel_transforms = transforms.Compose([
             transforms.RandomHorizontalFlip(),
             transforms.Resize(sample_size[0], antialias=None),
             transforms.CenterCrop(sample_size),
-            transforms.Normalize(mean=[0.5, 0.5, 0.5], std=[0.5, 0.5, 0.5], inplace=True),
         ])
+
+        # aspect ratio buckets, batch with `AspectRatioBucketBatchSampler(dataset.buckets.bucket_ids, ...)`
+        self.buckets = None
+        if aspect_ratio_buckets is not None:
+            heights, widths = get_annotation_sizes(self.dataset, self.video_index, sample_size)
+            self.buckets = AspectRatioBuckets(sample_size, aspect_ratio_buckets, heights, widths)
+        self.random_flip = transforms.RandomHorizontalFlip()
     
+    def get_resize_size(self, idx, height, width):
+        # short side that the frames of clip `idx` are resized to before cropping
+        if self.buckets is None:
+            return self.sample_size[0]
+        return self.buckets.get_resize_size(idx, height, width)
+
     def get_batch(self, idx):
         video_dict = self.dataset[idx]
         video_relative_path, name = video_dict['file'], video_dict['text']
@@ -51,8 +114,10 @@ class WebVid10M(Dataset):
                 video_dir = os.path.join(self.video_folder, video_relative_path)
         else:
             video_dir = video_relative_path
-        video_reader = VideoReader(video_dir)
-        video_length = len(video_reader)
+        video_size = self.video_index.get_size(video_relative_path) if self.video_index is not None else None
+        decode_size = get_decode_size(*video_size, self.get_resize_size(idx, *video_size)) if video_size is not None else None
+        video_length = get_video_length(video_dir, video_relative_path, self.video_index, self.reader_pool, decode_size)
+        keyframes = self.video_index.get_keyframes(video_relative_path) if self.align_to_keyframes and self.video_index is not None else None
         
         if not self.is_image:
             if isinstance(self.sample_stride, int):
@@ -60,17 +125,15 @@ class WebVid10M(Dataset):
             elif isinstance(self.sample_stride, tuple):
                 stride = random.randint(self.sample_stride[0], self.sample_stride[1])
             clip_length = min(video_length, (self.sample_n_frames - 1) * stride + 1)
-            start_idx   = random.randint(0, video_length - clip_length)
+            start_idx   = sample_clip_start(video_length, clip_length, keyframes)
             batch_index = np.linspace(start_idx, start_idx + clip_length - 1, self.sample_n_frames, dtype=int)
         else:
             frame_difference = random.randint(2, self.sample_n_frames)
             clip_length = min(video_length, (frame_difference - 1) * self.sample_stride + 1)
-            start_idx = random.randint(0, video_length - clip_length)
+            start_idx = sample_clip_start(video_length, clip_length, keyframes)
             batch_index = [start_idx, start_idx + clip_length - 1]
 
-        pixel_values = torch.from_numpy(video_reader.get_batch(batch_index).asnumpy()).permute(0, 3, 1, 2).contiguous()
-        pixel_values = pixel_values / 255.
-        del video_reader
+        pixel_values = torch.from_numpy(read_frames(video_dir, batch_index, self.reader_pool, decode_size)).permute(0, 3, 1, 2).contiguous()
         
         return pixel_values, name
 
@@ -78,15 +141,13 @@ class WebVid10M(Dataset):
         return self.length
 
     def __getitem__(self, idx):
-        while True:
-            try:
-                pixel_values, name = self.get_batch(idx)
-                break
-
-            except Exception as e:
-                idx = random.randint(0, self.length-1)
+        replacement_indices = self.buckets.get_replacement_indices(idx) if self.buckets is not None else None
+        pixel_values, name = get_batch_with_retries(self.get_batch, idx, self.length, self.failure_registry, self.max_retries, replacement_indices)
 
-        pixel_values = self.pixel_transforms(pixel_values)
+        if self.buckets is None:
+            pixel_values = self.pixel_transforms(pixel_values)
+        else:
+            pixel_values = resize_and_center_crop(self.random_flip(pixel_values), self.buckets.get_target_size(idx))
         sample = dict(pixel_values=pixel_values, text=name)
         return sample
 
@@ -97,23 +158,15 @@ class Pexels(Dataset):
             json_path, caption_json_path, video_folder=None,
             sample_size=256, sample_duration=1, sample_fps=8,
             is_image=False,
+            video_index_path=None, align_to_keyframes=False,
+            max_open_readers=8, max_open_bytes=None,
+            max_retries=10,
+            aspect_ratio_buckets=None,
             **kwargs,
         ):
-        logger.info(f"loading captions from {caption_json_path} ...")
-        with open(caption_json_path, 'rb') as caption_json_file:
-            caption_json_list = list(caption_json_file)
-        self.caption_dict = {json.loads(json_str)['id']: json.loads(json_str)['text'] for json_str in caption_json_list}
-        
         logger.info(f"loading annotations from {json_path} ...")
-        with open(json_path, 'rb') as json_file:
-            json_list = list(json_file)
-        dataset = [json.loads(json_str) for json_str in json_list]
-
-        self.dataset = []
-        for data in dataset:
-            data['text'] = self.caption_dict[data['id']]
-            if data['height'] / data['width'] < 0.625:
-                self.dataset.append(data)
+        # with aspect ratio buckets, clips of any aspect ratio are used
+        self.dataset = load_pexels_annotations(json_path, caption_json_path, 0.625 if aspect_ratio_buckets is None else None)
         self.length = len(self.dataset)
         logger.info(f"data scale: {self.length}")
 
@@ -122,15 +175,36 @@ class Pexels(Dataset):
         self.sample_fps      = sample_fps
         self.sample_n_frames = sample_duration * sample_fps
         self.is_image        = is_image
+
+        self.video_index        = VideoIndex.load_for_annotations(json_path, video_index_path)
+        self.align_to_keyframes = align_to_keyframes
+        self.reader_pool        = VideoReaderPool(max_open_readers, max_open_bytes)
+        self.failure_registry   = FailureRegistry(self.length)
+        self.max_retries        = max_retries
         
         sample_size = tuple(sample_size) if not isinstance(sample_size, int) else (sample_size, sample_size)
+        self.sample_size = sample_size
+        # frames stay uint8, see `normalize_pixel_values`; Resize is a no-op when decord already decoded at
+        # the sample size
         self.pixel_transforms = transforms.Compose([
             transforms.RandomHorizontalFlip(),
             transforms.Resize(sample_size[0], antialias=None),
             transforms.CenterCrop(sample_size),
-            transforms.Normalize(mean=[0.5, 0.5, 0.5], std=[0.5, 0.5, 0.5], inplace=True),
         ])
+
+        # aspect ratio buckets, batch with `AspectRatioBucketBatchSampler(dataset.buckets.bucket_ids, ...)`
+        self.buckets = None
+        if aspect_ratio_buckets is not None:
+            heights, widths = get_annotation_sizes(self.dataset, self.video_index, sample_size)
+            self.buckets = AspectRatioBuckets(sample_size, aspect_ratio_buckets, heights, widths)
+        self.random_flip = transforms.RandomHorizontalFlip()
     
+    def get_resize_size(self, idx, height, width):
+        # short side that the frames of clip `idx` are resized to before cropping
+        if self.buckets is None:
+            return self.sample_size[0]
+        return self.buckets.get_resize_size(idx, height, width)
+
     def get_batch(self, idx):
         video_dict = self.dataset[idx]
         video_relative_path, name = video_dict['file'], video_dict['text']
@@ -143,23 +217,25 @@ class Pexels(Dataset):
                 video_dir = os.path.join(self.video_folder, video_relative_path)
         else:
             video_dir = video_relative_path
-        video_reader = VideoReader(video_dir)
-        video_length = len(video_reader)
+        video_size = self.video_index.get_size(video_relative_path) if self.video_index is not None else None
+        if video_size is None:
+            video_size = (video_dict['height'], video_dict['width'])
+        decode_size = get_decode_size(*video_size, self.get_resize_size(idx, *video_size))
+        video_length = get_video_length(video_dir, video_relative_path, self.video_index, self.reader_pool, decode_size)
+        keyframes = self.video_index.get_keyframes(video_relative_path) if self.align_to_keyframes and self.video_index is not None else None
         
         if not self.is_image:
             clip_length = min(video_length, math.ceil(fps * self.sample_duration))
-            start_idx   = random.randint(0, video_length - clip_length)
+            start_idx   = sample_clip_start(video_length, clip_length, keyframes)
             batch_index = np.linspace(start_idx, start_idx + clip_length - 1, self.sample_n_frames, dtype=int)
         else:
             frame_difference = random.randint(2, self.sample_n_frames)
             sample_stride = math.ceil((fps * self.sample_duration) / (self.sample_n_frames - 1) - 1)
             clip_length = min(video_length, (frame_difference - 1) * sample_stride + 1)
-            start_idx = random.randint(0, video_length - clip_length)
+            start_idx = sample_clip_start(video_length, clip_length, keyframes)
             batch_index = [start_idx, start_idx + clip_length - 1]
 
-        pixel_values = torch.from_numpy(video_reader.get_batch(batch_index).asnumpy()).permute(0, 3, 1, 2).contiguous()
-        pixel_values = pixel_values / 255.
-        del video_reader
+        pixel_values = torch.from_numpy(read_frames(video_dir, batch_index, self.reader_pool, decode_size)).permute(0, 3, 1, 2).contiguous()
         
         return pixel_values, name
 
@@ -167,15 +243,13 @@ class Pexels(Dataset):
         return self.length
 
     def __getitem__(self, idx):
-        while True:
-            try:
-                pixel_values, name = self.get_batch(idx)
-                break
-
-            except Exception as e:
-                idx = random.randint(0, self.length-1)
+        replacement_indices = self.buckets.get_replacement_indices(idx) if self.buckets is not None else None
+        pixel_values, name = get_batch_with_retries(self.get_batch, idx, self.length, self.failure_registry, self.max_retries, replacement_indices)
 
-        pixel_values = self.pixel_transforms(pixel_values)
+        if self.buckets is None:
+            pixel_values = self.pixel_transforms(pixel_values)
+        else:
+            pixel_values = resize_and_center_crop(self.random_flip(pixel_values), self.buckets.get_target_size(idx))
         sample = dict(pixel_values=pixel_values, text=name)
         return sample
 
@@ -187,6 +261,10 @@ class JointDataset(Dataset):
             sample_size=256,
             sample_duration=None, sample_fps=None, sample_stride=None, sample_n_frames=None,
             is_image=False,
+            align_to_keyframes=False,
+            max_open_readers=8, max_open_bytes=None,
+            max_retries=10,
+            aspect_ratio_buckets=None,
             **kwargs,
         ):
         assert (sample_duration is None and sample_fps is None) or (sample_duration is not None and sample_fps is not None), "sample_duration and sample_fps should be both None or not None"
@@ -195,37 +273,19 @@ class JointDataset(Dataset):
         if sample_stride is not None:
             assert sample_fps is None and sample_duration is None, "when sample_stride is not None, sample_duration and sample_fps should be both None"
 
-        self.dataset = []
-
+        # (name, annotations) of every enabled dataset, indexed as one concatenated dataset
+        self.datasets = []
         if pexels_config.enable:
             logger.info(f"loading pexels dataset")
-            logger.info(f"loading captions from {pexels_config.caption_json_path} ...")
-            with open(pexels_config.caption_json_path, 'rb') as caption_json_file:
-                caption_json_list = list(caption_json_file)
-            self.caption_dict = {json.loads(json_str)['id']: json.loads(json_str)['text'] for json_str in caption_json_list}
-            
             logger.info(f"loading annotations from {pexels_config.json_path} ...")
-            with open(pexels_config.json_path, 'rb') as json_file:
-                json_list = list(json_file)
-            dataset = [json.loads(json_str) for json_str in json_list]
-
-            for data in dataset:
-                data['text'] = self.caption_dict[data['id']]
-                data['dataset'] = 'pexels'
-                if data['height'] / data['width'] < 0.625:
-                    self.dataset.append(data)
-        
+            self.datasets.append(('pexels', load_pexels_annotations(pexels_config.json_path, pexels_config.caption_json_path, 0.625 if aspect_ratio_buckets is None else None)))
         if webvid_config.enable:
             logger.info(f"loading webvid dataset")
             logger.info(f"loading annotations from {webvid_config.json_path} ...")
-            with open(webvid_config.json_path, 'rb') as json_file:
-                json_list = list(json_file)
-            dataset = [json.loads(json_str) for json_str in json_list]
-            for data in dataset:
-                data['dataset'] = 'webvid'
-            self.dataset.extend(dataset)
+            self.datasets.append(('webvid', load_webvid_annotations(webvid_config.json_path)))
+        self.dataset_offsets = np.cumsum([0] + [len(annotations) for _, annotations in self.datasets])
 
-        self.length = len(self.dataset)
+        self.length = int(self.dataset_offsets[-1])
         logger.info(f"data scale: {self.length}")
 
         self.pexels_folder   = pexels_config.video_folder
@@ -235,18 +295,52 @@ class JointDataset(Dataset):
         self.sample_n_frames = sample_duration * sample_fps if sample_n_frames is None else sample_n_frames
         self.sample_stride   = sample_stride if (sample_stride is None) or (sample_stride is not None and isinstance(sample_stride, int)) else tuple(sample_stride)
         self.is_image        = is_image
+
+        # per-dataset video indices, built with scripts/build_video_index.py
+        self.video_indices = {}
+        if pexels_config.enable:
+            self.video_indices['pexels'] = VideoIndex.load_for_annotations(pexels_config.json_path, pexels_config.get('video_index_path', None))
+        if webvid_config.enable:
+            self.video_indices['webvid'] = VideoIndex.load_for_annotations(webvid_config.json_path, webvid_config.get('video_index_path', None))
+        self.align_to_keyframes = align_to_keyframes
+        self.reader_pool        = VideoReaderPool(max_open_readers, max_open_bytes)
+        self.failure_registry   = FailureRegistry(self.length)
+        self.max_retries        = max_retries
         
         sample_size = tuple(sample_size) if not isinstance(sample_size, int) else (sample_size, sample_size)
+        self.sample_size = sample_size
+        # frames stay uint8, see `normalize_pixel_values`; Resize is a no-op when decord already decoded at
+        # the sample size
         self.pixel_transforms = transforms.Compose([
             transforms.RandomHorizontalFlip(),
             transforms.Resize(sample_size[0], antialias=None),
             transforms.CenterCrop(sample_size),
-            transforms.Normalize(mean=[0.5, 0.5, 0.5], std=[0.5, 0.5, 0.5], inplace=True),
         ])
+
+        # aspect ratio buckets, batch with `AspectRatioBucketBatchSampler(dataset.buckets.bucket_ids, ...)`
+        self.buckets = None
+        if aspect_ratio_buckets is not None:
+            sizes = [get_annotation_sizes(annotations, self.video_indices[name], sample_size) for name, annotations in self.datasets]
+            heights = np.concatenate([heights for heights, _ in sizes])
+            widths = np.concatenate([widths for _, widths in sizes])
+            self.buckets = AspectRatioBuckets(sample_size, aspect_ratio_buckets, heights, widths)
+        self.random_flip = transforms.RandomHorizontalFlip()
     
+    def get_video_dict(self, idx):
+        dataset_idx = int(np.searchsorted(self.dataset_offsets, idx, side='right')) - 1
+        dataset_name, annotations = self.datasets[dataset_idx]
+        return dict(annotations[idx - int(self.dataset_offsets[dataset_idx])], dataset=dataset_name)
+
+    def get_resize_size(self, idx, height, width):
+        # short side that the frames of clip `idx` are resized to before cropping
+        if self.buckets is None:
+            return self.sample_size[0]
+        return self.buckets.get_resize_size(idx, height, width)
+
     def get_batch(self, idx):
-        video_dict = self.dataset[idx]
+        video_dict = self.get_video_dict(idx)
         video_relative_path, name = video_dict['file'], video_dict['text']
+        video_index = self.video_indices[video_dict['dataset']]
 
         if video_dict['dataset'] == 'pexels':
             video_folder = self.pexels_folder
@@ -262,8 +356,12 @@ class JointDataset(Dataset):
                 video_dir = os.path.join(video_folder, video_relative_path)
         else:
             video_dir = video_relative_path
-        video_reader = VideoReader(video_dir)
-        video_length = len(video_reader)
+        video_size = video_index.get_size(video_relative_path) if video_index is not None else None
+        if video_size is None and 'height' in video_dict:
+            video_size = (video_dict['height'], video_dict['width'])
+        decode_size = get_decode_size(*video_size, self.get_resize_size(idx, *video_size)) if video_size is not None else None
+        video_length = get_video_length(video_dir, video_relative_path, video_index, self.reader_pool, decode_size)
+        keyframes = video_index.get_keyframes(video_relative_path) if self.align_to_keyframes and video_index is not None else None
         
         stride = None
         if not self.is_image:
@@ -277,7 +375,7 @@ class JointDataset(Dataset):
                     stride = random.randint(self.sample_stride[0], self.sample_stride[1])
                 clip_length = min(video_length, (self.sample_n_frames - 1) * stride + 1)
 
-            start_idx   = random.randint(0, video_length - clip_length)
+            start_idx   = sample_clip_start(video_length, clip_length, keyframes)
             batch_index = np.linspace(start_idx, start_idx + clip_length - 1, self.sample_n_frames, dtype=int)
 
         else:
@@ -289,12 +387,10 @@ class JointDataset(Dataset):
                 sample_stride = self.sample_stride
             
             clip_length = min(video_length, (frame_difference - 1) * sample_stride + 1)
-            start_idx = random.randint(0, video_length - clip_length)
+            start_idx = sample_clip_start(video_length, clip_length, keyframes)
             batch_index = [start_idx, start_idx + clip_length - 1]
 
-        pixel_values = torch.from_numpy(video_reader.get_batch(batch_index).asnumpy()).permute(0, 3, 1, 2).contiguous()
-        pixel_values = pixel_values / 255.
-        del video_reader
+        pixel_values = torch.from_numpy(read_frames(video_dir, batch_index, self.reader_pool, decode_size)).permute(0, 3, 1, 2).contiguous()
         
         return pixel_values, name, stride
 
@@ -302,14 +398,84 @@ class JointDataset(Dataset):
         return self.length
 
     def __getitem__(self, idx):
-        while True:
-            try:
-                pixel_values, name, stride = self.get_batch(idx)
-                break
+        replacement_indices = self.buckets.get_replacement_indices(idx) if self.buckets is not None else None
+        pixel_values, name, stride = get_batch_with_retries(self.get_batch, idx, self.length, self.failure_registry, self.max_retries, replacement_indices)
 
-            except Exception as e:
-                idx = random.randint(0, self.length-1)
-
-        pixel_values = self.pixel_transforms(pixel_values)
+        if self.buckets is None:
+            pixel_values = self.pixel_transforms(pixel_values)
+        else:
+            pixel_values = resize_and_center_crop(self.random_flip(pixel_values), self.buckets.get_target_size(idx))
         sample = dict(pixel_values=pixel_values, text=name, stride=stride)
         return sample
+
+
+class LatentDataset(Dataset):
+    """
+    Clips precomputed by `scripts/latentize.py`: VAE latent distributions and CLIP text embeddings stored in
+    memory-mapped shards. Every access samples new latents from the stored distribution, so no VAE or text
+    encoder is needed in the training loop.
+    """
+    def __init__(
+            self,
+            latent_folder,
+            sample_n_frames=None,
+            is_image=False,
+            **kwargs,
+        ):
+        index_paths = sorted(glob.glob(os.path.join(latent_folder, "index*.json")))
+        assert len(index_paths) > 0, f"no index file found in {latent_folder}"
+        logger.info(f"loading latent index from {latent_folder} ...")
+
+        self.latent_folder = latent_folder
+        self.shards = []
+        for index_path in index_paths:
+            with open(index_path, 'r') as index_file:
+                index = json.load(index_file)
+            self.shards.extend(shard for shard in index['shards'] if shard['num_samples'] > 0)
+        self.num_frames     = index['num_frames']
+        self.scaling_factor = index['scaling_factor']
+        self.null_text_embeds = torch.from_numpy(np.load(os.path.join(latent_folder, index['null_text_embeds'])))
+        self.shard_offsets  = np.cumsum([0] + [shard['num_samples'] for shard in self.shards])
+        self.length = int(self.shard_offsets[-1])
+        logger.info(f"data scale: {self.length}")
+
+        if sample_n_frames is not None:
+            assert sample_n_frames == self.num_frames, f"sample_n_frames ({sample_n_frames}) does not match the latentized clips ({self.num_frames})"
+        self.sample_n_frames = self.num_frames
+        self.is_image        = is_image
+
+        # memory maps are opened lazily so that every dataloader worker opens its own
+        self._shard_arrays = {}
+
+    def get_shard_arrays(self, shard_idx):
+        if shard_idx not in self._shard_arrays:
+            shard_name = self.shards[shard_idx]['name']
+            self._shard_arrays[shard_idx] = {
+                field: np.load(os.path.join(self.latent_folder, f"{shard_name}.{field}.npy"), mmap_mode='r')
+                for field in ('latent_mean', 'latent_std', 'text_embeds', 'stride')
+            }
+        return self._shard_arrays[shard_idx]
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, idx):
+        shard_idx = int(np.searchsorted(self.shard_offsets, idx, side='right')) - 1
+        arrays = self.get_shard_arrays(shard_idx)
+        sample_idx = idx - self.shard_offsets[shard_idx]
+
+        if not self.is_image:
+            frame_index = slice(None)
+        else:
+            frame_difference = random.randint(2, self.num_frames)
+            frame_index = [0, frame_difference - 1]
+
+        latent_mean = torch.from_numpy(np.array(arrays['latent_mean'][sample_idx][:, frame_index], dtype=np.float32))
+        latent_std  = torch.from_numpy(np.array(arrays['latent_std'][sample_idx][:, frame_index], dtype=np.float32))
+        latents = latent_mean + latent_std * torch.randn_like(latent_mean)
+
+        text_embeds = torch.from_numpy(np.array(arrays['text_embeds'][sample_idx]))
+        stride = int(arrays['stride'][sample_idx])
+
+        sample = dict(latents=latents, text_embeds=text_embeds, stride=stride)
+        return sample
@@ -0,0 +1,107 @@
+import queue
+import threading
+
+import torch
+
+
+def send_to_device(batch, device, non_blocking=False):
+    if isinstance(batch, torch.Tensor):
+        return batch.to(device, non_blocking=non_blocking)
+    if isinstance(batch, dict):
+        return {key: send_to_device(value, device, non_blocking) for key, value in batch.items()}
+    if isinstance(batch, (list, tuple)):
+        return type(batch)(send_to_device(value, device, non_blocking) for value in batch)
+    return batch
+
+
+def record_stream(batch, stream):
+    # tensors copied on a side stream must not be freed while the consuming stream may still use them
+    if isinstance(batch, torch.Tensor):
+        batch.record_stream(stream)
+    elif isinstance(batch, dict):
+        for value in batch.values():
+            record_stream(value, stream)
+    elif isinstance(batch, (list, tuple)):
+        for value in batch:
+            record_stream(value, stream)
+
+
+class BatchPrefetcher:
+    """
+    Iterates a dataloader ahead of the training loop. A background thread fetches batches and runs
+    `preprocess_fn` on them (e.g. tokenization), and batches are copied to `device` one step ahead, on a
+    side stream on CUDA, so that the copy of the next batch overlaps with the current step. On other devices
+    the copy runs in the background thread.
+
+    The dataloader should use `pin_memory=True` for the CUDA copies to be asynchronous.
+
+    Args:
+        dataloader: iterable of batches
+        device: device to move the batches to
+        preprocess_fn: optional function applied to every batch before the copy
+        num_prefetch: number of preprocessed batches kept ready
+    """
+
+    def __init__(self, dataloader, device, preprocess_fn=None, num_prefetch=2):
+        self.dataloader = dataloader
+        self.device = torch.device(device)
+        self.preprocess_fn = preprocess_fn
+        self.num_prefetch = num_prefetch
+
+    def __len__(self):
+        return len(self.dataloader)
+
+    def _produce(self, batches, stop_event, copy_to_device):
+        try:
+            for batch in self.dataloader:
+                if self.preprocess_fn is not None:
+                    batch = self.preprocess_fn(batch)
+                if copy_to_device:
+                    batch = send_to_device(batch, self.device)
+                while not stop_event.is_set():
+                    try:
+                        batches.put((batch, None), timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+                if stop_event.is_set():
+                    return
+            batches.put((None, None))
+        except Exception as e:
+            batches.put((None, e))
+
+    def _iter_batches(self, copy_to_device):
+        batches = queue.Queue(maxsize=self.num_prefetch)
+        stop_event = threading.Event()
+        thread = threading.Thread(target=self._produce, args=(batches, stop_event, copy_to_device), daemon=True)
+        thread.start()
+        try:
+            while True:
+                batch, error = batches.get()
+                if error is not None:
+                    raise error
+                if batch is None:
+                    return
+                yield batch
+        finally:
+            # stop the producer when the loop breaks early
+            stop_event.set()
+
+    def __iter__(self):
+        if self.device.type != "cuda":
+            yield from self._iter_batches(copy_to_device=True)
+            return
+
+        stream = torch.cuda.Stream(self.device)
+        next_batch = None
+        for batch in self._iter_batches(copy_to_device=False):
+            with torch.cuda.stream(stream):
+                batch = send_to_device(batch, self.device, non_blocking=True)
+            if next_batch is not None:
+                yield next_batch
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(stream)
+            record_stream(batch, current_stream)
+            next_batch = batch
+        if next_batch is not None:
+            yield next_batch
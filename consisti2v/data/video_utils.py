@@ -0,0 +1,318 @@
+import os
+import random
+import time
+from collections import OrderedDict
+
+import numpy as np
+import torch
+from decord import VideoReader
+
+from diffusers.utils import logging
+
+logger = logging.get_logger(__name__)
+
+
+class VideoReaderPool:
+    """
+    LRU pool of open decord readers, so that container parsing is not repeated for videos that are read
+    again. Readers are not shared across processes: every dataloader worker builds its own pool on first use.
+
+    Args:
+        max_readers: maximum number of open readers
+        max_bytes: optional maximum total file size of the videos with an open reader
+    """
+
+    def __init__(self, max_readers=8, max_bytes=None):
+        self.max_readers = max_readers
+        self.max_bytes = max_bytes
+        self._readers = OrderedDict()
+        self._size = 0
+        self._pid = None
+        self._inherited = []
+
+    def _check_pid(self):
+        # readers opened in the parent process must not be used by forked workers. They are not freed either:
+        # closing a decord reader that was opened before the fork can deadlock the worker
+        if self._pid != os.getpid():
+            self._inherited.append(self._readers)
+            self._readers = OrderedDict()
+            self._size = 0
+            self._pid = os.getpid()
+
+    def get(self, path, decode_size=None):
+        # `decode_size` is the (width, height) that decord scales the frames to, None for the native size
+        self._check_pid()
+        key = (path, decode_size)
+        if key in self._readers:
+            self._readers.move_to_end(key)
+            return self._readers[key][0]
+
+        width, height = decode_size if decode_size is not None else (-1, -1)
+        video_reader = VideoReader(path, width=width, height=height)
+        if self.max_readers <= 0:
+            return video_reader
+        nbytes = os.path.getsize(path)
+        self._readers[key] = (video_reader, nbytes)
+        self._size += nbytes
+        while len(self._readers) > self.max_readers or (self.max_bytes is not None and self._size > self.max_bytes and len(self._readers) > 1):
+            _, (_, evicted_nbytes) = self._readers.popitem(last=False)
+            self._size -= evicted_nbytes
+        return video_reader
+
+    def discard(self, path, decode_size=None):
+        # drop a reader that failed, so that the next access reopens the file
+        self._check_pid()
+        key = (path, decode_size)
+        if key in self._readers:
+            _, nbytes = self._readers.pop(key)
+            self._size -= nbytes
+
+    def __getstate__(self):
+        # open readers cannot be pickled into dataloader workers
+        state = self.__dict__.copy()
+        state["_readers"] = OrderedDict()
+        state["_inherited"] = []
+        state["_size"] = 0
+        state["_pid"] = None
+        return state
+
+
+def get_video_index_path(json_path):
+    return f"{json_path}.index.npz"
+
+
+class VideoIndex:
+    """
+    Per-video frame count, size, fps and keyframe positions stored next to an annotation file, keyed by the
+    "file" field of the annotations. Built with `scripts/build_video_index.py`.
+
+    The files are sorted and stored like the string columns of `AnnotationStore`, one utf-8 byte array plus
+    an offset array, and looked up by binary search, so the index holds no Python object per video and forked
+    dataloader workers share its pages.
+    """
+
+    def __init__(self, files_data, files_offsets, num_frames, heights, widths, fps, keyframes, keyframe_offsets):
+        self.files_data = files_data
+        self.files_offsets = files_offsets
+        self.num_frames = num_frames
+        self.heights = heights
+        self.widths = widths
+        self.fps = fps
+        self.keyframes = keyframes
+        self.keyframe_offsets = keyframe_offsets
+
+    @classmethod
+    def from_files(cls, files, num_frames, heights, widths, fps, keyframes, keyframe_offsets):
+        # `files` and the per-video arrays in any order, the rows are sorted by file
+        encoded = [file.encode("utf-8") for file in files]
+        order = np.array(sorted(range(len(encoded)), key=encoded.__getitem__), dtype=np.int64)
+        files_offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(encoded[row]) for row in order], out=files_offsets[1:])
+        files_data = np.frombuffer(b"".join(encoded[row] for row in order), dtype=np.uint8)
+
+        # the keyframes of every video, in the sorted order
+        keyframe_counts = np.diff(keyframe_offsets)[order]
+        sorted_keyframe_offsets = np.zeros(len(order) + 1, dtype=np.int64)
+        np.cumsum(keyframe_counts, out=sorted_keyframe_offsets[1:])
+        keyframe_index = np.repeat(keyframe_offsets[:-1][order] - sorted_keyframe_offsets[:-1], keyframe_counts)
+        keyframe_index += np.arange(sorted_keyframe_offsets[-1])
+
+        return cls(
+            files_data=files_data,
+            files_offsets=files_offsets,
+            num_frames=num_frames[order],
+            heights=heights[order],
+            widths=widths[order],
+            fps=fps[order],
+            keyframes=keyframes[keyframe_index],
+            keyframe_offsets=sorted_keyframe_offsets,
+        )
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        arrays = {
+            name: data[name] for name in ("num_frames", "heights", "widths", "fps", "keyframes", "keyframe_offsets")
+        }
+        if "files" in data:
+            # indexes saved before the files were stored as bytes
+            return cls.from_files(files=data["files"].tolist(), **arrays)
+        return cls(files_data=data["files_data"], files_offsets=data["files_offsets"], **arrays)
+
+    @classmethod
+    def load_for_annotations(cls, json_path, index_path=None):
+        # the index next to the annotation file, or None if it has not been built
+        index_path = index_path or get_video_index_path(json_path)
+        return cls.load(index_path) if os.path.exists(index_path) else None
+
+    def save(self, path):
+        np.savez(
+            path,
+            files_data=self.files_data,
+            files_offsets=self.files_offsets,
+            num_frames=self.num_frames,
+            heights=self.heights,
+            widths=self.widths,
+            fps=self.fps,
+            keyframes=self.keyframes,
+            keyframe_offsets=self.keyframe_offsets,
+        )
+
+    def __len__(self):
+        return len(self.files_offsets) - 1
+
+    def __contains__(self, file):
+        return self._find_row(file) is not None
+
+    def _get_file_bytes(self, row):
+        return self.files_data[self.files_offsets[row]:self.files_offsets[row + 1]].tobytes()
+
+    def _find_row(self, file):
+        key = file.encode("utf-8")
+        low, high = 0, len(self)
+        while low < high:
+            mid = (low + high) // 2
+            if self._get_file_bytes(mid) < key:
+                low = mid + 1
+            else:
+                high = mid
+        return low if low < len(self) and self._get_file_bytes(low) == key else None
+
+    def get_num_frames(self, file):
+        row = self._find_row(file)
+        return None if row is None else int(self.num_frames[row])
+
+    def get_size(self, file):
+        row = self._find_row(file)
+        return None if row is None else (int(self.heights[row]), int(self.widths[row]))
+
+    def get_keyframes(self, file):
+        row = self._find_row(file)
+        return None if row is None else self.keyframes[self.keyframe_offsets[row]:self.keyframe_offsets[row + 1]]
+
+
+def sample_clip_start(video_length, clip_length, keyframes=None):
+    """
+    Random start index of a clip of `clip_length` frames. If `keyframes` is given, the clip starts on a
+    random keyframe that leaves room for the clip when there is one, which avoids decoding from the previous
+    keyframe up to the start of the clip.
+    """
+    max_start_idx = video_length - clip_length
+    if keyframes is not None:
+        keyframes = keyframes[keyframes <= max_start_idx]
+        if len(keyframes) > 0:
+            return int(random.choice(keyframes))
+    return random.randint(0, max_start_idx)
+
+
+def get_decode_size(height, width, short_side):
+    """
+    (width, height) at which decord should decode a `height` x `width` video so that its short side is
+    `short_side`, the output size of `transforms.Resize(short_side)`. None if the video is not larger than
+    that, upscaling is left to the transforms.
+    """
+    if min(height, width) <= short_side:
+        return None
+    if height <= width:
+        return int(short_side * width / height), short_side
+    return short_side, int(short_side * height / width)
+
+
+def get_video_length(video_path, file, video_index=None, reader_pool=None, decode_size=None):
+    # frame count from the index if available, otherwise from the (pooled) reader
+    video_length = video_index.get_num_frames(file) if video_index is not None else None
+    if video_length is None:
+        video_reader = reader_pool.get(video_path, decode_size) if reader_pool is not None else VideoReader(video_path)
+        video_length = len(video_reader)
+    return video_length
+
+
+def read_frames(video_path, batch_index, reader_pool, decode_size=None):
+    video_reader = reader_pool.get(video_path, decode_size)
+    try:
+        return video_reader.get_batch(batch_index).asnumpy()
+    except Exception:
+        reader_pool.discard(video_path, decode_size)
+        raise
+
+
+def normalize_pixel_values(pixel_values, dtype=torch.float32):
+    # uint8 frames returned by the video datasets to [-1, 1], meant to run on the training device
+    return (pixel_values.float() / 127.5 - 1.0).to(dtype)
+
+
+class FailureRegistry:
+    """
+    Samples that failed to load, shared by the dataloader workers. The counts live in shared memory tensors
+    created by the main process, which the workers share with any multiprocessing start method, so a sample
+    that fails in one worker is skipped by all workers from then on, including in later epochs, and the main
+    process sees the failures of all workers.
+
+    The updates are not locked: workers failing at the same time can lose each other's increments, so the
+    counts and `get_stats` are best-effort and meant for logging. A sample that failed is always marked failed.
+
+    Args:
+        num_samples: number of samples in the dataset
+    """
+
+    def __init__(self, num_samples):
+        # per-sample failure count, saturating at 255
+        self.failures = torch.zeros(num_samples, dtype=torch.uint8).share_memory_()
+        # number of failures, number of replacement draws and seconds spent on failed attempts
+        self.counters = torch.zeros(3, dtype=torch.float64).share_memory_()
+
+    def is_failed(self, idx):
+        return bool(self.failures[idx] > 0)
+
+    def record_failure(self, idx, elapsed):
+        self.failures[idx] = min(int(self.failures[idx]) + 1, 255)
+        self.counters[0] += 1
+        self.counters[2] += elapsed
+
+    def record_retry(self):
+        self.counters[1] += 1
+
+    def get_failed_samples(self):
+        failures = self.failures.numpy()
+        return {int(idx): int(failures[idx]) for idx in np.flatnonzero(failures)}
+
+    def get_stats(self):
+        num_failures, num_retries, retry_time = self.counters.tolist()
+        return {
+            "num_failures": int(num_failures),
+            "num_failed_samples": int(torch.count_nonzero(self.failures)),
+            "num_retries": int(num_retries),
+            "retry_time": retry_time,
+        }
+
+
+def get_batch_with_retries(get_batch, idx, num_samples, failure_registry, max_retries=10, replacement_indices=None):
+    """
+    Calls `get_batch(idx)`, replacing samples that fail or failed before with random ones, drawn from
+    `replacement_indices` if given. Raises after `max_retries` failed loads instead of retrying forever.
+    """
+    def get_replacement():
+        if replacement_indices is not None:
+            return int(random.choice(replacement_indices))
+        return random.randint(0, num_samples - 1)
+
+    num_attempts = 0
+    while True:
+        # known failures are replaced without trying them again
+        num_draws = 0
+        while failure_registry.is_failed(idx) and num_draws < 100:
+            idx = get_replacement()
+            failure_registry.record_retry()
+            num_draws += 1
+
+        t0 = time.time()
+        try:
+            return get_batch(idx)
+        except Exception as e:
+            failure_registry.record_failure(idx, time.time() - t0)
+            logger.warning(f"failed to load sample {idx}: {e}")
+            num_attempts += 1
+            if num_attempts > max_retries:
+                raise RuntimeError(f"failed to load a sample after {num_attempts} attempts") from e
+            idx = get_replacement()
+            failure_registry.record_retry()
@@ -1,4 +1,5 @@
 from math import pi, log
+import importlib.util
 
 import torch
 from torch.nn import Module, ModuleList
@@ -47,6 +48,50 @@ def apply_rotary_emb(freqs, t, start_index = 0, scale = 1., seq_dim = -2):
     t = (t * freqs.cos() * scale) + (rotate_half(t) * freqs.sin() * scale)
     return torch.cat((t_left, t, t_right), dim = -1)
 
+def apply_rotary_emb_cached(cos, sin, t):
+    # `apply_rotary_emb` with the cos and sin tables of `RotaryEmbedding.get_cos_sin`, rotating the first features
+    rot_dim = cos.shape[-1]
+    t, t_right = t[..., :rot_dim], t[..., rot_dim:]
+    t = (t * cos) + (rotate_half(t) * sin)
+    return torch.cat((t, t_right), dim = -1)
+
+# fused rotation helpers
+# features are rotated as (x1, x2) pairs, (x1, x2) -> (x1 cos - x2 sin, x2 cos + x1 sin), and the tables of
+# `get_cos_sin` hold every angle twice, once per feature of its pair
+
+def rotate_complex(rotation, t, out = None):
+    # the pairs as complex numbers times the complex `rotation` table, one elementwise op without intermediate
+    # tensors, for float32 and float64 inputs without autograd
+    rot_dim = rotation.shape[-1] * 2
+    if not exists(out):
+        out = torch.empty_like(t)
+    pairs = torch.view_as_complex(t[..., :rot_dim].unflatten(-1, (-1, 2)))
+    torch.mul(pairs, rotation, out = torch.view_as_complex(out[..., :rot_dim].unflatten(-1, (-1, 2))))
+    out[..., rot_dim:] = t[..., rot_dim:]
+    return out
+
+def rotate_pairs_functional(cos, sin, t):
+    # out of place rotation, compiled into a single kernel by `torch.compile`
+    rot_dim = cos.shape[-1]
+    x1, x2 = t[..., :rot_dim].unflatten(-1, (-1, 2)).unbind(dim = -1)
+    cos, sin = cos[..., ::2], sin[..., ::2]
+    rotated = torch.stack((x1 * cos - x2 * sin, x2 * cos + x1 * sin), dim = -1).flatten(-2)
+    return torch.cat((rotated, t[..., rot_dim:]), dim = -1)
+
+def rotate_queries_and_keys_pairs(q_cos, q_sin, q, k_cos, k_sin, k):
+    return rotate_pairs_functional(q_cos, q_sin, q), rotate_pairs_functional(k_cos, k_sin, k)
+
+_compiled_rotations = {}
+
+def is_fused_rotary_available(device):
+    # `torch.compile` generates triton kernels on cuda
+    return device.type == 'cuda' and hasattr(torch, 'compile') and importlib.util.find_spec('triton') is not None
+
+def get_compiled_rotation(fn):
+    if fn not in _compiled_rotations:
+        _compiled_rotations[fn] = torch.compile(fn, dynamic = True)
+    return _compiled_rotations[fn]
+
 # learned rotation helpers
 
 def apply_learned_rotations(rotations, t, start_index = 0, freq_ranges = None):
@@ -78,7 +123,8 @@ class RotaryEmbedding(Module):
         xpos_scale_base = 512,
         interpolate_factor = 1.,
         theta_rescale_factor = 1.,
-        seq_before_head_dim = False
+        seq_before_head_dim = False,
+        compile_rotation = False
     ):
         super().__init__()
         # proposed by reddit user bloc97, to rescale rotary embeddings to longer sequence length without fine-tuning
@@ -98,9 +144,14 @@ class RotaryEmbedding(Module):
         elif freqs_for == 'constant':
             freqs = torch.ones(num_freqs).float()
 
-        self.tmp_store('cached_freqs', None)
         self.tmp_store('cached_scales', None)
 
+        # cos and sin tables of `get_cos_sin`, see there for the keys
+        self.cached_cos_sin = {}
+
+        # opt-in `torch.compile`d rotation on cuda, every new process pays the compilation on its first call
+        self.compile_rotation = compile_rotation
+
         self.freqs = nn.Parameter(freqs, requires_grad = learned_freq)
 
         self.learned_freq = learned_freq
@@ -140,13 +191,45 @@ class RotaryEmbedding(Module):
     def get_seq_pos(self, seq_len, device, dtype, offset = 0):
         return (torch.arange(seq_len, device = device, dtype = dtype) + offset) / self.interpolate_factor
 
-    def rotate_queries_or_keys(self, t, seq_dim = None, offset = 0, freq_seq_len = None, seq_pos = None):
+    def get_cos_sin(self, seq_len, device, dtype, offset = 0, pad_len = 0):
+        """
+        cos and sin of the rotation angles of `seq_len` positions starting at `offset`, of which the last
+        `pad_len` are at position 0 instead, as (seq_len, rot_dim) tables in `dtype`. The tables are computed
+        exactly like `apply_rotary_emb` does for (batch, seq, dim) inputs and cached by (seq_len, offset,
+        pad_len, device, dtype) and the dtype and version of `freqs`, so every temporal attention layer with
+        the same number of frames reuses them at every step.
+        """
+        key = (seq_len, offset, pad_len, device, dtype, self.freqs.dtype, self.freqs._version)
+        cached = self.cached_cos_sin.get(key)
+        if exists(cached):
+            return cached
+
+        seq_pos = self.get_seq_pos(seq_len - pad_len, device = device, dtype = dtype, offset = offset)
+        if pad_len > 0:
+            seq_pos = torch.cat((seq_pos, torch.zeros(pad_len, device = device, dtype = dtype)))
+        freqs = self.forward(seq_pos).to(dtype)
+        cos_sin = (freqs.cos(), freqs.sin())
+
+        if not self.learned_freq:
+            self.cached_cos_sin[key] = cos_sin
+        return cos_sin
+
+    def rotate_queries_or_keys(self, t, seq_dim = None, offset = 0, freq_seq_len = None, seq_pos = None, pad_len = 0):
         seq_dim = default(seq_dim, self.default_seq_dim)
 
         assert not self.use_xpos, 'you must use `.rotate_queries_and_keys` method instead and pass in both queries and keys, for length extrapolatable rotary embeddings'
 
         device, dtype, seq_len = t.device, t.dtype, t.shape[seq_dim]
 
+        if self.supports_cached_rotation(t, seq_dim) and not exists(freq_seq_len) and not exists(seq_pos):
+            # (batch, seq, dim) inputs, the common case of the attention processors, use the cached tables
+            return self.rotate_cached(t, offset = offset, pad_len = pad_len, seq_dim = seq_dim)
+
+        if pad_len > 0:
+            assert not exists(seq_pos)
+            seq_pos = self.get_seq_pos(seq_len - pad_len, device = device, dtype = dtype, offset = offset)
+            seq_pos = torch.cat((seq_pos, torch.zeros(pad_len, device = device, dtype = dtype)))
+
         if exists(freq_seq_len):
             assert freq_seq_len >= seq_len
             seq_len = freq_seq_len
@@ -163,6 +246,65 @@ class RotaryEmbedding(Module):
 
         return apply_rotary_emb(freqs, t, seq_dim = seq_dim)
 
+    def get_complex_rotation(self, seq_len, device, dtype, offset = 0, pad_len = 0):
+        # `get_cos_sin` as one complex table per pair of features, for `rotate_complex`
+        key = ('complex', seq_len, offset, pad_len, device, dtype, self.freqs.dtype, self.freqs._version)
+        cached = self.cached_cos_sin.get(key)
+        if exists(cached):
+            return cached
+
+        cos, sin = self.get_cos_sin(seq_len, device, dtype, offset = offset, pad_len = pad_len)
+        rotation = torch.complex(cos[..., ::2].contiguous(), sin[..., ::2].contiguous())
+
+        if not self.learned_freq:
+            self.cached_cos_sin[key] = rotation
+        return rotation
+
+    def supports_cached_rotation(self, t, seq_dim):
+        if seq_dim >= 0:
+            seq_dim -= t.ndim
+        supported_layout = (t.ndim == 3 and seq_dim == -2) or (t.ndim == 4 and seq_dim == -3)
+        return supported_layout and not self.learned_freq and not self.use_xpos
+
+    def use_compiled_rotation(self, device):
+        return self.compile_rotation and is_fused_rotary_available(device)
+
+    def rotate_cached(self, t, offset = 0, pad_len = 0, seq_dim = -2):
+        """
+        Rotates (batch, seq, dim) `t`, or (batch, seq, n, dim) `t` with `seq_dim = -3`, with the cached tables,
+        in a single pass over `t`: a compiled kernel on cuda with `compile_rotation`, otherwise a complex
+        multiplication for contiguous float32 and float64 inputs without gradients. Other inputs go through
+        `apply_rotary_emb_cached`.
+        """
+        device, dtype, seq_len = t.device, t.dtype, t.shape[seq_dim]
+        # the (seq_len, rot_dim) tables broadcast over the dimensions after the sequence
+        num_broadcast_dims = t.ndim - 2 - (seq_dim % t.ndim)
+        expand_tables = lambda *tables: tuple(table.view(seq_len, *(1,) * num_broadcast_dims, -1) for table in tables)
+        if self.use_compiled_rotation(device):
+            cos_sin = expand_tables(*self.get_cos_sin(seq_len, device, dtype, offset, pad_len))
+            return get_compiled_rotation(rotate_pairs_functional)(*cos_sin, t)
+        if dtype in (torch.float32, torch.float64) and t.is_contiguous() and not (torch.is_grad_enabled() and t.requires_grad):
+            rotation, = expand_tables(self.get_complex_rotation(seq_len, device, dtype, offset, pad_len))
+            return rotate_complex(rotation, t)
+        return apply_rotary_emb_cached(*expand_tables(*self.get_cos_sin(seq_len, device, dtype, offset, pad_len)), t)
+
+    def rotate_queries_and_keys_fused(self, q, k, key_pad_len = 0):
+        """
+        Rotates (batch, seq, dim) queries at positions 0 ... q_len - 1 and keys at positions 0 ... k_len -
+        key_pad_len - 1 followed by `key_pad_len` keys at position 0. On cuda with `compile_rotation` both are
+        rotated by one compiled function, otherwise each goes through `rotate_cached`.
+        """
+        if not (self.supports_cached_rotation(q, -2) and self.supports_cached_rotation(k, -2)):
+            return (
+                self.rotate_queries_or_keys(q, seq_dim = -2),
+                self.rotate_queries_or_keys(k, seq_dim = -2, pad_len = key_pad_len)
+            )
+        if self.use_compiled_rotation(q.device):
+            q_tables = self.get_cos_sin(q.shape[-2], q.device, q.dtype)
+            k_tables = self.get_cos_sin(k.shape[-2], k.device, k.dtype, pad_len = key_pad_len)
+            return get_compiled_rotation(rotate_queries_and_keys_pairs)(*q_tables, q, *k_tables, k)
+        return self.rotate_cached(q), self.rotate_cached(k, pad_len = key_pad_len)
+
     def rotate_queries_with_cached_keys(self, q, k, seq_dim = None, offset = 0):
         seq_dim = default(seq_dim, self.default_seq_dim)
 
@@ -256,25 +398,10 @@ class RotaryEmbedding(Module):
         seq_len = None,
         offset = 0
     ):
-        # should_cache = (
-        #     not self.learned_freq and \
-        #     exists(seq_len) and \
-        #     self.freqs_for != 'pixel'
-        # )
-
-        # if (
-        #     should_cache and \
-        #     exists(self.cached_freqs) and \
-        #     (offset + seq_len) <= self.cached_freqs.shape[0]
-        # ):
-        #     return self.cached_freqs[offset:(offset + seq_len)].detach()
-
+        # cos and sin of these are cached by `get_cos_sin`
         freqs = self.freqs
 
         freqs = einsum('..., f -> ... f', t.type(freqs.dtype), freqs)
         freqs = repeat(freqs, '... n -> ... (n r)', r = 2)
 
-        # if should_cache:
-        #     self.tmp_store('cached_freqs', freqs.detach())
-
         return freqs
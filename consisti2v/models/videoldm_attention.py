@@ -1,3 +1,4 @@
+from collections import OrderedDict
 from importlib import import_module
 from typing import Callable, Optional, Union
 import math
@@ -45,6 +46,74 @@ if is_xformers_available():
 else:
     xformers = None
 
+def get_tensor_key(tensor):
+    # identifies the contents of a tensor without reading them, for caches that hold a reference to the tensor
+    return (tensor.data_ptr(), tensor.shape, tensor.stride(), tensor.dtype, tensor.device, tensor._version)
+
+
+class TextKeyValueCache:
+    """
+    Keys and values one cross attention layer projected from text embeddings. The embeddings are the same at
+    every denoising step of a pipeline call, so each distinct embedding tensor is projected once. Entries are
+    looked up by the storage, layout and version counter of the embeddings and hold a reference to them, so
+    a freed tensor can not alias a new one allocated at the same address.
+    """
+
+    def __init__(self, max_entries=4):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+
+    def get(self, encoder_hidden_states, scale, project_fn):
+        key = get_tensor_key(encoder_hidden_states) + (scale,)
+        entry = self.entries.get(key)
+        if entry is None:
+            entry = (encoder_hidden_states, project_fn())
+            self.entries[key] = entry
+            if len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        else:
+            self.entries.move_to_end(key)
+        return entry[1]
+
+
+def project_text_key_value(attn, encoder_hidden_states, scale=1.0):
+    # keys and values of `encoder_hidden_states`, from the layer's cache if `cache_text_key_values` is active
+    def project():
+        return attn.to_k(encoder_hidden_states, scale=scale), attn.to_v(encoder_hidden_states, scale=scale)
+
+    if attn.text_kv_cache is None or torch.is_grad_enabled():
+        return project()
+    return attn.text_kv_cache.get(encoder_hidden_states, scale, project)
+
+
+def supports_attention_lse(query, key, value):
+    # the fused flash attention kernels return the log-sum-exp of the scores, but not its gradient
+    if torch.is_grad_enabled() and any(t.requires_grad for t in (query, key, value)):
+        return False
+    if query.device.type == "cpu":
+        return hasattr(torch.ops.aten, "_scaled_dot_product_flash_attention_for_cpu")
+    return (
+        query.device.type == "cuda"
+        and query.dtype in (torch.float16, torch.bfloat16)
+        and query.shape[-1] % 8 == 0
+        and query.shape[-1] <= 256
+        and torch.cuda.get_device_capability(query.device) >= (8, 0)
+        and torch.backends.cuda.flash_sdp_enabled()
+    )
+
+
+def scaled_dot_product_attention_with_lse(query, key, value):
+    """
+    `F.scaled_dot_product_attention` with the default scale that also returns the log-sum-exp over the keys of
+    the scores of every query, (..., q_len) in float32. Only for inputs accepted by `supports_attention_lse`.
+    """
+    if query.device.type == "cpu":
+        output, lse = torch.ops.aten._scaled_dot_product_flash_attention_for_cpu(query, key, value)
+    else:
+        output, lse = torch.ops.aten._scaled_dot_product_flash_attention(query, key, value)[:2]
+    return output, lse[..., :query.shape[-2]]
+
+
 @maybe_allow_in_graph
 class ConditionalAttention(nn.Module):
     r"""
@@ -176,6 +245,9 @@ class ConditionalAttention(nn.Module):
             )
         self.set_processor(processor)
 
+        # set by `VideoLDMUNet3DConditionModel.cache_text_key_values`
+        self.text_kv_cache = None
+
     def set_use_memory_efficient_attention_xformers(
         self, use_memory_efficient_attention_xformers: bool, attention_op: Optional[Callable] = None
     ):
@@ -424,7 +496,31 @@ class ConditionalAttention(nn.Module):
 
         return lora_processor
 
-    def forward(self, hidden_states, encoder_hidden_states=None, attention_mask=None, **cross_attention_kwargs):
+    def forward(
+        self,
+        hidden_states,
+        encoder_hidden_states=None,
+        attention_mask=None,
+        first_frame_hidden_states=None,
+        num_frames=None,
+        **cross_attention_kwargs,
+    ):
+        if first_frame_hidden_states is not None:
+            # self attention over every frame and the first frame of its video
+            assert encoder_hidden_states is None
+            if self._supports_attention_fast_path(attention_mask):
+                return self.first_frame_attention(
+                    hidden_states, first_frame_hidden_states, num_frames, **cross_attention_kwargs
+                )
+            first_frame_hidden_states = repeat(first_frame_hidden_states, 'b n c -> (b f) n c', f=num_frames)
+            encoder_hidden_states = torch.cat((hidden_states, first_frame_hidden_states), dim=1)
+        elif encoder_hidden_states is not None and encoder_hidden_states.shape[0] != hidden_states.shape[0]:
+            # cross attention to embeddings given once per video, shared by all of its frames
+            if self._supports_attention_fast_path(attention_mask):
+                return self.text_attention(hidden_states, encoder_hidden_states, **cross_attention_kwargs)
+            num_frames = hidden_states.shape[0] // encoder_hidden_states.shape[0]
+            encoder_hidden_states = encoder_hidden_states.repeat_interleave(num_frames, dim=0)
+
         # The `Attention` class can call different attention processors / attention functions
         # here we simply pass along all tensors to the selected processor class
         # For standard processors that are defined here, `**cross_attention_kwargs` is empty
@@ -436,6 +532,121 @@ class ConditionalAttention(nn.Module):
             **cross_attention_kwargs,
         )
 
+    def _supports_attention_fast_path(self, attention_mask):
+        # `first_frame_attention` and `text_attention` implement `AttnProcessor2_0` for plain attention, other
+        # processors (xformers, sliced, custom diffusion, ...) get repeated keys and values instead
+        return (
+            type(self.processor) is AttnProcessor2_0
+            and attention_mask is None
+            and self.spatial_norm is None
+            and self.group_norm is None
+            and self.norm_cross is None
+        )
+
+    def first_frame_attention(self, hidden_states, first_frame_hidden_states, num_frames, scale=1.0):
+        """
+        Self attention in which the keys and values of every frame are its own tokens followed by the tokens
+        of the first frame of its video, as when attending to `torch.cat((hidden_states, first frame repeated to
+        all frames), dim=1)`. The first frame's keys and values are projected once per video and the repeated
+        input is never built.
+
+        Where the fused kernels return the log-sum-exp of the scores (see `supports_attention_lse`, i.e. without
+        gradients), every frame attends to its own keys and values, all frames of a video attend together to its
+        first frame's keys and values, and the two outputs are merged with their log-sum-exps, so that the first
+        frame's keys and values are not copied to every frame. Otherwise the keys and values of every frame are
+        written to one (batch_size * num_frames, seq_len + first_frame_len) buffer for a single attention call.
+
+        Args:
+            hidden_states: (batch_size * num_frames, seq_len, dim)
+            first_frame_hidden_states: (batch_size, seq_len, dim)
+        """
+        residual = hidden_states
+        batch_size = first_frame_hidden_states.shape[0]
+        seq_len = hidden_states.shape[1]
+        first_frame_len = first_frame_hidden_states.shape[1]
+        head_dim = self.inner_dim // self.heads
+
+        query = self.to_q(hidden_states, scale=scale)
+        # the queries of every frame, (b * f, heads, seq_len, head_dim), and of every video, (b, heads, f * seq_len,
+        # head_dim), are views of the same projection
+        frame_query = query.view(batch_size * num_frames, seq_len, self.heads, head_dim).transpose(1, 2)
+        video_query = query.view(batch_size, num_frames * seq_len, self.heads, head_dim).transpose(1, 2)
+
+        if supports_attention_lse(frame_query, hidden_states, first_frame_hidden_states):
+            key = self.to_k(hidden_states, scale=scale).view(batch_size * num_frames, -1, self.heads, head_dim).transpose(1, 2)
+            value = self.to_v(hidden_states, scale=scale).view(batch_size * num_frames, -1, self.heads, head_dim).transpose(1, 2)
+            own_output, own_lse = scaled_dot_product_attention_with_lse(frame_query, key, value)
+            del key, value
+
+            key = self.to_k(first_frame_hidden_states, scale=scale).view(batch_size, -1, self.heads, head_dim).transpose(1, 2)
+            value = self.to_v(first_frame_hidden_states, scale=scale).view(batch_size, -1, self.heads, head_dim).transpose(1, 2)
+            first_frame_output, first_frame_lse = scaled_dot_product_attention_with_lse(video_query, key, value)
+
+            # both outputs and their (b, f, seq_len, heads, 1) softmax weights in the (b, f, seq_len, heads, head_dim) layout
+            own_output = own_output.transpose(1, 2).view(batch_size, num_frames, seq_len, self.heads, head_dim)
+            first_frame_output = first_frame_output.transpose(1, 2).view(batch_size, num_frames, seq_len, self.heads, head_dim)
+            own_lse = own_lse.view(batch_size, num_frames, self.heads, seq_len, 1).transpose(2, 3)
+            first_frame_lse = first_frame_lse.view(batch_size, self.heads, num_frames, seq_len, 1).permute(0, 2, 3, 1, 4)
+            own_weight = torch.sigmoid(own_lse - first_frame_lse)
+            hidden_states = own_output.mul_(own_weight.to(query.dtype))
+            hidden_states = hidden_states.addcmul_(first_frame_output, (1 - own_weight).to(query.dtype))
+        else:
+            # keys and values are written to one buffer, the first frame's projection is copied to every frame
+            key_value = hidden_states.new_empty(2, batch_size, num_frames, self.heads, seq_len + first_frame_len, head_dim)
+            for i, to_kv in enumerate((self.to_k, self.to_v)):
+                own = to_kv(hidden_states, scale=scale).view(batch_size, num_frames, seq_len, self.heads, head_dim)
+                first_frame = to_kv(first_frame_hidden_states, scale=scale).view(batch_size, 1, first_frame_len, self.heads, head_dim)
+                key_value[i, :, :, :, :seq_len] = own.transpose(2, 3)
+                key_value[i, :, :, :, seq_len:] = first_frame.transpose(2, 3)
+            key, value = key_value.flatten(1, 2).unbind(0)
+
+            hidden_states = F.scaled_dot_product_attention(frame_query, key, value, dropout_p=0.0, is_causal=False)
+            hidden_states = hidden_states.transpose(1, 2)
+        hidden_states = hidden_states.reshape(batch_size * num_frames, seq_len, self.heads * head_dim)
+        hidden_states = hidden_states.to(query.dtype)
+
+        hidden_states = self.to_out[0](hidden_states, scale=scale)
+        hidden_states = self.to_out[1](hidden_states)
+
+        if self.residual_connection:
+            hidden_states = hidden_states + residual
+        hidden_states = hidden_states / self.rescale_output_factor
+        return hidden_states
+
+    def text_attention(self, hidden_states, encoder_hidden_states, scale=1.0):
+        """
+        Cross attention of every frame to the embeddings of its video. Cross attention treats queries
+        independently, so the frames of a video are attended as one query sequence and the embeddings are
+        projected once per video (and once per pipeline call with `cache_text_key_values`) instead of being
+        repeated to every frame.
+
+        Args:
+            hidden_states: (batch_size * num_frames, seq_len, dim)
+            encoder_hidden_states: (batch_size, text_len, cross_attention_dim)
+        """
+        residual = hidden_states
+        batch_size = encoder_hidden_states.shape[0]
+        num_frames = hidden_states.shape[0] // batch_size
+        head_dim = self.inner_dim // self.heads
+
+        query = self.to_q(hidden_states, scale=scale)
+        query = query.view(batch_size, -1, self.heads, head_dim).transpose(1, 2)
+        key, value = project_text_key_value(self, encoder_hidden_states, scale=scale)
+        key = key.view(batch_size, -1, self.heads, head_dim).transpose(1, 2)
+        value = value.view(batch_size, -1, self.heads, head_dim).transpose(1, 2)
+
+        hidden_states = F.scaled_dot_product_attention(query, key, value, dropout_p=0.0, is_causal=False)
+        hidden_states = hidden_states.transpose(1, 2).reshape(batch_size * num_frames, -1, self.heads * head_dim)
+        hidden_states = hidden_states.to(query.dtype)
+
+        hidden_states = self.to_out[0](hidden_states, scale=scale)
+        hidden_states = self.to_out[1](hidden_states)
+
+        if self.residual_connection:
+            hidden_states = hidden_states + residual
+        hidden_states = hidden_states / self.rescale_output_factor
+        return hidden_states
+
     def batch_to_head_dim(self, tensor):
         head_size = self.heads
         batch_size, seq_len, dim = tensor.shape
@@ -563,40 +774,63 @@ class TemporalConditionalAttention(Attention):
         self.use_rotary_emb = rotary_emb
         self.n_frames = n_frames
 
+        # set by `VideoLDMUNet3DConditionModel.cache_text_key_values`
+        self.text_kv_cache = None
+
     def forward(
         self, 
         hidden_states, 
         encoder_hidden_states=None,
         attention_mask=None,
         adjacent_slices=None,
+        num_frames=None,
         **cross_attention_kwargs):
 
-        key_pos_idx = None
+        key_pad_len = 0
+        num_frames = num_frames or self.n_frames
 
         bt, hw, c = hidden_states.shape
-        hidden_states = rearrange(hidden_states, '(b t) hw c -> b hw t c', t=self.n_frames)
+        batch_size = bt // num_frames
         if not self.use_rotary_emb:
-            pos_embed = self.pos_enc(self.n_frames)
-            hidden_states = hidden_states + pos_embed
-        hidden_states = rearrange(hidden_states, 'b hw t c -> (b hw) t c')
+            pos_embed = self.pos_enc(num_frames)
 
         if encoder_hidden_states is not None:
             assert adjacent_slices is None
-            encoder_hidden_states = encoder_hidden_states[::self.n_frames]
-            encoder_hidden_states = repeat(encoder_hidden_states, 'b n c -> (b hw) n c', hw=hw)
+            if encoder_hidden_states.shape[0] == bt:
+                # embeddings repeated to every frame
+                encoder_hidden_states = encoder_hidden_states[::num_frames]
+            if self._supports_text_attention(attention_mask, num_frames, encoder_hidden_states.shape[1]):
+                # the queries of a video are contiguous in the (b t, hw, c) layout, no rearrange is needed
+                if not self.use_rotary_emb:
+                    hidden_states = hidden_states.view(batch_size, num_frames, hw, c) + pos_embed[:, None]
+                    hidden_states = hidden_states.view(bt, hw, c)
+                return self.text_attention(hidden_states, encoder_hidden_states, num_frames=num_frames, **cross_attention_kwargs)
+            encoder_hidden_states = repeat(encoder_hidden_states, 'b n c -> (hw b) n c', hw=hw)
+
+        # The frames of every position are gathered once into a (hw, b, t, c) layout. It is the (hw b, t, c) batch
+        # of sequences of the attention, and its (hw, b t, c) view transposed is the (b t, hw, c) layout of the
+        # spatial layers, so the output is returned as a strided view instead of being copied back.
+        hidden_states = rearrange(hidden_states, '(b t) hw c -> hw b t c', t=num_frames)
+        if not self.use_rotary_emb:
+            hidden_states = hidden_states + pos_embed
+        hidden_states = hidden_states.reshape(hw * batch_size, num_frames, c)
+        if attention_mask is not None and attention_mask.shape[0] == batch_size * hw:
+            attention_mask = rearrange(attention_mask, '(b hw) ... -> (hw b) ...', hw=hw)
 
         if adjacent_slices is not None:
             assert encoder_hidden_states is None
-            adjacent_slices = rearrange(adjacent_slices, 'b c h w n -> b (h w) n c')
+            # (b, h * w, 8, c) neighbors of every position in the first frame
             if not self.use_rotary_emb:
                 first_frame_pos_embed = pos_embed[0:1, :]
                 adjacent_slices = adjacent_slices + first_frame_pos_embed
             else:
-                pos_idx = torch.arange(self.n_frames, device=hidden_states.device, dtype=hidden_states.dtype)
-                first_frame_pos_pad = torch.zeros(adjacent_slices.shape[2], device=hidden_states.device, dtype=hidden_states.dtype)
-                key_pos_idx = torch.cat([pos_idx, first_frame_pos_pad], dim=0)
-            adjacent_slices = rearrange(adjacent_slices, 'b hw n c -> (b hw) n c')
-            encoder_hidden_states = torch.cat([hidden_states, adjacent_slices], dim=1)
+                # the neighbors are keys at position 0, after the frames
+                key_pad_len = adjacent_slices.shape[2]
+            # concatenated in the (hw, b, t, c) layout, without gathering the neighbors first
+            encoder_hidden_states = torch.cat(
+                [hidden_states.view(hw, batch_size, num_frames, c), adjacent_slices.transpose(0, 1)], dim=2
+            )
+            encoder_hidden_states = encoder_hidden_states.view(hw * batch_size, -1, c)
 
         if not self.use_rotary_emb:
             out = self.processor(
@@ -612,14 +846,66 @@ class TemporalConditionalAttention(Attention):
                 hidden_states,
                 encoder_hidden_states=encoder_hidden_states,
                 attention_mask=attention_mask,
-                key_pos_idx=key_pos_idx,
+                key_pad_len=key_pad_len,
                 **cross_attention_kwargs,
             )
 
-        out = rearrange(out, '(b hw) t c -> (b t) hw c', hw=hw)
+        # (b t, hw, c) view of the (hw b, t, c) output, callers add it to a contiguous tensor (e.g. the residual)
+        out = out.reshape(hw, bt, c).transpose(0, 1)
 
         return out
 
+    def _supports_text_attention(self, attention_mask, num_frames, text_len):
+        # `text_attention` implements `AttnProcessor2_0` and `RotaryEmbAttnProcessor2_0`, the latter also rotates
+        # the keys when there are as many frames as text tokens
+        if type(self.processor) is RotaryEmbAttnProcessor2_0:
+            supported_processor = num_frames != text_len
+        else:
+            supported_processor = type(self.processor) is AttnProcessor2_0
+        return (
+            supported_processor
+            and attention_mask is None
+            and self.spatial_norm is None
+            and self.group_norm is None
+            and self.norm_cross is None
+        )
+
+    def text_attention(self, hidden_states, encoder_hidden_states, num_frames, scale=1.0):
+        """
+        Cross attention of every spatial position to the embeddings of its video. The positions of a video
+        are attended as one query sequence, so the embeddings are projected once per video (and once per
+        pipeline call with `cache_text_key_values`) instead of once per position.
+
+        Args:
+            hidden_states: (batch_size * num_frames, height * width, dim)
+            encoder_hidden_states: (batch_size, text_len, cross_attention_dim)
+        """
+        residual = hidden_states
+        batch_size = encoder_hidden_states.shape[0]
+        head_dim = self.inner_dim // self.heads
+
+        query = self.to_q(hidden_states, scale=scale)
+        if type(self.processor) is RotaryEmbAttnProcessor2_0:
+            # frame positions are rotated before the positions of a video are merged into one sequence
+            query = query.view(batch_size, num_frames, -1, self.inner_dim)
+            query = self.rotary_emb.rotate_queries_or_keys(query, seq_dim=-3)
+        query = query.reshape(batch_size, -1, self.heads, head_dim).transpose(1, 2)
+        key, value = project_text_key_value(self, encoder_hidden_states, scale=scale)
+        key = key.view(batch_size, -1, self.heads, head_dim).transpose(1, 2)
+        value = value.view(batch_size, -1, self.heads, head_dim).transpose(1, 2)
+
+        out = F.scaled_dot_product_attention(query, key, value, dropout_p=0.0, is_causal=False)
+        out = out.transpose(1, 2).reshape(hidden_states.shape[0], -1, self.heads * head_dim)
+        out = out.to(query.dtype)
+
+        out = self.to_out[0](out, scale=scale)
+        out = self.to_out[1](out)
+
+        if self.residual_connection:
+            out = out + residual
+        out = out / self.rescale_output_factor
+        return out
+
     def set_use_memory_efficient_attention_xformers(self, use_memory_efficient_attention_xformers, attention_op=None):
         if use_memory_efficient_attention_xformers:
             try:
@@ -727,6 +1013,7 @@ class RotaryEmbAttnProcessor2_0:
         temb=None,
         scale: float = 1.0,
         key_pos_idx: Optional[torch.Tensor] = None,
+        key_pad_len: int = 0,
     ):
         assert attention_mask is None
         residual = hidden_states
@@ -770,11 +1057,13 @@ class RotaryEmbAttnProcessor2_0:
         key = attn.to_k(encoder_hidden_states, scale=scale)
         value = attn.to_v(encoder_hidden_states, scale=scale)
 
-        query = attn.rotary_emb.rotate_queries_or_keys(query)
-        if qlen == klen:
-            key = attn.rotary_emb.rotate_queries_or_keys(key)
-        elif key_pos_idx is not None:
-            key = attn.rotary_emb.rotate_queries_or_keys(key, seq_pos=key_pos_idx)
+        if qlen == klen or (key_pos_idx is None and key_pad_len > 0):
+            # the last `key_pad_len` keys are at position 0, queries and keys are rotated in one pass
+            query, key = attn.rotary_emb.rotate_queries_and_keys_fused(query, key, key_pad_len=key_pad_len)
+        else:
+            query = attn.rotary_emb.rotate_queries_or_keys(query)
+            if key_pos_idx is not None:
+                key = attn.rotary_emb.rotate_queries_or_keys(key, seq_pos=key_pos_idx)
 
         inner_dim = key.shape[-1]
         head_dim = inner_dim // attn.heads
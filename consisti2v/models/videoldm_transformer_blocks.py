@@ -1,5 +1,6 @@
 # Modified from https://github.com/huggingface/diffusers/blob/v0.21.0/src/diffusers/models/transformer_2d.py
 from dataclasses import dataclass
+from functools import lru_cache
 from typing import Any, Dict, Optional
 
 import torch
@@ -190,6 +191,7 @@ class Transformer2DConditionModel(ModelMixin, ConfigMixin):
         encoder_attention_mask: Optional[torch.Tensor] = None,
         return_dict: bool = True,
         condition_on_first_frame: bool = False,
+        num_frames: Optional[int] = None,
     ):
         input_states = hidden_states
         input_height, input_width = hidden_states.shape[-2:]
@@ -251,6 +253,10 @@ class Transformer2DConditionModel(ModelMixin, ConfigMixin):
                     timestep,
                     cross_attention_kwargs,
                     class_labels,
+                    condition_on_first_frame,
+                    input_height,
+                    input_width,
+                    num_frames,
                     use_reentrant=False,
                 )
             else:
@@ -266,6 +272,7 @@ class Transformer2DConditionModel(ModelMixin, ConfigMixin):
                     condition_on_first_frame=condition_on_first_frame,
                     input_height=input_height,
                     input_width=input_width,
+                    num_frames=num_frames,
                 )
 
         # 3. Output
@@ -317,9 +324,31 @@ class Transformer2DConditionModel(ModelMixin, ConfigMixin):
         return Transformer2DModelOutput(sample=output)
 
 
+@lru_cache(maxsize=32)
+def get_neighbor_index(height, width, device):
+    """
+    Flat indices of the 8 neighbors of every position of a height x width grid, with replicate padding at
+    the borders, in row-major order of the 3 x 3 window without its center. Shape (height * width * 8,).
+    """
+    rows = torch.arange(height, device=device)
+    cols = torch.arange(width, device=device)
+    offsets = [(dy, dx) for dy in (-1, 0, 1) for dx in (-1, 0, 1) if (dy, dx) != (0, 0)]
+    neighbor_rows = torch.stack([(rows + dy).clamp(0, height - 1) for dy, _ in offsets], dim=-1)  # (h, 8)
+    neighbor_cols = torch.stack([(cols + dx).clamp(0, width - 1) for _, dx in offsets], dim=-1)  # (w, 8)
+    neighbor_index = neighbor_rows[:, None, :] * width + neighbor_cols[None, :, :]  # (h, w, 8)
+    return neighbor_index.reshape(-1)
+
+
 @maybe_allow_in_graph
 class BasicConditionalTransformerBlock(nn.Module):
-    """ transformer block with first frame conditioning """
+    """
+    transformer block with first frame conditioning
+
+    With `condition_on_first_frame`, the spatial self attention attends to every frame and the first frame of its
+    video with `ConditionalAttention.first_frame_attention`, which projects the first frame once per video. That
+    path only runs with the default `AttnProcessor2_0` and no attention mask. Other processors (xformers, sliced,
+    LoRA, custom diffusion) get the first frame repeated and concatenated to every frame, as before.
+    """
     def __init__(
         self,
         dim: int,
@@ -457,7 +486,12 @@ class BasicConditionalTransformerBlock(nn.Module):
         condition_on_first_frame: bool = False,
         input_height: Optional[int] = None,
         input_width: Optional[int] = None,
+        num_frames: Optional[int] = None,
     ):
+        num_frames = num_frames or self.n_frames
+        # the number of frames is only needed by the temporal attention layers
+        temporal_kwargs = {"num_frames": num_frames} if self.is_temporal else {}
+
         # Notice that normalization is always applied before the real computation in the following blocks.
         # 0. Self-Attention
         if self.use_ada_layer_norm:
@@ -476,9 +510,19 @@ class BasicConditionalTransformerBlock(nn.Module):
         cross_attention_kwargs = cross_attention_kwargs.copy() if cross_attention_kwargs is not None else {}
         gligen_kwargs = cross_attention_kwargs.pop("gligen", None)
 
-        if condition_on_first_frame:
-            first_frame_hidden_states = rearrange(norm_hidden_states, '(b f) d h -> b f d h', f=self.n_frames)[:, 0, :, :]
-            first_frame_hidden_states = repeat(first_frame_hidden_states, 'b d h -> b f d h', f=self.n_frames)
+        if condition_on_first_frame and not self.is_temporal and not self.only_cross_attention:
+            # every frame also attends to the first frame, whose keys and values are projected once per video
+            first_frame_hidden_states = rearrange(norm_hidden_states, '(b f) d h -> b f d h', f=num_frames)[:, 0, :, :]
+            attn_output = self.attn1(
+                norm_hidden_states,
+                attention_mask=attention_mask,
+                first_frame_hidden_states=first_frame_hidden_states,
+                num_frames=num_frames,
+                **cross_attention_kwargs,
+            )
+        elif condition_on_first_frame:
+            first_frame_hidden_states = rearrange(norm_hidden_states, '(b f) d h -> b f d h', f=num_frames)[:, 0, :, :]
+            first_frame_hidden_states = repeat(first_frame_hidden_states, 'b d h -> b f d h', f=num_frames)
             first_frame_hidden_states = rearrange(first_frame_hidden_states, 'b f d h -> (b f) d h')
             first_frame_concat_hidden_states = torch.cat((norm_hidden_states, first_frame_hidden_states), dim=1)
             attn_output = self.attn1(
@@ -488,18 +532,17 @@ class BasicConditionalTransformerBlock(nn.Module):
                 **cross_attention_kwargs,
             )
         elif self.is_temporal and self.augment_temporal_attention:
-            first_frame_hidden_states = rearrange(norm_hidden_states, '(b f) d h -> b f d h', f=self.n_frames)[:, 0, :, :]
-            first_frame_hidden_states = rearrange(first_frame_hidden_states, 'b (h w) c -> b h w c', h=input_height, w=input_width)
-            first_frame_hidden_states = first_frame_hidden_states.permute(0, 3, 1, 2)
-            padded_first_frame = torch.nn.functional.pad(first_frame_hidden_states, (1, 1, 1, 1), "replicate")
-            first_frame_windows = padded_first_frame.unfold(2, 3, 1).unfold(3, 3, 1)
-            mask = torch.tensor([[1, 1, 1], [1, 0, 1], [1, 1, 1]], dtype=torch.bool)
-            adjacent_slices = first_frame_windows[:, :, :, :, mask]
+            # the 8 neighbors of every position in the first frame, (b, h * w, 8, c)
+            first_frame_hidden_states = rearrange(norm_hidden_states, '(b f) d h -> b f d h', f=num_frames)[:, 0, :, :]
+            neighbor_index = get_neighbor_index(input_height, input_width, first_frame_hidden_states.device)
+            adjacent_slices = first_frame_hidden_states.index_select(1, neighbor_index)
+            adjacent_slices = adjacent_slices.view(adjacent_slices.shape[0], input_height * input_width, 8, adjacent_slices.shape[-1])
             attn_output = self.attn1(
                 norm_hidden_states,
                 encoder_hidden_states=encoder_hidden_states if self.only_cross_attention else None,
                 attention_mask=attention_mask,
                 adjacent_slices=adjacent_slices,
+                **temporal_kwargs,
                 **cross_attention_kwargs,
             )
         else:
@@ -507,11 +550,14 @@ class BasicConditionalTransformerBlock(nn.Module):
                 norm_hidden_states,
                 encoder_hidden_states=encoder_hidden_states if self.only_cross_attention else None,
                 attention_mask=attention_mask,
+                **temporal_kwargs,
                 **cross_attention_kwargs,
             )
         if self.use_ada_layer_norm_zero:
             attn_output = gate_msa.unsqueeze(1) * attn_output
-        hidden_states = attn_output + hidden_states
+        # the residual comes first so that the sum keeps its contiguous layout, the temporal attention returns a
+        # strided view
+        hidden_states = hidden_states + attn_output
 
         # 2.5 GLIGEN Control
         if gligen_kwargs is not None:
@@ -528,9 +574,10 @@ class BasicConditionalTransformerBlock(nn.Module):
                 norm_hidden_states,
                 encoder_hidden_states=encoder_hidden_states,
                 attention_mask=encoder_attention_mask,
+                **temporal_kwargs,
                 **cross_attention_kwargs,
             )
-            hidden_states = attn_output + hidden_states
+            hidden_states = hidden_states + attn_output
 
         # 4. Feed-forward
         norm_hidden_states = self.norm3(hidden_states)
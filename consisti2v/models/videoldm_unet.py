@@ -1,5 +1,6 @@
 import os
 import re
+from contextlib import contextmanager
 from typing import Optional, Tuple, Union, Dict, List, Any
 from einops import rearrange, repeat
 
@@ -60,7 +61,9 @@ if is_accelerate_available():
 
 
 
-from .videoldm_unet_blocks import get_down_block, get_up_block, VideoLDMUNetMidBlock2DCrossAttn
+from .videoldm_unet_blocks import get_down_block, get_up_block, VideoLDMUNetMidBlock2DCrossAttn, FirstFrameFeatureCache, Conv3DLayer, get_conv_macs
+from .videoldm_attention import TextKeyValueCache
+from .rotary_embedding import RotaryEmbedding
 
 logger = logging.get_logger(__name__)
 
@@ -203,6 +206,8 @@ class VideoLDMUNet3DConditionModel(ModelMixin, ConfigMixin, UNet2DConditionLoade
         self.conv_in = nn.Conv2d(
             in_channels, block_out_channels[0], kernel_size=conv_in_kernel, padding=conv_in_padding
         )
+        # set by `cache_first_frame_features`
+        self.first_frame_cache = None
 
         # time
         if time_embedding_type == "fourier":
@@ -417,6 +422,10 @@ class VideoLDMUNet3DConditionModel(ModelMixin, ConfigMixin, UNet2DConditionLoade
             )
             self.down_blocks.append(down_block)
 
+        # the first down block gets the `conv_in` output, whose frame 0 is computed from the first frame latents alone
+        if first_frame_condition_mode != "none":
+            self.down_blocks[0].static_first_frame_input = True
+
         # mid
         if mid_block_type == "UNetMidBlock2DCrossAttn":
             self.mid_block = VideoLDMUNetMidBlock2DCrossAttn(
@@ -684,6 +693,63 @@ class VideoLDMUNet3DConditionModel(ModelMixin, ConfigMixin, UNet2DConditionLoade
         if hasattr(module, "gradient_checkpointing"):
             module.gradient_checkpointing = value
 
+    def set_temporal_conv_matmul(self, enabled=True):
+        """
+        Runs the (3, 1, 1) convolutions of the temporal resnets as shifted matmuls on the (b t) layout
+        (`temporal_conv_matmul`) instead of `nn.Conv3d` on rearranged copies of the activations. The weights
+        are unchanged, the outputs equal the default up to floating point rounding. Fastest with channels_last
+        activations, e.g. with the `nn.Conv2d` layers converted to channels_last.
+        """
+        for module in self.modules():
+            if isinstance(module, Conv3DLayer):
+                module.use_matmul = enabled
+
+    def set_rotary_compilation(self, enabled=True):
+        """
+        Rotates the queries and keys of the temporal attention layers with `torch.compile`d kernels on cuda (see
+        `RotaryEmbedding.rotate_cached`). Off by default, the compilation runs on the first call of every process.
+        """
+        for module in self.modules():
+            if isinstance(module, RotaryEmbedding):
+                module.compile_rotation = enabled
+
+    @contextmanager
+    def cache_text_key_values(self):
+        """
+        Within this context, every cross attention layer caches the keys and values it projects from
+        `encoder_hidden_states`, so a prompt is projected once instead of at every denoising step. The
+        caches are dropped when the context exits. Gradient enabled calls (training) are never cached.
+        """
+        modules = [module for module in self.modules() if hasattr(module, "text_kv_cache")]
+        for module in modules:
+            module.text_kv_cache = TextKeyValueCache()
+        try:
+            yield
+        finally:
+            for module in modules:
+                module.text_kv_cache = None
+
+    @contextmanager
+    def cache_first_frame_features(self, enabled=True):
+        """
+        Within this context, features that only depend on `first_frame_latents` (see `FirstFrameFeatureCache`)
+        are computed once per first frame tensor instead of at every denoising step. Yields the cache, whose
+        `get_stats()` reports the hits and the multiply-accumulates they saved, or None when not `enabled`.
+        Gradient enabled calls (training) are never cached.
+        """
+        if not enabled:
+            yield None
+            return
+        cache = FirstFrameFeatureCache()
+        modules = [module for module in self.modules() if hasattr(module, "first_frame_cache")]
+        for module in modules:
+            module.first_frame_cache = cache
+        try:
+            yield cache
+        finally:
+            for module in modules:
+                module.first_frame_cache = None
+
     def forward(
         self,
         sample: torch.FloatTensor,
@@ -713,10 +779,7 @@ class VideoLDMUNet3DConditionModel(ModelMixin, ConfigMixin, UNet2DConditionLoade
             sample = torch.cat([first_frame_latents, sample], dim=2)
             video_length += 1
         
-        # copy conditioning embeddings for cross attention
-        if encoder_hidden_states is not None:
-            encoder_hidden_states = repeat(encoder_hidden_states, 'b n c -> (b f) n c', f=video_length)
-        
+        # conditioning embeddings stay one row per video, cross attention broadcasts them over the frames
         sample = rearrange(sample, "b c f h w -> (b f) c h w")
 
         # By default samples have to be AT least a multiple of the overall upsampling factor.
@@ -831,7 +894,7 @@ class VideoLDMUNet3DConditionModel(ModelMixin, ConfigMixin, UNet2DConditionLoade
                 emb = emb + class_emb
 
         if self.config.addition_embed_type == "text":
-            aug_emb = self.add_embedding(encoder_hidden_states)
+            aug_emb = self.add_embedding(repeat(encoder_hidden_states, 'b n c -> (b f) n c', f=video_length))
         elif self.config.addition_embed_type == "text_image":
             # Kandinsky 2.1 - style
             if "image_embeds" not in added_cond_kwargs:
@@ -840,7 +903,7 @@ class VideoLDMUNet3DConditionModel(ModelMixin, ConfigMixin, UNet2DConditionLoade
                 )
 
             image_embs = added_cond_kwargs.get("image_embeds")
-            text_embs = added_cond_kwargs.get("text_embeds", encoder_hidden_states)
+            text_embs = added_cond_kwargs.get("text_embeds", repeat(encoder_hidden_states, 'b n c -> (b f) n c', f=video_length))
             aug_emb = self.add_embedding(text_embs, image_embs)
         elif self.config.addition_embed_type == "text_time":
             # SDXL - style
@@ -904,7 +967,18 @@ class VideoLDMUNet3DConditionModel(ModelMixin, ConfigMixin, UNet2DConditionLoade
             image_embeds = added_cond_kwargs.get("image_embeds")
             encoder_hidden_states = self.encoder_hid_proj(image_embeds)
         # 2. pre-process
-        sample = self.conv_in(sample)
+        if self.first_frame_cache is not None and self.config.first_frame_condition_mode != "none" and not torch.is_grad_enabled():
+            # the first frame is the same at every step, only the noisy frames go through `conv_in`
+            sample = rearrange(sample, "(b f) c h w -> b f c h w", f=video_length)
+            def first_frame_conv_in():
+                first_frame_sample = self.conv_in(sample[:, 0])
+                return first_frame_sample, get_conv_macs(self.conv_in, first_frame_sample)
+
+            first_frame_sample = self.first_frame_cache.get(self.conv_in, first_frame_latents, first_frame_conv_in)
+            noisy_sample = self.conv_in(sample[:, 1:].flatten(0, 1)).unflatten(0, (sample.shape[0], video_length - 1))
+            sample = torch.cat([first_frame_sample.unsqueeze(1), noisy_sample], dim=1).flatten(0, 1)
+        else:
+            sample = self.conv_in(sample)
 
         # 2.5 GLIGEN position net
         if cross_attention_kwargs is not None and cross_attention_kwargs.get("gligen", None) is not None:
@@ -934,10 +1008,11 @@ class VideoLDMUNet3DConditionModel(ModelMixin, ConfigMixin, UNet2DConditionLoade
                     cross_attention_kwargs=cross_attention_kwargs,
                     encoder_attention_mask=encoder_attention_mask,
                     first_frame_latents=first_frame_latents,
+                    num_frames=video_length,
                     **additional_residuals,
                 )
             else:
-                sample, res_samples = downsample_block(hidden_states=sample, temb=emb, scale=lora_scale, first_frame_latents=first_frame_latents,)
+                sample, res_samples = downsample_block(hidden_states=sample, temb=emb, scale=lora_scale, first_frame_latents=first_frame_latents, num_frames=video_length)
 
                 if is_adapter and len(down_block_additional_residuals) > 0:
                     sample += down_block_additional_residuals.pop(0)
@@ -966,6 +1041,7 @@ class VideoLDMUNet3DConditionModel(ModelMixin, ConfigMixin, UNet2DConditionLoade
                 encoder_attention_mask=encoder_attention_mask,
                 # additional
                 first_frame_latents=first_frame_latents,
+                num_frames=video_length,
             )
             # To support T2I-Adapter-XL
             if (
@@ -1001,6 +1077,7 @@ class VideoLDMUNet3DConditionModel(ModelMixin, ConfigMixin, UNet2DConditionLoade
                     attention_mask=attention_mask,
                     encoder_attention_mask=encoder_attention_mask,
                     first_frame_latents=first_frame_latents,
+                    num_frames=video_length,
                 )
             else:
                 sample = upsample_block(
@@ -1010,6 +1087,7 @@ class VideoLDMUNet3DConditionModel(ModelMixin, ConfigMixin, UNet2DConditionLoade
                     upsample_size=upsample_size,
                     scale=lora_scale,
                     first_frame_latents=first_frame_latents,
+                    num_frames=video_length,
                 )
 
         # 6. post-process
@@ -1,10 +1,10 @@
+from collections import OrderedDict
 from typing import Optional, Dict, Tuple, Any
 
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from einops import rearrange, repeat
-from einops.layers.torch import Rearrange
 from diffusers.utils import logging
 from diffusers.models.unet_2d_blocks import (
     DownBlock2D,
@@ -21,6 +21,7 @@ from diffusers.models.activations import get_activation
 from diffusers.utils import logging, is_torch_version
 from diffusers.utils.import_utils import is_xformers_available
 from .videoldm_transformer_blocks import Transformer2DConditionModel
+from .videoldm_attention import get_tensor_key
 
 logger = logging.get_logger(__name__)
 
@@ -31,6 +32,142 @@ else:
     xformers = None
 
 
+class FirstFrameFeatureCache:
+    """
+    Features computed from the first frame latents alone, which are the same at every denoising step:
+
+    - the `conv_in` output of the first frame
+    - the `first_frame_conv` projections of the "conv2d" condition mode
+    - the first frame's `norm1` -> `conv1` and `conv_shortcut` outputs in the first resnet of every block whose
+      first frame input only depends on the first frame latents (see `run_first_resnet`): the first down block,
+      and with the "conv2d" condition mode every down block and the mid block. The rest of these resnets adds
+      the timestep embedding and runs at every step.
+
+    Everything after the first resnet of a block mixes the first frame with the noisy frames (temporal
+    convolutions and attention), and the inputs of the up blocks include skip connections from such
+    layers, so those features change at every step and are recomputed.
+
+    Entries are looked up by module and by the storage, layout and version counter of the latents. Every hit
+    adds the multiply-accumulates of the skipped convolutions to `saved_macs`.
+    """
+
+    def __init__(self, max_entries=64):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.saved_macs = 0
+
+    def get(self, module, first_frame_latents, compute_fn):
+        # `compute_fn` returns the features and the multiply-accumulates they take
+        key = (id(module),) + get_tensor_key(first_frame_latents)
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            entry = (first_frame_latents,) + tuple(compute_fn())
+            self.entries[key] = entry
+            if len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        else:
+            self.hits += 1
+            self.saved_macs += entry[2]
+            self.entries.move_to_end(key)
+        return entry[1]
+
+    def get_stats(self):
+        return {"hits": self.hits, "misses": self.misses, "saved_gmacs": self.saved_macs / 1e9}
+
+
+def get_conv_macs(conv, output):
+    kernel_numel = 1
+    for kernel_size in conv.kernel_size:
+        kernel_numel *= kernel_size
+    return output.numel() * (conv.in_channels // conv.groups) * kernel_numel
+
+
+def project_first_frame_latents(block, first_frame_latents, hidden_height):
+    # (b, c, 1, h, w) first frame latents resized to the block's resolution and projected to its channels
+    def project():
+        downsample_ratio = hidden_height / first_frame_latents.shape[3]
+        latents = F.interpolate(first_frame_latents.squeeze(2), scale_factor=downsample_ratio, mode="nearest")
+        return block.first_frame_conv(latents).unsqueeze(2)
+
+    def project_with_macs():
+        projection = project()
+        return projection, get_conv_macs(block.first_frame_conv, projection)
+
+    if block.first_frame_cache is None or torch.is_grad_enabled():
+        return project()
+    return block.first_frame_cache.get(block.first_frame_conv, first_frame_latents, project_with_macs)
+
+
+def run_first_resnet(block, resnet, hidden_states, temb, first_frame_latents, num_frames, scale=1.0):
+    """
+    `resnet(hidden_states, temb)` for the first resnet of a block. When the block's first frame input only
+    depends on the first frame latents (`static_first_frame_input`) and a `FirstFrameFeatureCache` is active,
+    the first frame's `norm1` -> `conv1` and `conv_shortcut` outputs, which come before the timestep embedding,
+    are taken from the cache and only computed for the noisy frames. The timestep embedding, `norm2` and
+    `conv2` run on all frames as in `ResnetBlock2D.forward`.
+    """
+    if (
+        block.first_frame_cache is None
+        or not block.static_first_frame_input
+        or first_frame_latents is None
+        or torch.is_grad_enabled()
+        or resnet.upsample is not None
+        or resnet.downsample is not None
+        or resnet.time_embedding_norm not in ("default", "scale_shift")
+    ):
+        return resnet(hidden_states, temb, scale=scale)
+
+    input_tensor = hidden_states.unflatten(0, (-1, num_frames))
+    noisy_frames = input_tensor[:, 1:].flatten(0, 1)
+
+    def first_frame_features():
+        first_frame = input_tensor[:, 0]
+        conv1_output = resnet.conv1(resnet.nonlinearity(resnet.norm1(first_frame)), scale)
+        macs = get_conv_macs(resnet.conv1, conv1_output)
+        shortcut = None
+        if resnet.conv_shortcut is not None:
+            shortcut = resnet.conv_shortcut(first_frame, scale)
+            macs += get_conv_macs(resnet.conv_shortcut, shortcut)
+        return (conv1_output, shortcut), macs
+
+    first_frame_conv1, first_frame_shortcut = block.first_frame_cache.get(resnet, first_frame_latents, first_frame_features)
+
+    def with_first_frame(first_frame, noisy_frames):
+        return torch.cat([first_frame.unsqueeze(1), noisy_frames.unflatten(0, (-1, num_frames - 1))], dim=1).flatten(0, 1)
+
+    hidden_states = resnet.conv1(resnet.nonlinearity(resnet.norm1(noisy_frames)), scale)
+    hidden_states = with_first_frame(first_frame_conv1, hidden_states)
+
+    if resnet.time_emb_proj is not None:
+        if not resnet.skip_time_act:
+            temb = resnet.nonlinearity(temb)
+        temb = resnet.time_emb_proj(temb, scale)[:, :, None, None]
+
+    if temb is not None and resnet.time_embedding_norm == "default":
+        hidden_states = hidden_states + temb
+
+    hidden_states = resnet.norm2(hidden_states)
+
+    if temb is not None and resnet.time_embedding_norm == "scale_shift":
+        time_scale, time_shift = torch.chunk(temb, 2, dim=1)
+        hidden_states = hidden_states * (1 + time_scale) + time_shift
+
+    hidden_states = resnet.nonlinearity(hidden_states)
+
+    hidden_states = resnet.dropout(hidden_states)
+    hidden_states = resnet.conv2(hidden_states, scale)
+
+    if resnet.conv_shortcut is not None:
+        shortcut = with_first_frame(first_frame_shortcut, resnet.conv_shortcut(noisy_frames, scale))
+    else:
+        shortcut = input_tensor.flatten(0, 1)
+
+    return (shortcut + hidden_states) / resnet.output_scale_factor
+
+
 def get_down_block(
     down_block_type,
     num_layers,
@@ -277,13 +414,13 @@ class TemporalResnetBlock(nn.Module):
 
         self.alpha = nn.Parameter(torch.ones(1))
 
-    def forward(self, input_tensor, temb=None):
+    def forward(self, input_tensor, temb=None, num_frames=None):
         hidden_states = input_tensor
 
         hidden_states = self.norm1(hidden_states)
         hidden_states = self.nonlinearity(hidden_states)
 
-        hidden_states = self.conv1(hidden_states)
+        hidden_states = self.conv1(hidden_states, num_frames=num_frames)
 
         if temb is not None:
             temb = self.time_emb_proj(self.nonlinearity(temb))[:, :, None, None, None]
@@ -300,7 +437,7 @@ class TemporalResnetBlock(nn.Module):
         hidden_states = self.nonlinearity(hidden_states)
 
         hidden_states = self.dropout(hidden_states)
-        hidden_states = self.conv2(hidden_states)
+        hidden_states = self.conv2(hidden_states, num_frames=num_frames)
 
         output_tensor = (input_tensor + hidden_states) / self.output_scale_factor
 
@@ -313,18 +450,73 @@ class TemporalResnetBlock(nn.Module):
         return output_tensor
 
 
+def temporal_conv_matmul(x, weight, bias, num_frames):
+    """
+    The (3, 1, 1) convolution over the frames of `Conv3DLayer`, with zero padding, as three shifted matmuls
+    on the (b t, c, h, w) layout: every frame gets its center tap, then the previous and the next frame are
+    accumulated in place, each as one matmul over all the frames of all the videos. The shifted matmuls also
+    add the last frame of a video to the first frame of the next one (and the other way around), so those
+    b - 1 frames are saved before and written back after. Nothing is rearranged and the output has the memory
+    format of `x`. A channels_last `x` is a (b t h w, c) matrix, so every tap is a single matmul.
+
+    Args:
+        x: (batch_size * num_frames, in_channels, height, width)
+        weight: (out_channels, in_channels, 3, 1, 1) weight of the `nn.Conv3d`
+        bias: (out_channels,) or None
+    """
+    bt, c, height, width = x.shape
+    batch_size, hw = bt // num_frames, height * width
+    out_channels = weight.shape[0]
+    # (3, out_channels, in_channels), one matrix per tap
+    taps = weight.flatten(2).permute(2, 0, 1).contiguous()
+    if bias is None:
+        bias = x.new_zeros(out_channels)
+
+    if x.is_contiguous(memory_format=torch.channels_last) and not x.is_contiguous():
+        # (b t h w, c), frames are hw rows apart
+        x = x.permute(0, 2, 3, 1).reshape(bt * hw, c)
+        out = torch.addmm(bias, x, taps[1].t())
+        video_out = out.view(batch_size, num_frames * hw, out_channels)
+        first_frames = video_out[1:, :hw].clone()
+        out[hw:].addmm_(x[:-hw], taps[0].t())
+        video_out[1:, :hw] = first_frames
+        last_frames = video_out[:-1, -hw:].clone()
+        out[:-hw].addmm_(x[hw:], taps[2].t())
+        video_out[:-1, -hw:] = last_frames
+        return out.view(bt, height, width, out_channels).permute(0, 3, 1, 2)
+
+    x = x.view(bt, c, hw)
+    out = torch.baddbmm(bias[:, None], taps[1].expand(bt, -1, -1), x)
+    video_out = out.view(batch_size, num_frames, out_channels, hw)
+    first_frames = video_out[1:, 0].clone()
+    out[1:].baddbmm_(taps[0].expand(bt - 1, -1, -1), x[:-1])
+    video_out[1:, 0] = first_frames
+    last_frames = video_out[:-1, -1].clone()
+    out[:-1].baddbmm_(taps[2].expand(bt - 1, -1, -1), x[1:])
+    video_out[:-1, -1] = last_frames
+    return out.view(bt, out_channels, height, width)
+
+
 class Conv3DLayer(nn.Conv3d):
     def __init__(self, in_dim, out_dim, n_frames):
         k, p = (3, 1, 1), (1, 0, 0)
         super().__init__(in_channels=in_dim, out_channels=out_dim, kernel_size=k, stride=1, padding=p)
 
-        self.to_3d = Rearrange('(b t) c h w -> b c t h w', t=n_frames)
-        self.to_2d = Rearrange('b c t h w -> (b t) c h w')
+        # default number of frames, used when `num_frames` is not passed to forward
+        self.n_frames = n_frames
+
+        # set by `VideoLDMUNet3DConditionModel.set_temporal_conv_matmul`, runs `temporal_conv_matmul` on the
+        # (b t) layout instead of the `nn.Conv3d` on a rearranged copy. Same weights, outputs equal up to
+        # floating point rounding.
+        self.use_matmul = False
 
-    def forward(self, x):
-        h = self.to_3d(x)
+    def forward(self, x, num_frames=None):
+        num_frames = num_frames or self.n_frames
+        if self.use_matmul:
+            return temporal_conv_matmul(x, self.weight, self.bias, num_frames)
+        h = rearrange(x, '(b t) c h w -> b c t h w', t=num_frames)
         h = super().forward(h)
-        out = self.to_2d(h)
+        out = rearrange(h, 'b c t h w -> (b t) c h w')
         return out
 
 
@@ -381,6 +573,10 @@ class VideoLDMCrossAttnDownBlock(nn.Module):
         self.first_frame_condition_mode = first_frame_condition_mode
         if self.first_frame_condition_mode == "conv2d":
             self.first_frame_conv = nn.Conv2d(latent_channels, in_channels, kernel_size=1)
+        # set by `VideoLDMUNet3DConditionModel.cache_first_frame_features`
+        self.first_frame_cache = None
+        # whether frame 0 of the first resnet's input only depends on the first frame latents (see `run_first_resnet`)
+        self.static_first_frame_input = self.first_frame_condition_mode == "conv2d"
 
         resnets = []
         attentions = []
@@ -502,36 +698,38 @@ class VideoLDMCrossAttnDownBlock(nn.Module):
         encoder_attention_mask: Optional[torch.FloatTensor] = None,
         # additional
         first_frame_latents=None,
+        num_frames=None,
     ):
         condition_on_first_frame = (self.first_frame_condition_mode != "none" and self.first_frame_condition_mode != "input_only")
         # input shape: hidden_states = (b f) c h w, first_frame_latents = b c 1 h w
+        num_frames = num_frames or self.n_frames
         if self.first_frame_condition_mode == "conv2d":
-            hidden_states = rearrange(hidden_states, '(b t) c h w -> b c t h w', t=self.n_frames)
-            hidden_height = hidden_states.shape[3]
-            first_frame_height = first_frame_latents.shape[3]
-            downsample_ratio = hidden_height / first_frame_height
-            first_frame_latents = F.interpolate(first_frame_latents.squeeze(2), scale_factor=downsample_ratio, mode="nearest")
-            first_frame_latents = self.first_frame_conv(first_frame_latents).unsqueeze(2)
-            hidden_states[:, :, 0:1, :, :] = first_frame_latents
-            hidden_states = rearrange(hidden_states, 'b c t h w -> (b t) c h w', t=self.n_frames)
+            hidden_states = rearrange(hidden_states, '(b t) c h w -> b c t h w', t=num_frames)
+            hidden_states[:, :, 0:1, :, :] = project_first_frame_latents(self, first_frame_latents, hidden_states.shape[3])
+            hidden_states = rearrange(hidden_states, 'b c t h w -> (b t) c h w', t=num_frames)
 
         output_states = ()
 
-        for resnet, conv3d, attn, tempo_attn in zip(self.resnets, self.conv3ds, self.attentions, self.tempo_attns):
+        for i, (resnet, conv3d, attn, tempo_attn) in enumerate(zip(self.resnets, self.conv3ds, self.attentions, self.tempo_attns)):
 
-            hidden_states = resnet(hidden_states, temb)
-            hidden_states = conv3d(hidden_states)
+            if i == 0:
+                hidden_states = run_first_resnet(self, resnet, hidden_states, temb, first_frame_latents, num_frames)
+            else:
+                hidden_states = resnet(hidden_states, temb)
+            hidden_states = conv3d(hidden_states, num_frames=num_frames)
             hidden_states = attn(
                 hidden_states,
                 encoder_hidden_states=encoder_hidden_states,
                 cross_attention_kwargs=cross_attention_kwargs,
                 condition_on_first_frame=condition_on_first_frame,
+                num_frames=num_frames,
             ).sample
             hidden_states = tempo_attn(
                 hidden_states,
                 encoder_hidden_states=encoder_hidden_states,
                 cross_attention_kwargs=cross_attention_kwargs,
                 condition_on_first_frame=False,
+                num_frames=num_frames,
             ).sample
 
             output_states += (hidden_states,)
@@ -586,6 +784,8 @@ class VideoLDMCrossAttnUpBlock(nn.Module):
         self.first_frame_condition_mode = first_frame_condition_mode
         if self.first_frame_condition_mode == "conv2d":
             self.first_frame_conv = nn.Conv2d(latent_channels, prev_output_channel, kernel_size=1)
+        # set by `VideoLDMUNet3DConditionModel.cache_first_frame_features`
+        self.first_frame_cache = None
 
         resnets = []
         attentions = []
@@ -705,18 +905,15 @@ class VideoLDMCrossAttnUpBlock(nn.Module):
         encoder_attention_mask: Optional[torch.FloatTensor] = None,
         # additional
         first_frame_latents=None,
+        num_frames=None,
     ):
         condition_on_first_frame = (self.first_frame_condition_mode != "none" and self.first_frame_condition_mode != "input_only")
         # input shape: hidden_states = (b f) c h w, first_frame_latents = b c 1 h w
+        num_frames = num_frames or self.n_frames
         if self.first_frame_condition_mode == "conv2d":
-            hidden_states = rearrange(hidden_states, '(b t) c h w -> b c t h w', t=self.n_frames)
-            hidden_height = hidden_states.shape[3]
-            first_frame_height = first_frame_latents.shape[3]
-            downsample_ratio = hidden_height / first_frame_height
-            first_frame_latents = F.interpolate(first_frame_latents.squeeze(2), scale_factor=downsample_ratio, mode="nearest")
-            first_frame_latents = self.first_frame_conv(first_frame_latents).unsqueeze(2)
-            hidden_states[:, :, 0:1, :, :] = first_frame_latents
-            hidden_states = rearrange(hidden_states, 'b c t h w -> (b t) c h w', t=self.n_frames)
+            hidden_states = rearrange(hidden_states, '(b t) c h w -> b c t h w', t=num_frames)
+            hidden_states[:, :, 0:1, :, :] = project_first_frame_latents(self, first_frame_latents, hidden_states.shape[3])
+            hidden_states = rearrange(hidden_states, 'b c t h w -> (b t) c h w', t=num_frames)
 
         for resnet, conv3d, attn, tempo_attn in zip(self.resnets, self.conv3ds, self.attentions, self.tempo_attns):
 
@@ -725,18 +922,20 @@ class VideoLDMCrossAttnUpBlock(nn.Module):
             hidden_states = torch.cat([hidden_states, res_hidden_states], dim=1)
 
             hidden_states = resnet(hidden_states, temb)
-            hidden_states = conv3d(hidden_states)
+            hidden_states = conv3d(hidden_states, num_frames=num_frames)
             hidden_states = attn(
                 hidden_states,
                 encoder_hidden_states=encoder_hidden_states,
                 cross_attention_kwargs=cross_attention_kwargs,
                 condition_on_first_frame=condition_on_first_frame,
+                num_frames=num_frames,
             ).sample
             hidden_states = tempo_attn(
                 hidden_states,
                 encoder_hidden_states=encoder_hidden_states,
                 cross_attention_kwargs=cross_attention_kwargs,
                 condition_on_first_frame=False,
+                num_frames=num_frames,
             ).sample
 
         if self.upsamplers is not None:
@@ -779,6 +978,10 @@ class VideoLDMUNetMidBlock2DCrossAttn(nn.Module):
         self.first_frame_condition_mode = first_frame_condition_mode
         if self.first_frame_condition_mode == "conv2d":
             self.first_frame_conv = nn.Conv2d(latent_channels, in_channels, kernel_size=1)
+        # set by `VideoLDMUNet3DConditionModel.cache_first_frame_features`
+        self.first_frame_cache = None
+        # whether frame 0 of the first resnet's input only depends on the first frame latents (see `run_first_resnet`)
+        self.static_first_frame_input = self.first_frame_condition_mode == "conv2d"
 
         self.has_cross_attention = True
         self.num_attention_heads = num_attention_heads
@@ -881,22 +1084,19 @@ class VideoLDMUNetMidBlock2DCrossAttn(nn.Module):
         encoder_attention_mask: Optional[torch.FloatTensor] = None,
         # additional
         first_frame_latents=None,
+        num_frames=None,
     ) -> torch.FloatTensor:
         condition_on_first_frame = (self.first_frame_condition_mode != "none" and self.first_frame_condition_mode != "input_only")
         # input shape: hidden_states = (b f) c h w, first_frame_latents = b c 1 h w
+        num_frames = num_frames or self.n_frames
         if self.first_frame_condition_mode == "conv2d":
-            hidden_states = rearrange(hidden_states, '(b t) c h w -> b c t h w', t=self.n_frames)
-            hidden_height = hidden_states.shape[3]
-            first_frame_height = first_frame_latents.shape[3]
-            downsample_ratio = hidden_height / first_frame_height
-            first_frame_latents = F.interpolate(first_frame_latents.squeeze(2), scale_factor=downsample_ratio, mode="nearest")
-            first_frame_latents = self.first_frame_conv(first_frame_latents).unsqueeze(2)
-            hidden_states[:, :, 0:1, :, :] = first_frame_latents
-            hidden_states = rearrange(hidden_states, 'b c t h w -> (b t) c h w', t=self.n_frames)
+            hidden_states = rearrange(hidden_states, '(b t) c h w -> b c t h w', t=num_frames)
+            hidden_states[:, :, 0:1, :, :] = project_first_frame_latents(self, first_frame_latents, hidden_states.shape[3])
+            hidden_states = rearrange(hidden_states, 'b c t h w -> (b t) c h w', t=num_frames)
 
         lora_scale = cross_attention_kwargs.get("scale", 1.0) if cross_attention_kwargs is not None else 1.0
-        hidden_states = self.resnets[0](hidden_states, temb, scale=lora_scale)
-        hidden_states = self.conv3ds[0](hidden_states)
+        hidden_states = run_first_resnet(self, self.resnets[0], hidden_states, temb, first_frame_latents, num_frames, scale=lora_scale)
+        hidden_states = self.conv3ds[0](hidden_states, num_frames=num_frames)
         for attn, resnet, conv3d in zip(self.attentions, self.resnets[1:], self.conv3ds[1:]):
             if self.training and self.gradient_checkpointing:
 
@@ -919,6 +1119,7 @@ class VideoLDMUNetMidBlock2DCrossAttn(nn.Module):
                     return_dict=False,
                     # additional
                     condition_on_first_frame=condition_on_first_frame,
+                    num_frames=num_frames,
                 )[0]
                 hidden_states = torch.utils.checkpoint.checkpoint(
                     create_custom_forward(resnet),
@@ -926,7 +1127,7 @@ class VideoLDMUNetMidBlock2DCrossAttn(nn.Module):
                     temb,
                     **ckpt_kwargs,
                 )
-                hidden_states = conv3d(hidden_states)
+                hidden_states = conv3d(hidden_states, num_frames=num_frames)
             else:
                 hidden_states = attn(
                     hidden_states,
@@ -937,9 +1138,10 @@ class VideoLDMUNetMidBlock2DCrossAttn(nn.Module):
                     return_dict=False,
                     # additional
                     condition_on_first_frame=condition_on_first_frame,
+                    num_frames=num_frames,
                 )[0]
                 hidden_states = resnet(hidden_states, temb, scale=lora_scale)
-                hidden_states = conv3d(hidden_states)
+                hidden_states = conv3d(hidden_states, num_frames=num_frames)
 
         return hidden_states
 
@@ -987,6 +1189,10 @@ class VideoLDMDownBlock(DownBlock2D):
         self.first_frame_condition_mode = first_frame_condition_mode
         if self.first_frame_condition_mode == "conv2d":
             self.first_frame_conv = nn.Conv2d(latent_channels, in_channels, kernel_size=1)
+        # set by `VideoLDMUNet3DConditionModel.cache_first_frame_features`
+        self.first_frame_cache = None
+        # whether frame 0 of the first resnet's input only depends on the first frame latents (see `run_first_resnet`)
+        self.static_first_frame_input = self.first_frame_condition_mode == "conv2d"
 
         # >>> Temporal Layers >>>
         conv3ds = []
@@ -1004,21 +1210,17 @@ class VideoLDMDownBlock(DownBlock2D):
         self.conv3ds = nn.ModuleList(conv3ds)
         # <<< Temporal Layers <<<
 
-    def forward(self, hidden_states, temb=None, scale: float = 1, first_frame_latents=None):
+    def forward(self, hidden_states, temb=None, scale: float = 1, first_frame_latents=None, num_frames=None):
         # input shape: hidden_states = (b f) c h w, first_frame_latents = b c 1 h w
+        num_frames = num_frames or self.n_frames
         if self.first_frame_condition_mode == "conv2d":
-            hidden_states = rearrange(hidden_states, '(b t) c h w -> b c t h w', t=self.n_frames)
-            hidden_height = hidden_states.shape[3]
-            first_frame_height = first_frame_latents.shape[3]
-            downsample_ratio = hidden_height / first_frame_height
-            first_frame_latents = F.interpolate(first_frame_latents.squeeze(2), scale_factor=downsample_ratio, mode="nearest")
-            first_frame_latents = self.first_frame_conv(first_frame_latents).unsqueeze(2)
-            hidden_states[:, :, 0:1, :, :] = first_frame_latents
-            hidden_states = rearrange(hidden_states, 'b c t h w -> (b t) c h w', t=self.n_frames)
+            hidden_states = rearrange(hidden_states, '(b t) c h w -> b c t h w', t=num_frames)
+            hidden_states[:, :, 0:1, :, :] = project_first_frame_latents(self, first_frame_latents, hidden_states.shape[3])
+            hidden_states = rearrange(hidden_states, 'b c t h w -> (b t) c h w', t=num_frames)
 
         output_states = ()
 
-        for resnet, conv3d in zip(self.resnets, self.conv3ds):
+        for i, (resnet, conv3d) in enumerate(zip(self.resnets, self.conv3ds)):
             if self.training and self.gradient_checkpointing:
 
                 def create_custom_forward(module):
@@ -1035,10 +1237,12 @@ class VideoLDMDownBlock(DownBlock2D):
                     hidden_states = torch.utils.checkpoint.checkpoint(
                         create_custom_forward(resnet), hidden_states, temb
                     )
+            elif i == 0:
+                hidden_states = run_first_resnet(self, resnet, hidden_states, temb, first_frame_latents, num_frames, scale=scale)
             else:
                 hidden_states = resnet(hidden_states, temb, scale=scale)
 
-            hidden_states = conv3d(hidden_states)
+            hidden_states = conv3d(hidden_states, num_frames=num_frames)
 
             output_states = output_states + (hidden_states,)
 
@@ -1095,6 +1299,8 @@ class VideoLDMUpBlock(UpBlock2D):
         self.first_frame_condition_mode = first_frame_condition_mode
         if self.first_frame_condition_mode == "conv2d":
             self.first_frame_conv = nn.Conv2d(latent_channels, prev_output_channel, kernel_size=1)
+        # set by `VideoLDMUNet3DConditionModel.cache_first_frame_features`
+        self.first_frame_cache = None
 
         # >>> Temporal Layers >>>
         conv3ds = []
@@ -1113,17 +1319,13 @@ class VideoLDMUpBlock(UpBlock2D):
         self.conv3ds = nn.ModuleList(conv3ds)
         # <<< Temporal Layers <<<
 
-    def forward(self, hidden_states, res_hidden_states_tuple, temb=None, upsample_size=None, scale: float = 1, first_frame_latents=None):
+    def forward(self, hidden_states, res_hidden_states_tuple, temb=None, upsample_size=None, scale: float = 1, first_frame_latents=None, num_frames=None):
         # input shape: hidden_states = (b f) c h w, first_frame_latents = b c 1 h w
+        num_frames = num_frames or self.n_frames
         if self.first_frame_condition_mode == "conv2d":
-            hidden_states = rearrange(hidden_states, '(b t) c h w -> b c t h w', t=self.n_frames)
-            hidden_height = hidden_states.shape[3]
-            first_frame_height = first_frame_latents.shape[3]
-            downsample_ratio = hidden_height / first_frame_height
-            first_frame_latents = F.interpolate(first_frame_latents.squeeze(2), scale_factor=downsample_ratio, mode="nearest")
-            first_frame_latents = self.first_frame_conv(first_frame_latents).unsqueeze(2)
-            hidden_states[:, :, 0:1, :, :] = first_frame_latents
-            hidden_states = rearrange(hidden_states, 'b c t h w -> (b t) c h w', t=self.n_frames)
+            hidden_states = rearrange(hidden_states, '(b t) c h w -> b c t h w', t=num_frames)
+            hidden_states[:, :, 0:1, :, :] = project_first_frame_latents(self, first_frame_latents, hidden_states.shape[3])
+            hidden_states = rearrange(hidden_states, 'b c t h w -> (b t) c h w', t=num_frames)
 
         for resnet, conv3d in zip(self.resnets, self.conv3ds):
             # pop res hidden states
@@ -1150,7 +1352,7 @@ class VideoLDMUpBlock(UpBlock2D):
             else:
                 hidden_states = resnet(hidden_states, temb, scale=scale)
             
-            hidden_states = conv3d(hidden_states)
+            hidden_states = conv3d(hidden_states, num_frames=num_frames)
 
         if self.upsamplers is not None:
             for upsampler in self.upsamplers:
@@ -4,12 +4,12 @@ import inspect
 from typing import Callable, List, Optional, Union
 from dataclasses import dataclass
 
-import math
 import numpy as np
 import torch
 from tqdm import tqdm
 
 from torchvision import transforms as T
+from torchvision.utils import make_grid
 from torchvision.transforms import functional as F
 from PIL import Image
 
@@ -34,11 +34,16 @@ from einops import rearrange, repeat
 
 from ..models.videoldm_unet import VideoLDMUNet3DConditionModel
 
-from ..utils.frameinit_utils import get_freq_filter, freq_mix_3d
+from ..utils.cache_utils import FirstFrameLatentCache, TextEmbeddingCache
+from ..utils.guidance_utils import GUIDANCE_BRANCHES, get_guidance_mode, get_guidance_scale_schedule, select_guidance_branches
+from ..utils.frameinit_utils import get_freq_filter, freq_mix_3d, freq_mix_3d_rfft
+from ..utils.noise_utils import randn, sample_noise
+from ..utils.pipeline_utils import encode_text, get_decode_chunk_size
 
 
 logger = logging.get_logger(__name__)  # pylint: disable=invalid-name
 
+
 # copied from https://github.com/huggingface/diffusers/blob/v0.23.0/src/diffusers/pipelines/stable_diffusion/pipeline_stable_diffusion.py#L59C1-L70C21
 def rescale_noise_cfg(noise_cfg, noise_pred_text, guidance_rescale=0.0):
     """
@@ -196,10 +201,16 @@ class ConditionalAnimationPipeline(DiffusionPipeline):
         self.vae_scale_factor = 2 ** (len(self.vae.config.block_out_channels) - 1)
 
         self.freq_filter = None
+        self.freq_mix_mode = "fft"
+        self.enable_text_embedding_cache()
+        self.enable_first_frame_cache()
 
     @torch.no_grad()
-    def init_filter(self, video_length, height, width, filter_params):
+    def init_filter(self, video_length, height, width, filter_params, freq_mix_mode="fft"):
         # initialize frequency filter for noise reinitialization
+        # freq_mix_mode: "fft" (full complex spectrum) or "rfft" (half spectrum, same result)
+        if freq_mix_mode not in ("fft", "rfft"):
+            raise ValueError(f"Unknown freq_mix_mode: {freq_mix_mode}")
         batch_size = 1
         num_channels_latents = self.unet.config.in_channels
         filter_shape = [
@@ -216,8 +227,10 @@ class ConditionalAnimationPipeline(DiffusionPipeline):
             filter_type=filter_params.method,
             n=filter_params.n if filter_params.method=="butterworth" else None,
             d_s=filter_params.d_s,
-            d_t=filter_params.d_t
+            d_t=filter_params.d_t,
+            rfft=freq_mix_mode == "rfft",
         )
+        self.freq_mix_mode = freq_mix_mode
 
     def enable_vae_slicing(self):
         self.vae.enable_slicing()
@@ -251,36 +264,19 @@ class ConditionalAnimationPipeline(DiffusionPipeline):
                 return torch.device(module._hf_hook.execution_device)
         return self.device
 
+    def enable_text_embedding_cache(self, max_size=256, cache_dir=None):
+        r"""
+        Cache text encoder outputs across calls in an LRU of `max_size` embeddings, optionally backed by
+        `cache_dir` on disk. The empty prompt used for classifier free guidance is kept for the lifetime of
+        the pipeline. Enabled with the default arguments on construction.
+        """
+        self.text_embedding_cache = TextEmbeddingCache(max_size=max_size, cache_dir=cache_dir)
+
     def _encode_prompt(self, prompt, device, num_videos_per_prompt, do_classifier_free_guidance, negative_prompt):
         batch_size = len(prompt) if isinstance(prompt, list) else 1
+        max_length = self.tokenizer.model_max_length
 
-        text_inputs = self.tokenizer(
-            prompt,
-            padding="max_length",
-            max_length=self.tokenizer.model_max_length,
-            truncation=True,
-            return_tensors="pt",
-        )
-        text_input_ids = text_inputs.input_ids
-        untruncated_ids = self.tokenizer(prompt, padding="longest", return_tensors="pt").input_ids
-
-        if untruncated_ids.shape[-1] >= text_input_ids.shape[-1] and not torch.equal(text_input_ids, untruncated_ids):
-            removed_text = self.tokenizer.batch_decode(untruncated_ids[:, self.tokenizer.model_max_length - 1 : -1])
-            logger.warning(
-                "The following part of your input was truncated because CLIP can only handle sequences up to"
-                f" {self.tokenizer.model_max_length} tokens: {removed_text}"
-            )
-
-        if hasattr(self.text_encoder.config, "use_attention_mask") and self.text_encoder.config.use_attention_mask:
-            attention_mask = text_inputs.attention_mask.to(device)
-        else:
-            attention_mask = None
-
-        text_embeddings = self.text_encoder(
-            text_input_ids.to(device),
-            attention_mask=attention_mask,
-        )
-        text_embeddings = text_embeddings[0]
+        text_embeddings = encode_text(self.tokenizer, self.text_encoder, self.text_embedding_cache, prompt if isinstance(prompt, list) else [prompt], device, max_length)
 
         # duplicate text embeddings for each generation per prompt, using mps friendly method
         bs_embed, seq_len, _ = text_embeddings.shape
@@ -308,25 +304,7 @@ class ConditionalAnimationPipeline(DiffusionPipeline):
             else:
                 uncond_tokens = negative_prompt
 
-            max_length = text_input_ids.shape[-1]
-            uncond_input = self.tokenizer(
-                uncond_tokens,
-                padding="max_length",
-                max_length=max_length,
-                truncation=True,
-                return_tensors="pt",
-            )
-
-            if hasattr(self.text_encoder.config, "use_attention_mask") and self.text_encoder.config.use_attention_mask:
-                attention_mask = uncond_input.attention_mask.to(device)
-            else:
-                attention_mask = None
-
-            uncond_embeddings = self.text_encoder(
-                uncond_input.input_ids.to(device),
-                attention_mask=attention_mask,
-            )
-            uncond_embeddings = uncond_embeddings[0]
+            uncond_embeddings = encode_text(self.tokenizer, self.text_encoder, self.text_embedding_cache, uncond_tokens, device, max_length)
 
             # duplicate unconditional embeddings for each generation per prompt, using mps friendly method
             seq_len = uncond_embeddings.shape[1]
@@ -343,26 +321,138 @@ class ConditionalAnimationPipeline(DiffusionPipeline):
 
         return text_embeddings
 
-    def decode_latents(self, latents, first_frames=None):
+    def enable_first_frame_cache(self, max_bytes=1 << 30, cache_dir=None):
+        r"""
+        Cache preprocessed first frames and their VAE latent distributions across calls, keyed by the image
+        content, in an LRU of at most `max_bytes` bytes, optionally backed by memory-mapped files in
+        `cache_dir`. Enabled with the default arguments on construction.
+        """
+        self.first_frame_cache = FirstFrameLatentCache(max_bytes=max_bytes, cache_dir=cache_dir)
+
+    def _preprocess_first_frame(self, first_frame_path, height, width, video_length, camera_motion):
+        if camera_motion is None:
+            img_transform = T.Compose([
+                T.ToTensor(),
+                T.Resize(height, antialias=None),
+                T.CenterCrop((height, width)),
+                T.Normalize(mean=[0.5, 0.5, 0.5], std=[0.5, 0.5, 0.5], inplace=True),
+            ])
+        elif camera_motion == "pan_left" or camera_motion == "pan_right":
+            img_transform = T.Compose([
+                T.ToTensor(),
+                T.Resize(height, antialias=None),
+                T.Normalize(mean=[0.5, 0.5, 0.5], std=[0.5, 0.5, 0.5], inplace=True),
+            ])
+        elif camera_motion == "zoom_out" or camera_motion == "zoom_in":
+            img_transform = T.Compose([
+                T.ToTensor(),
+                T.Resize(height * 2, antialias=None),
+                T.Normalize(mean=[0.5, 0.5, 0.5], std=[0.5, 0.5, 0.5], inplace=True),
+            ])
+        else:
+            raise NotImplementedError(f"camera_motion: {camera_motion} is not implemented.")
+
+        first_frame = Image.open(first_frame_path).convert('RGB')
+        first_frame = img_transform(first_frame)
+        if camera_motion == "pan_left":
+            first_frame = pan_left(first_frame, num_frames=video_length, crop_width=width)
+        elif camera_motion == "pan_right":
+            first_frame = pan_right(first_frame, num_frames=video_length, crop_width=width)
+        elif camera_motion == "zoom_in":
+            first_frame = zoom_in(first_frame, num_frames=video_length, crop_width=width)
+        elif camera_motion == "zoom_out":
+            first_frame = zoom_out(first_frame, num_frames=video_length, crop_width=width)
+        return first_frame
+
+    def _encode_first_frame_paths(self, first_frame_paths, height, width, video_length, camera_motion, device):
+        # preprocessed first frames and their latent distribution, only loading and encoding cache misses
+        keys = [
+            self.first_frame_cache.get_key(path, height, width, camera_motion, video_length, self.vae.dtype)
+            for path in first_frame_paths
+        ]
+        entries = {key: self.first_frame_cache.get(key) for key in dict.fromkeys(keys)}
+        missing_keys = [key for key, entry in entries.items() if entry is None]
+
+        if len(missing_keys) > 0:
+            key_paths = dict(zip(keys, first_frame_paths))
+            missing_frames = [
+                self._preprocess_first_frame(key_paths[key], height, width, video_length, camera_motion)
+                for key in missing_keys
+            ]
+            if camera_motion is None:
+                missing_frames = [first_frame.unsqueeze(0) for first_frame in missing_frames]
+            # (f, c, h, w) per image with a camera motion, (1, c, h, w) otherwise
+            frames_per_image = missing_frames[0].shape[0]
+            missing_frames = torch.cat(missing_frames, dim=0).to(device, dtype=self.vae.dtype)
+            latent_dist = self.vae.encode(missing_frames).latent_dist
+            for i, key in enumerate(missing_keys):
+                frame_slice = slice(i * frames_per_image, (i + 1) * frames_per_image)
+                entry = {
+                    "first_frame": missing_frames[frame_slice],
+                    "mean": latent_dist.mean[frame_slice],
+                    "std": latent_dist.std[frame_slice],
+                }
+                self.first_frame_cache.put(key, entry)
+                entries[key] = entry
+
+        first_frames = torch.stack([entries[key]["first_frame"] for key in keys]).to(device, dtype=self.vae.dtype)
+        if camera_motion is None:
+            first_frames = first_frames.squeeze(1)
+        else:
+            first_frames = rearrange(first_frames, "b f c h w -> (b f) c h w")
+        first_frame_mean = torch.cat([entries[key]["mean"] for key in keys]).to(device, dtype=self.vae.dtype)
+        first_frame_std = torch.cat([entries[key]["std"] for key in keys]).to(device, dtype=self.vae.dtype)
+        return first_frames, first_frame_mean, first_frame_std
+
+    def decode_latents(self, latents, first_frames=None, decode_chunk_size=None, output_type="numpy"):
         video_length = latents.shape[2]
         latents = 1 / self.vae.config.scaling_factor * latents
         latents = rearrange(latents, "b c f h w -> (b f) c h w")
+        num_frames = latents.shape[0]
+        if decode_chunk_size is None:
+            decode_chunk_size = get_decode_chunk_size(self.vae, latents, self.vae_scale_factor)
+
         # video = self.vae.decode(latents).sample
-        video = []
-        for frame_idx in tqdm(range(latents.shape[0]), **self._progress_bar_config):
-            video.append(self.vae.decode(latents[frame_idx:frame_idx+1]).sample)
-        video = torch.cat(video)
+        video = None
+        for frame_idx in tqdm(range(0, num_frames, decode_chunk_size), **self._progress_bar_config):
+            frames = self.vae.decode(latents[frame_idx:frame_idx+decode_chunk_size]).sample
+            if video is None:
+                video = frames.new_empty((num_frames, *frames.shape[1:]))
+            video[frame_idx:frame_idx+frames.shape[0]] = frames
         video = rearrange(video, "(b f) c h w -> b c f h w", f=video_length)
 
         if first_frames is not None:
             first_frames = first_frames.unsqueeze(2)
             video = torch.cat([first_frames, video], dim=2)
 
-        video = (video / 2 + 0.5).clamp(0, 1)
+        video = video.div_(2).add_(0.5).clamp_(0, 1)
         # we always cast to float32 as this does not cause significant overhead and is compatible with bfloa16
-        video = video.cpu().float().numpy()
+        video = video.cpu().float()
+        if output_type != "tensor":
+            video = video.numpy()
         return video
 
+    def decode_latents_stream(self, latents, decode_chunk_size=None, n_rows=6):
+        """
+        Decode `latents` chunk by chunk in temporal order and yield uint8 frames of shape (n, height, width, 3).
+        The videos of a batch are tiled into one grid per frame, laid out like `save_videos_grid`.
+        """
+        batch_size, video_length = latents.shape[0], latents.shape[2]
+        latents = 1 / self.vae.config.scaling_factor * latents
+        latents = rearrange(latents, "b c f h w -> (f b) c h w")
+        if decode_chunk_size is None:
+            decode_chunk_size = get_decode_chunk_size(self.vae, latents, self.vae_scale_factor)
+        # decode whole time steps so that every chunk can be tiled
+        frames_per_chunk = max(1, decode_chunk_size // batch_size)
+
+        for frame_idx in range(0, video_length, frames_per_chunk):
+            video = self.vae.decode(latents[frame_idx * batch_size:(frame_idx + frames_per_chunk) * batch_size]).sample
+            video = video.div_(2).add_(0.5).clamp_(0, 1)
+            video = rearrange(video, "(f b) c h w -> f b c h w", b=batch_size)
+            video = torch.stack([make_grid(x, nrow=n_rows) for x in video])
+            video = rearrange(video.float().mul_(255).to(torch.uint8), "f c h w -> f h w c")
+            yield video.cpu().numpy()
+
     def prepare_extra_step_kwargs(self, generator, eta):
         # prepare extra kwargs for the scheduler step, since not all schedulers have the same signature
         # eta (η) is only used with the DDIMScheduler, it will be ignored for other schedulers.
@@ -407,48 +497,9 @@ class ConditionalAnimationPipeline(DiffusionPipeline):
             )
         if latents is None:
             rand_device = "cpu" if device.type == "mps" else device
-
-            if isinstance(generator, list):
-                # shape = shape
-                shape = (1,) + shape[1:]
-                if noise_sampling_method == "vanilla":
-                    latents = [
-                        torch.randn(shape, generator=generator[i], device=rand_device, dtype=dtype)
-                        for i in range(batch_size)
-                    ]
-                elif noise_sampling_method == "pyoco_mixed":
-                    base_shape = (batch_size, num_channels_latents, 1, height // self.vae_scale_factor, width // self.vae_scale_factor)
-                    latents = []
-                    noise_alpha_squared = noise_alpha ** 2
-                    for i in range(batch_size):
-                        base_latent = torch.randn(base_shape, generator=generator[i], device=rand_device, dtype=dtype) * math.sqrt((noise_alpha_squared) / (1 + noise_alpha_squared))
-                        ind_latent = torch.randn(shape, generator=generator[i], device=rand_device, dtype=dtype) * math.sqrt(1 / (1 + noise_alpha_squared))
-                        latents.append(base_latent + ind_latent)
-                elif noise_sampling_method == "pyoco_progressive":
-                    latents = []
-                    noise_alpha_squared = noise_alpha ** 2
-                    for i in range(batch_size):
-                        latent = torch.randn(shape, generator=generator[i], device=rand_device, dtype=dtype)
-                        ind_latent = torch.randn(shape, generator=generator[i], device=rand_device, dtype=dtype) * math.sqrt(1 / (1 + noise_alpha_squared))
-                        for j in range(1, video_length):
-                            latent[:, :, j, :, :] = latent[:, :, j - 1, :, :] * math.sqrt((noise_alpha_squared) / (1 + noise_alpha_squared)) + ind_latent[:, :, j, :, :]
-                        latents.append(latent)
-                latents = torch.cat(latents, dim=0).to(device)
-            else:
-                if noise_sampling_method == "vanilla":
-                    latents = torch.randn(shape, generator=generator, device=rand_device, dtype=dtype).to(device)
-                elif noise_sampling_method == "pyoco_mixed":
-                    noise_alpha_squared = noise_alpha ** 2
-                    base_shape = (batch_size, num_channels_latents, 1, height // self.vae_scale_factor, width // self.vae_scale_factor)
-                    base_latents = torch.randn(base_shape, generator=generator, device=rand_device, dtype=dtype) * math.sqrt((noise_alpha_squared) / (1 + noise_alpha_squared))
-                    ind_latents = torch.randn(shape, generator=generator, device=rand_device, dtype=dtype) * math.sqrt(1 / (1 + noise_alpha_squared))
-                    latents = base_latents + ind_latents
-                elif noise_sampling_method == "pyoco_progressive":
-                    noise_alpha_squared = noise_alpha ** 2
-                    latents = torch.randn(shape, generator=generator, device=rand_device, dtype=dtype)
-                    ind_latents = torch.randn(shape, generator=generator, device=rand_device, dtype=dtype) * math.sqrt(1 / (1 + noise_alpha_squared))
-                    for j in range(1, video_length):
-                        latents[:, :, j, :, :] = latents[:, :, j - 1, :, :] * math.sqrt((noise_alpha_squared) / (1 + noise_alpha_squared)) + ind_latents[:, :, j, :, :]
+            latents = sample_noise(
+                shape, noise_sampling_method, noise_alpha, generator=generator, device=rand_device, dtype=dtype
+            ).to(device)
         else:
             if latents.shape != shape:
                 raise ValueError(f"Unexpected latents shape, got {latents.shape}, expected {shape}")
@@ -458,6 +509,26 @@ class ConditionalAnimationPipeline(DiffusionPipeline):
         latents = latents * self.scheduler.init_noise_sigma
         return latents
 
+    def sample_first_frame_latents(self, mean, std, generator, batch_size, num_videos_per_prompt):
+        """
+        Samples first frame latents from their VAE latent distribution, whose `batch_size` first frames have one
+        row each (or one per frame with camera motion). With a list of generators, one per video, the rows of a
+        first frame are drawn from the generator of its first video, so that a video does not depend on the
+        others it is batched with.
+        """
+        if isinstance(generator, list):
+            if len(generator) != batch_size * num_videos_per_prompt:
+                raise ValueError(
+                    f"You have passed a list of generators of length {len(generator)}, but requested an effective batch"
+                    f" size of {batch_size * num_videos_per_prompt}. Make sure the batch size matches the length of the generators."
+                )
+            shape = (batch_size, mean.shape[0] // batch_size) + tuple(mean.shape[1:])
+            generator = generator[::num_videos_per_prompt]
+            noise = randn(shape, generator=generator, device=mean.device, dtype=mean.dtype).flatten(0, 1)
+        else:
+            noise = randn(mean.shape, generator=generator, device=mean.device, dtype=mean.dtype)
+        return mean + std * noise
+
     @torch.no_grad()
     def __call__(
         self,
@@ -486,7 +557,11 @@ class ConditionalAnimationPipeline(DiffusionPipeline):
         frame_stride: Optional[int] = None,
         use_frameinit: bool = False,
         frameinit_noise_level: int = 999,
+        guidance_schedule: Union[str, List[float]] = "constant",
+        cfg_cutoff: float = 1.0,
+        decode_chunk_size: Optional[int] = None,
         camera_motion: str = None,
+        cache_first_frame_features: bool = False,
         **kwargs,
     ):
         if first_frame_paths is not None and first_frames is not None:
@@ -513,12 +588,10 @@ class ConditionalAnimationPipeline(DiffusionPipeline):
         # here `guidance_scale` is defined analog to the guidance weight `w` of equation (2)
         # of the Imagen paper: https://arxiv.org/pdf/2205.11487.pdf . `guidance_scale = 1`
         # corresponds to doing no classifier free guidance.
-        do_classifier_free_guidance = None
-        # two guidance mode: text and text+image
-        if guidance_scale_txt > 1.0:
-            do_classifier_free_guidance = "text"
-        if guidance_scale_img > 1.0:
-            do_classifier_free_guidance = "both"
+        # two guidance mode: text and text+image, scheduled per step and switched off after `cfg_cutoff`
+        guidance_scales_txt = get_guidance_scale_schedule(guidance_scale_txt, num_inference_steps, guidance_schedule, cfg_cutoff)
+        guidance_scales_img = get_guidance_scale_schedule(guidance_scale_img, num_inference_steps, guidance_schedule, cfg_cutoff)
+        do_classifier_free_guidance = get_guidance_mode(max(guidance_scales_txt), max(guidance_scales_img))
 
         # Encode input prompt
         prompt = prompt if isinstance(prompt, list) else [prompt] * batch_size
@@ -532,49 +605,21 @@ class ConditionalAnimationPipeline(DiffusionPipeline):
         first_frame_latents = None
         if first_frame_paths is not None:
             first_frame_paths = first_frame_paths if isinstance(first_frame_paths, list) else [first_frame_paths] * batch_size
-            if camera_motion is None:
-                img_transform = T.Compose([
-                    T.ToTensor(),
-                    T.Resize(height, antialias=None),
-                    T.CenterCrop((height, width)),
-                    T.Normalize(mean=[0.5, 0.5, 0.5], std=[0.5, 0.5, 0.5], inplace=True),
-                ])
-            elif camera_motion == "pan_left" or camera_motion == "pan_right":
-                img_transform = T.Compose([
-                    T.ToTensor(),
-                    T.Resize(height, antialias=None),
-                    T.Normalize(mean=[0.5, 0.5, 0.5], std=[0.5, 0.5, 0.5], inplace=True),
-                ])
-            elif camera_motion == "zoom_out" or camera_motion == "zoom_in":
-                img_transform = T.Compose([
-                    T.ToTensor(),
-                    T.Resize(height * 2, antialias=None),
-                    T.Normalize(mean=[0.5, 0.5, 0.5], std=[0.5, 0.5, 0.5], inplace=True),
-                ])
-            
-            first_frames = []
-            for first_frame_path in first_frame_paths:
-                first_frame = Image.open(first_frame_path).convert('RGB')
-                first_frame = img_transform(first_frame)
-                if camera_motion is not None:
-                    if camera_motion == "pan_left":
-                        first_frame = pan_left(first_frame, num_frames=video_length, crop_width=width)
-                    elif camera_motion == "pan_right":
-                        first_frame = pan_right(first_frame, num_frames=video_length, crop_width=width)
-                    elif camera_motion == "zoom_in":
-                        first_frame = zoom_in(first_frame, num_frames=video_length, crop_width=width)
-                    elif camera_motion == "zoom_out":
-                        first_frame = zoom_out(first_frame, num_frames=video_length, crop_width=width)
-                    else:
-                        raise NotImplementedError(f"camera_motion: {camera_motion} is not implemented.")
-                first_frames.append(first_frame.unsqueeze(0))
-            first_frames = torch.cat(first_frames, dim=0)
-        if first_frames is not None:
+            first_frames, first_frame_mean, first_frame_std = self._encode_first_frame_paths(
+                first_frame_paths, height, width, video_length, camera_motion, device
+            )
+            first_frame_latents = self.sample_first_frame_latents(
+                first_frame_mean, first_frame_std, generator, batch_size, num_videos_per_prompt
+            )
+        elif first_frames is not None:
             first_frames = first_frames.to(device, dtype=self.vae.dtype)
             if camera_motion is not None:
                 first_frames = rearrange(first_frames, "b f c h w -> (b f) c h w")
-            first_frame_latents = self.vae.encode(first_frames).latent_dist
-            first_frame_latents = first_frame_latents.sample()
+            latent_dist = self.vae.encode(first_frames).latent_dist
+            first_frame_latents = self.sample_first_frame_latents(
+                latent_dist.mean, latent_dist.std, generator, batch_size, num_videos_per_prompt
+            )
+        if first_frame_latents is not None:
             first_frame_latents = first_frame_latents * self.vae.config.scaling_factor # b, c, h, w
             first_frame_static_vid = rearrange(first_frame_latents, "(b f) c h w -> b c f h w", f=video_length if camera_motion is not None else 1)
             first_frame_latents = first_frame_static_vid[:, :, 0, :, :]
@@ -620,42 +665,53 @@ class ConditionalAnimationPipeline(DiffusionPipeline):
                 noise=latents.to(device), 
                 timesteps=diffuse_timesteps.to(device)
             )
-            latents = freq_mix_3d(z_T.to(dtype=torch.float32), latents, LPF=self.freq_filter)
+            if self.freq_mix_mode == "rfft":
+                z_T = z_T.to(dtype=torch.float32)
+                latents = freq_mix_3d_rfft(z_T, latents, LPF=self.freq_filter, out=z_T)
+            else:
+                latents = freq_mix_3d(z_T.to(dtype=torch.float32), latents, LPF=self.freq_filter)
             latents = latents.to(dtype=latents_dtype)
 
         if first_frame_latents is not None:
             first_frame_noisy_latent = latents[:, :, 0, :, :]
             latents = latents[:, :, 1:, :, :]
 
+            # first frame inputs for all guidance branches, constant over the denoising steps
+            if do_classifier_free_guidance is None:
+                first_frame_latents_model_input = first_frame_latents
+            elif do_classifier_free_guidance == "text":
+                first_frame_latents_model_input = torch.cat([first_frame_latents] * 2)
+            elif do_classifier_free_guidance == "both":
+                first_frame_latents_model_input = torch.cat([first_frame_noisy_latent, first_frame_latents, first_frame_latents])
+            first_frame_latents_model_input = first_frame_latents_model_input.unsqueeze(2)
+
         # Prepare extra step kwargs.
         extra_step_kwargs = self.prepare_extra_step_kwargs(generator, eta)
 
         # Denoising loop
         num_warmup_steps = len(timesteps) - num_inference_steps * self.scheduler.order
-        with self.progress_bar(total=num_inference_steps) as progress_bar:
+        # text keys and values (and optionally the first frame features) are computed once per call instead of
+        # at every step
+        first_frame_cache_context = self.unet.cache_first_frame_features(enabled=cache_first_frame_features)
+        with self.unet.cache_text_key_values(), first_frame_cache_context as first_frame_cache, self.progress_bar(total=num_inference_steps) as progress_bar:
             for i, t in enumerate(timesteps):
+                # guidance for this step, run only the branches it needs
+                step_idx = min(i // self.scheduler.order, num_inference_steps - 1)
+                step_guidance_scale_txt = guidance_scales_txt[step_idx]
+                step_guidance_scale_img = guidance_scales_img[step_idx]
+                step_guidance = get_guidance_mode(step_guidance_scale_txt, step_guidance_scale_img) if do_classifier_free_guidance else None
+                step_text_embeddings = select_guidance_branches(text_embeddings, do_classifier_free_guidance, step_guidance)
+
                 # expand the latents if we are doing classifier free guidance
-                if do_classifier_free_guidance is None:
-                    latent_model_input = latents
-                elif do_classifier_free_guidance == "text":
-                    latent_model_input = torch.cat([latents] * 2)
-                elif do_classifier_free_guidance == "both":
-                    latent_model_input = torch.cat([latents] * 3)
+                latent_model_input = torch.cat([latents] * GUIDANCE_BRANCHES[step_guidance]) if step_guidance else latents
                 latent_model_input = self.scheduler.scale_model_input(latent_model_input, t)
                 if first_frame_latents is not None:
-                    if do_classifier_free_guidance is None:
-                        first_frame_latents_input = first_frame_latents
-                    elif do_classifier_free_guidance == "text":
-                        first_frame_latents_input = torch.cat([first_frame_latents] * 2)
-                    elif do_classifier_free_guidance == "both":
-                        first_frame_latents_input = torch.cat([first_frame_noisy_latent, first_frame_latents, first_frame_latents])
-
-                    first_frame_latents_input = first_frame_latents_input.unsqueeze(2)
+                    first_frame_latents_input = select_guidance_branches(first_frame_latents_model_input, do_classifier_free_guidance, step_guidance)
 
                     # predict the noise residual
-                    noise_pred = self.unet(latent_model_input, t, encoder_hidden_states=text_embeddings, first_frame_latents=first_frame_latents_input, frame_stride=frame_stride).sample.to(dtype=latents_dtype)
+                    noise_pred = self.unet(latent_model_input, t, encoder_hidden_states=step_text_embeddings, first_frame_latents=first_frame_latents_input, frame_stride=frame_stride).sample.to(dtype=latents_dtype)
                 else:
-                    noise_pred = self.unet(latent_model_input, t, encoder_hidden_states=text_embeddings).sample.to(dtype=latents_dtype)
+                    noise_pred = self.unet(latent_model_input, t, encoder_hidden_states=step_text_embeddings).sample.to(dtype=latents_dtype)
                 # noise_pred = []
                 # import pdb
                 # pdb.set_trace()
@@ -665,15 +721,15 @@ class ConditionalAnimationPipeline(DiffusionPipeline):
                 # noise_pred = torch.cat(noise_pred)
 
                 # perform guidance
-                if do_classifier_free_guidance:
-                    if do_classifier_free_guidance == "text":
+                if step_guidance:
+                    if step_guidance == "text":
                         noise_pred_uncond, noise_pred_text = noise_pred.chunk(2)
-                        noise_pred = noise_pred_uncond + guidance_scale_txt * (noise_pred_text - noise_pred_uncond)
-                    elif do_classifier_free_guidance == "both":
+                        noise_pred = noise_pred_uncond + step_guidance_scale_txt * (noise_pred_text - noise_pred_uncond)
+                    elif step_guidance == "both":
                         noise_pred_uncond, noise_pred_img, noise_pred_both = noise_pred.chunk(3)
-                        noise_pred = noise_pred_uncond + guidance_scale_img * (noise_pred_img - noise_pred_uncond) + guidance_scale_txt * (noise_pred_both - noise_pred_img)
+                        noise_pred = noise_pred_uncond + step_guidance_scale_img * (noise_pred_img - noise_pred_uncond) + step_guidance_scale_txt * (noise_pred_both - noise_pred_img)
                 
-                if do_classifier_free_guidance and guidance_rescale > 0.0:
+                if step_guidance and guidance_rescale > 0.0:
                     # Based on 3.4. in https://arxiv.org/pdf/2305.08891.pdf
                     # currently only support text guidance
                     noise_pred = rescale_noise_cfg(noise_pred, noise_pred_text, guidance_rescale=guidance_rescale)
@@ -687,16 +743,34 @@ class ConditionalAnimationPipeline(DiffusionPipeline):
                     if callback is not None and i % callback_steps == 0:
                         callback(i, t, latents)
 
+        if first_frame_cache is not None:
+            logger.info(f"First frame feature cache: {first_frame_cache.get_stats()}")
+
         # Post-processing
         latents = torch.cat([first_frame_latents.unsqueeze(2), latents], dim=2)
         # video = self.decode_latents(latents, first_frames)
-        video = self.decode_latents(latents)
-
-        # Convert to tensor
-        if output_type == "tensor":
-            video = torch.from_numpy(video)
+        if output_type == "latent":
+            video = latents
+        else:
+            video = self.decode_latents(latents, decode_chunk_size=decode_chunk_size, output_type=output_type)
 
         if not return_dict:
             return video
 
         return AnimationPipelineOutput(videos=video)
+
+    @torch.no_grad()
+    def stream(self, *args, decode_chunk_size: Optional[int] = None, n_rows: int = 6, **kwargs):
+        """
+        Takes the same arguments as `__call__` and yields the result as uint8 frame chunks of shape
+        (n, height, width, 3) as soon as each VAE decode chunk is done, see `decode_latents_stream`.
+
+        Only the decoding is streamed: all the frames of a video are denoised together, so none of them is
+        final before the last denoising step and the first chunk is yielded after the whole denoising loop.
+        Streaming saves the memory of the full decoded video and lets the caller encode or send the first
+        frames while the later ones are decoded. `AutoregressiveAnimationPipeline.stream` yields every segment
+        before generating the next one.
+        """
+        kwargs.update(output_type="latent", return_dict=False)
+        latents = self(*args, **kwargs)
+        yield from self.decode_latents_stream(latents, decode_chunk_size=decode_chunk_size, n_rows=n_rows)
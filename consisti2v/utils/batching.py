@@ -0,0 +1,176 @@
+import asyncio
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Optional
+
+import torch
+
+
+@dataclass
+class GenerationRequest:
+    prompt: str
+    first_frame_path: str
+    negative_prompt: str = ""
+    height: int = 256
+    width: int = 256
+    video_length: int = 16
+    num_inference_steps: int = 50
+    guidance_scale_txt: float = 7.5
+    guidance_scale_img: float = 1.0
+    seed: Optional[int] = None
+
+    @property
+    def batch_key(self):
+        # requests can share one pipeline call only if all of these match; the guidance scales also
+        # determine the guidance mode (none / text / text+image)
+        return (
+            self.height,
+            self.width,
+            self.video_length,
+            self.num_inference_steps,
+            self.guidance_scale_txt,
+            self.guidance_scale_img,
+        )
+
+
+class BatchingScheduler:
+    """
+    Groups concurrent `GenerationRequest`s that share a `batch_key` into a single pipeline call.
+
+    A group is dispatched once it holds `max_batch_size` requests or its oldest request has waited
+    `max_wait_time` seconds. Pipeline calls run one at a time on a worker thread, so new requests keep
+    queueing up while the GPU is busy. Every request gets its own generator, so its result does not
+    depend on the requests it is batched with.
+
+    Args:
+        pipeline: a `ConditionalAnimationPipeline` (or anything with the same call signature)
+        max_batch_size: maximum number of requests per pipeline call
+        max_wait_time: maximum time in seconds a request waits for others to batch with
+        filter_params: FrameInit filter parameters, used when `use_frameinit` is passed in `pipeline_kwargs`
+        freq_mix_mode: FrameInit frequency mixing mode, see `ConditionalAnimationPipeline.init_filter`
+        pipeline_kwargs: extra arguments passed to every pipeline call (eta, frame_stride, ...)
+    """
+
+    def __init__(self, pipeline, max_batch_size=4, max_wait_time=0.1, filter_params=None, freq_mix_mode="fft", **pipeline_kwargs):
+        self.pipeline = pipeline
+        self.max_batch_size = max_batch_size
+        self.max_wait_time = max_wait_time
+        self.filter_params = filter_params
+        self.freq_mix_mode = freq_mix_mode
+        self.pipeline_kwargs = pipeline_kwargs
+
+        # batch key -> list of (request, future, arrival time), oldest first
+        self._pending = {}
+        self._wakeup = None
+        self._task = None
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    async def start(self):
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self._executor.shutdown(wait=True)
+
+    async def submit(self, request: GenerationRequest) -> torch.Tensor:
+        """
+        Queue `request` and wait for its video, a (c, f, h, w) tensor in [0, 1].
+        """
+        if self._task is None:
+            raise RuntimeError("The scheduler is not running, call `start()` first.")
+        if request.seed is None:
+            request.seed = random.getrandbits(32)
+        future = asyncio.get_running_loop().create_future()
+        self._pending.setdefault(request.batch_key, []).append((request, future, time.monotonic()))
+        self._wakeup.set()
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = self._pop_batch()
+            if batch is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self._time_to_next_deadline())
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            requests = [request for request, _, _ in batch]
+            futures = [future for _, future, _ in batch]
+            try:
+                videos = await loop.run_in_executor(self._executor, self._run_batch, requests)
+            except Exception as e:
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
+            else:
+                for future, video in zip(futures, videos):
+                    if not future.done():
+                        future.set_result(video)
+
+    def _pop_batch(self):
+        # dispatch the ready group whose oldest request has waited the longest
+        now = time.monotonic()
+        ready_key = None
+        for key, entries in self._pending.items():
+            # drop requests whose caller has gone away
+            entries[:] = [entry for entry in entries if not entry[1].done()]
+            if not entries:
+                continue
+            if len(entries) >= self.max_batch_size or now - entries[0][2] >= self.max_wait_time:
+                if ready_key is None or entries[0][2] < self._pending[ready_key][0][2]:
+                    ready_key = key
+        self._pending = {key: entries for key, entries in self._pending.items() if entries}
+        if ready_key is None:
+            return None
+
+        entries = self._pending.pop(ready_key)
+        if len(entries) > self.max_batch_size:
+            self._pending[ready_key] = entries[self.max_batch_size:]
+        return entries[:self.max_batch_size]
+
+    def _time_to_next_deadline(self):
+        if not self._pending:
+            return None
+        oldest = min(entries[0][2] for entries in self._pending.values())
+        return max(0.0, oldest + self.max_wait_time - time.monotonic())
+
+    @torch.no_grad()
+    def _run_batch(self, requests):
+        request = requests[0]
+        if self.pipeline_kwargs.get("use_frameinit", False):
+            self.pipeline.init_filter(
+                video_length=request.video_length,
+                height=request.height,
+                width=request.width,
+                filter_params=self.filter_params,
+                freq_mix_mode=self.freq_mix_mode,
+            )
+        generator = [torch.Generator(device=self.pipeline.device).manual_seed(r.seed) for r in requests]
+        videos = self.pipeline(
+            prompt=[r.prompt for r in requests],
+            negative_prompt=[r.negative_prompt for r in requests],
+            first_frame_paths=[r.first_frame_path for r in requests],
+            height=request.height,
+            width=request.width,
+            video_length=request.video_length,
+            num_inference_steps=request.num_inference_steps,
+            guidance_scale_txt=request.guidance_scale_txt,
+            guidance_scale_img=request.guidance_scale_img,
+            generator=generator,
+            num_videos_per_prompt=1,
+            output_type="tensor",
+            **self.pipeline_kwargs,
+        ).videos
+        return list(videos.unbind(0))
@@ -0,0 +1,206 @@
+import hashlib
+import os
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+
+class LRUCache:
+    """
+    Least recently used cache bounded by the total size of its entries.
+
+    Args:
+        max_size: maximum total size of the unpinned entries, 0 disables caching
+        size_fn: size of a value, 1 per entry by default
+    """
+
+    def __init__(self, max_size, size_fn=None):
+        self.max_size = max_size
+        self.size_fn = size_fn or (lambda value: 1)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        # pinned entries are never evicted and do not count towards `max_size`
+        self._pinned = {}
+
+    def __len__(self):
+        return len(self._entries) + len(self._pinned)
+
+    def __contains__(self, key):
+        return key in self._pinned or key in self._entries
+
+    def get(self, key, default=None):
+        if key in self._pinned:
+            self.hits += 1
+            return self._pinned[key]
+        if key in self._entries:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key]
+        self.misses += 1
+        return default
+
+    def put(self, key, value, pin=False):
+        self.pop(key)
+        if pin:
+            self._pinned[key] = value
+            return
+        size = self.size_fn(value)
+        if size > self.max_size:
+            return
+        self._entries[key] = value
+        self.size += size
+        while self.size > self.max_size:
+            _, evicted = self._entries.popitem(last=False)
+            self.size -= self.size_fn(evicted)
+
+    def pop(self, key, default=None):
+        if key in self._pinned:
+            return self._pinned.pop(key)
+        if key in self._entries:
+            value = self._entries.pop(key)
+            self.size -= self.size_fn(value)
+            return value
+        return default
+
+    def clear(self):
+        self._entries.clear()
+        self._pinned.clear()
+        self.size = 0
+
+
+def get_cache_filename(key):
+    # stable file name for a hashable cache key made of str/int/float/dtype values
+    return hashlib.sha1(repr(key).encode("utf-8")).hexdigest()
+
+
+class TextEmbeddingCache:
+    """
+    Cache of text encoder outputs keyed by (tokenizer name, text, max_length, dtype, device).
+
+    Entries live in an in-memory LRU and, if `cache_dir` is set, are also written to disk so that other
+    processes and later runs can load them instead of running the text encoder. The cache does not track
+    the text encoder weights, call `clear()` after changing them.
+
+    Args:
+        max_size: maximum number of embeddings kept in memory
+        cache_dir: optional directory for the on-disk tier
+    """
+
+    def __init__(self, max_size=256, cache_dir=None):
+        self.memory = LRUCache(max_size)
+        self.cache_dir = cache_dir
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def _get_path(self, key):
+        # the on-disk tier is device independent
+        return os.path.join(self.cache_dir, get_cache_filename(key[:-1]) + ".pt")
+
+    def get(self, key):
+        embedding = self.memory.get(key)
+        if embedding is None and self.cache_dir is not None:
+            path = self._get_path(key)
+            if os.path.exists(path):
+                embedding = torch.load(path, map_location="cpu").to(device=key[-1], dtype=key[-2])
+                self.memory.put(key, embedding)
+        return embedding
+
+    def put(self, key, embedding, pin=False):
+        # the embeddings are rows of a batched text encoder output, a copy keeps only its own row alive
+        embedding = embedding.detach().clone()
+        self.memory.put(key, embedding, pin=pin)
+        if self.cache_dir is not None:
+            path = self._get_path(key)
+            if not os.path.exists(path):
+                # write to a temporary file first so that concurrent readers never see a partial file
+                tmp_path = f"{path}.{os.getpid()}.tmp"
+                torch.save(embedding.cpu(), tmp_path)
+                os.replace(tmp_path, path)
+
+    def clear(self):
+        self.memory.clear()
+
+
+def get_file_hash(path, chunk_size=1 << 20):
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+class FirstFrameLatentCache:
+    """
+    Content addressed cache of preprocessed first frames and their VAE latent distributions, keyed by
+    (file hash, height, width, camera_motion, video_length, dtype). Every entry is a dict of tensors with
+    the preprocessed frame(s) "first_frame" and the latent distribution "mean" and "std".
+
+    Entries live in an in-memory LRU bounded by `max_bytes` and, if `cache_dir` is set, are also written to
+    disk as .npy files that are memory-mapped on load. Like `TextEmbeddingCache`, the cache does not track
+    the VAE weights, call `clear()` after changing them.
+
+    Args:
+        max_bytes: maximum total size of the entries kept in memory
+        cache_dir: optional directory for the on-disk tier
+    """
+
+    FIELDS = ("first_frame", "mean", "std")
+
+    def __init__(self, max_bytes=1 << 30, cache_dir=None):
+        self.memory = LRUCache(
+            max_bytes, size_fn=lambda entry: sum(t.numel() * t.element_size() for t in entry.values())
+        )
+        self.cache_dir = cache_dir
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+        # (path, mtime, size) -> content hash, so unchanged files are not re-read on every call
+        self._file_hashes = LRUCache(4096)
+
+    def get_key(self, path, height, width, camera_motion, video_length, dtype):
+        stat = os.stat(path)
+        file_key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+        file_hash = self._file_hashes.get(file_key)
+        if file_hash is None:
+            file_hash = get_file_hash(path)
+            self._file_hashes.put(file_key, file_hash)
+        # the number of frames only changes the preprocessed input when a camera motion is applied
+        return (file_hash, height, width, camera_motion, video_length if camera_motion is not None else None, dtype)
+
+    def _get_dir(self, key):
+        return os.path.join(self.cache_dir, get_cache_filename(key))
+
+    def get(self, key):
+        entry = self.memory.get(key)
+        if entry is None and self.cache_dir is not None:
+            entry_dir = self._get_dir(key)
+            if os.path.exists(os.path.join(entry_dir, "std.npy")):
+                # copy-on-write mappings are writable, so torch does not warn, and only the pages that are
+                # read are loaded
+                entry = {
+                    name: torch.from_numpy(np.load(os.path.join(entry_dir, f"{name}.npy"), mmap_mode="c")).to(dtype=key[-1])
+                    for name in self.FIELDS
+                }
+                self.memory.put(key, entry)
+        return entry
+
+    def put(self, key, entry):
+        entry = {name: entry[name].detach().to("cpu", copy=True) for name in self.FIELDS}
+        self.memory.put(key, entry)
+        if self.cache_dir is not None:
+            entry_dir = self._get_dir(key)
+            if not os.path.exists(os.path.join(entry_dir, "std.npy")):
+                os.makedirs(entry_dir, exist_ok=True)
+                # numpy has no bfloat16, store float32 and cast back on load; "std" is written last and
+                # marks a complete entry
+                for name in self.FIELDS:
+                    path = os.path.join(entry_dir, f"{name}.npy")
+                    tmp_path = f"{path}.{os.getpid()}.tmp.npy"
+                    np.save(tmp_path, entry[name].float().numpy())
+                    os.replace(tmp_path, path)
+
+    def clear(self):
+        self.memory.clear()
+        self._file_hashes.clear()
@@ -1,7 +1,12 @@
 # modified from https://github.com/TianxingWu/FreeInit/blob/master/freeinit_utils.py
+from functools import lru_cache
+
 import torch
 import torch.fft as fft
-import math
+
+
+# number of distinct (shape, filter, device, dtype) masks kept around
+FREQ_FILTER_CACHE_SIZE = 16
 
 
 def freq_mix_3d(x, noise, LPF):
@@ -32,27 +37,102 @@ def freq_mix_3d(x, noise, LPF):
     return x_mixed
 
 
-def get_freq_filter(shape, device, filter_type, n, d_s, d_t):
+def freq_mix_3d_rfft(x, noise, LPF, x_freq=None, noise_freq=None, out=None):
+    """
+    Noise reinitialization with real-input FFTs, equivalent to `freq_mix_3d` for real latents.
+
+    The mix is done in place in the spectrum of `x`; pass preallocated buffers to avoid allocations
+    when called repeatedly with the same shape.
+
+    Args:
+        x: diffused latent
+        noise: randomly sampled noise
+        LPF: half-spectrum low pass filter in the unshifted domain, see `get_freq_filter(..., rfft=True)`
+        x_freq: optional complex buffer for the spectrum of x
+        noise_freq: optional complex buffer for the spectrum of noise
+        out: optional real buffer for the result, may alias x
+    """
+    dim = (-3, -2, -1)
+    x_freq = fft.rfftn(x, dim=dim, out=x_freq)
+    noise_freq = fft.rfftn(noise.to(x.dtype), dim=dim, out=noise_freq)
+
+    # x * LPF + noise * (1 - LPF) == noise + (x - noise) * LPF
+    x_freq.sub_(noise_freq).mul_(LPF).add_(noise_freq)
+
+    return fft.irfftn(x_freq, s=x.shape[-3:], dim=dim, out=out)
+
+
+def get_freq_filter(shape, device, filter_type, n, d_s, d_t, dtype=torch.float32, rfft=False):
     """
     Form the frequency filter for noise reinitialization.
 
+    The (T, H, W) mask is shared across batch and channel, so the returned tensor is shaped
+    (1, ..., 1, T, H, W) and broadcasts against latents of `shape`. Masks are cached; treat the
+    result as read-only.
+
     Args:
         shape: shape of latent (B, C, T, H, W)
         filter_type: type of the freq filter
         n: (only for butterworth) order of the filter, larger n ~ ideal, smaller n ~ gaussian
         d_s: normalized stop frequency for spatial dimensions (0.0-1.0)
         d_t: normalized stop frequency for temporal dimension (0.0-1.0)
+        dtype: dtype of the returned filter
+        rfft: return the half-spectrum, unshifted filter used by `freq_mix_3d_rfft`
     """
+    if filter_type not in ("gaussian", "ideal", "box", "butterworth"):
+        raise NotImplementedError
+    mask = _get_cached_freq_filter(
+        tuple(shape[-3:]), filter_type, n, d_s, d_t, torch.device(device), dtype, rfft
+    )
+    return _expand_mask(mask, shape)
+
+
+@lru_cache(maxsize=FREQ_FILTER_CACHE_SIZE)
+def _get_cached_freq_filter(size, filter_type, n, d_s, d_t, device, dtype, rfft):
     if filter_type == "gaussian":
-        return gaussian_low_pass_filter(shape=shape, d_s=d_s, d_t=d_t).to(device)
+        mask = gaussian_low_pass_filter(shape=size, d_s=d_s, d_t=d_t)
     elif filter_type == "ideal":
-        return ideal_low_pass_filter(shape=shape, d_s=d_s, d_t=d_t).to(device)
+        mask = ideal_low_pass_filter(shape=size, d_s=d_s, d_t=d_t)
     elif filter_type == "box":
-        return box_low_pass_filter(shape=shape, d_s=d_s, d_t=d_t).to(device)
-    elif filter_type == "butterworth":
-        return butterworth_low_pass_filter(shape=shape, n=n, d_s=d_s, d_t=d_t).to(device)
+        mask = box_low_pass_filter(shape=size, d_s=d_s, d_t=d_t)
     else:
-        raise NotImplementedError
+        mask = butterworth_low_pass_filter(shape=size, n=n, d_s=d_s, d_t=d_t)
+    mask = mask.reshape(size)
+    if rfft:
+        mask = _to_rfft_filter(mask)
+    return mask.to(device=device, dtype=dtype)
+
+
+def _to_rfft_filter(mask):
+    """
+    Convert a centered (fftshift-ed) filter to the unshifted half spectrum returned by `rfftn`.
+
+    `freq_mix_3d` keeps only the real part of the inverse transform, which is the same as filtering
+    with the Hermitian-symmetric part of the mask, so the mask is symmetrized before it is cut in half.
+    The centered masks are already symmetric for even sizes.
+    """
+    dim = (-3, -2, -1)
+    mask = fft.ifftshift(mask, dim=dim)
+    mask_neg = torch.roll(torch.flip(mask, dims=dim), shifts=(1, 1, 1), dims=dim)
+    mask = (mask + mask_neg) / 2
+    return mask[..., : mask.shape[-1] // 2 + 1].contiguous()
+
+
+def _get_freq_distance_square(shape, d_s, d_t):
+    """
+    Squared normalized distance to the spectrum center on a (T, H, W) grid, computed in float64 to
+    match the scalar reference values.
+    """
+    T, H, W = shape[-3], shape[-2], shape[-1]
+    grid_t = (d_s / d_t) * (2 * torch.arange(T, dtype=torch.float64) / T - 1)
+    grid_h = 2 * torch.arange(H, dtype=torch.float64) / H - 1
+    grid_w = 2 * torch.arange(W, dtype=torch.float64) / W - 1
+    return grid_t[:, None, None] ** 2 + grid_h[None, :, None] ** 2 + grid_w[None, None, :] ** 2
+
+
+def _expand_mask(mask, shape):
+    # (T, H, W) -> (1, ..., 1, T, H, W), broadcastable against `shape`
+    return mask.view((1,) * (len(shape) - 3) + tuple(mask.shape))
 
 
 def gaussian_low_pass_filter(shape, d_s=0.25, d_t=0.25):
@@ -65,15 +145,11 @@ def gaussian_low_pass_filter(shape, d_s=0.25, d_t=0.25):
         d_t: normalized stop frequency for temporal dimension (0.0-1.0)
     """
     T, H, W = shape[-3], shape[-2], shape[-1]
-    mask = torch.zeros(shape)
     if d_s==0 or d_t==0:
-        return mask
-    for t in range(T):
-        for h in range(H):
-            for w in range(W):
-                d_square = (((d_s/d_t)*(2*t/T-1))**2 + (2*h/H-1)**2 + (2*w/W-1)**2)
-                mask[..., t,h,w] = math.exp(-1/(2*d_s**2) * d_square)
-    return mask
+        return _expand_mask(torch.zeros(T, H, W), shape)
+    d_square = _get_freq_distance_square(shape, d_s, d_t)
+    mask = torch.exp(-1/(2*d_s**2) * d_square)
+    return _expand_mask(mask.float(), shape)
 
 
 def butterworth_low_pass_filter(shape, n=4, d_s=0.25, d_t=0.25):
@@ -87,15 +163,11 @@ def butterworth_low_pass_filter(shape, n=4, d_s=0.25, d_t=0.25):
         d_t: normalized stop frequency for temporal dimension (0.0-1.0)
     """
     T, H, W = shape[-3], shape[-2], shape[-1]
-    mask = torch.zeros(shape)
     if d_s==0 or d_t==0:
-        return mask
-    for t in range(T):
-        for h in range(H):
-            for w in range(W):
-                d_square = (((d_s/d_t)*(2*t/T-1))**2 + (2*h/H-1)**2 + (2*w/W-1)**2)
-                mask[..., t,h,w] = 1 / (1 + (d_square / d_s**2)**n)
-    return mask
+        return _expand_mask(torch.zeros(T, H, W), shape)
+    d_square = _get_freq_distance_square(shape, d_s, d_t)
+    mask = 1 / (1 + (d_square / d_s**2)**n)
+    return _expand_mask(mask.float(), shape)
 
 
 def ideal_low_pass_filter(shape, d_s=0.25, d_t=0.25):
@@ -108,15 +180,11 @@ def ideal_low_pass_filter(shape, d_s=0.25, d_t=0.25):
         d_t: normalized stop frequency for temporal dimension (0.0-1.0)
     """
     T, H, W = shape[-3], shape[-2], shape[-1]
-    mask = torch.zeros(shape)
     if d_s==0 or d_t==0:
-        return mask
-    for t in range(T):
-        for h in range(H):
-            for w in range(W):
-                d_square = (((d_s/d_t)*(2*t/T-1))**2 + (2*h/H-1)**2 + (2*w/W-1)**2)
-                mask[..., t,h,w] =  1 if d_square <= d_s*2 else 0
-    return mask
+        return _expand_mask(torch.zeros(T, H, W), shape)
+    d_square = _get_freq_distance_square(shape, d_s, d_t)
+    mask = (d_square <= d_s*2).float()
+    return _expand_mask(mask, shape)
 
 
 def box_low_pass_filter(shape, d_s=0.25, d_t=0.25):
@@ -129,14 +197,14 @@ def box_low_pass_filter(shape, d_s=0.25, d_t=0.25):
         d_t: normalized stop frequency for temporal dimension (0.0-1.0)
     """
     T, H, W = shape[-3], shape[-2], shape[-1]
-    mask = torch.zeros(shape)
+    mask = torch.zeros(T, H, W)
     if d_s==0 or d_t==0:
-        return mask
+        return _expand_mask(mask, shape)
 
     threshold_s = round(int(H // 2) * d_s)
     threshold_t = round(T // 2 * d_t)
 
     cframe, crow, ccol = T // 2, H // 2, W //2
-    mask[..., cframe - threshold_t:cframe + threshold_t, crow - threshold_s:crow + threshold_s, ccol - threshold_s:ccol + threshold_s] = 1.0
+    mask[cframe - threshold_t:cframe + threshold_t, crow - threshold_s:crow + threshold_s, ccol - threshold_s:ccol + threshold_s] = 1.0
 
-    return mask
\ No newline at end of file
+    return _expand_mask(mask, shape)
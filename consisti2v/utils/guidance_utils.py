@@ -0,0 +1,62 @@
+import math
+
+
+# number of UNet branches run per step for each classifier-free guidance mode
+GUIDANCE_BRANCHES = {None: 1, "text": 2, "both": 3}
+
+
+def get_guidance_mode(guidance_scale_txt, guidance_scale_img):
+    """
+    Classifier-free guidance mode for the given scales: None (conditional branch only), "text"
+    (uncond / text) or "both" (uncond / image / text+image).
+    """
+    guidance_mode = None
+    if guidance_scale_txt > 1.0:
+        guidance_mode = "text"
+    if guidance_scale_img > 1.0:
+        guidance_mode = "both"
+    return guidance_mode
+
+
+def get_guidance_scale_schedule(guidance_scale, num_inference_steps, schedule="constant", cfg_cutoff=1.0):
+    """
+    Compute the guidance scale for every denoising step.
+
+    Args:
+        guidance_scale: guidance scale at the first step
+        num_inference_steps: number of denoising steps
+        schedule: "constant", "linear" or "cosine" decay from `guidance_scale` towards 1, or a list of
+            per-step weights w so that the scale is 1 + (guidance_scale - 1) * w
+        cfg_cutoff: fraction of the steps after which guidance is disabled (scale 1)
+    """
+    if isinstance(schedule, str):
+        if schedule == "constant":
+            weights = [1.0] * num_inference_steps
+        elif schedule == "linear":
+            weights = [1.0 - i / num_inference_steps for i in range(num_inference_steps)]
+        elif schedule == "cosine":
+            weights = [0.5 * (1.0 + math.cos(math.pi * i / num_inference_steps)) for i in range(num_inference_steps)]
+        else:
+            raise ValueError(f"Unknown guidance schedule: {schedule}")
+    else:
+        weights = [float(w) for w in schedule]
+        if len(weights) != num_inference_steps:
+            raise ValueError(
+                f"The guidance schedule has {len(weights)} entries, but {num_inference_steps} inference steps were requested."
+            )
+
+    cutoff_step = round(cfg_cutoff * num_inference_steps)
+    return [1.0 + (guidance_scale - 1.0) * w if i < cutoff_step else 1.0 for i, w in enumerate(weights)]
+
+
+def select_guidance_branches(inputs, guidance_mode, step_guidance_mode):
+    """
+    Slice the batch of `inputs`, laid out as the `guidance_mode` branches ([uncond, text] or
+    [uncond, img, both]), down to the branches needed by `step_guidance_mode`. The trailing branches are
+    kept, so the result is a view.
+    """
+    num_branches = GUIDANCE_BRANCHES[guidance_mode]
+    num_step_branches = GUIDANCE_BRANCHES[step_guidance_mode]
+    if num_step_branches > num_branches:
+        raise ValueError(f"Cannot run {step_guidance_mode} guidance on inputs prepared for {guidance_mode} guidance.")
+    return inputs[(num_branches - num_step_branches) * (inputs.shape[0] // num_branches):]
@@ -0,0 +1,58 @@
+import math
+
+import torch
+
+
+NOISE_SAMPLING_METHODS = ("vanilla", "pyoco_mixed", "pyoco_progressive")
+
+
+def randn(shape, generator=None, device=None, dtype=None):
+    """
+    `torch.randn` that also takes a list of generators, one per batch item. Every item is drawn into its
+    slice of a single tensor, which consumes each generator exactly like a separate `torch.randn` call for
+    that item.
+    """
+    if not isinstance(generator, list):
+        return torch.randn(shape, generator=generator, device=device, dtype=dtype)
+    if len(generator) != shape[0]:
+        raise ValueError(f"Got {len(generator)} generators for a batch size of {shape[0]}")
+    noise = torch.empty(shape, device=device, dtype=dtype)
+    for i, item_generator in enumerate(generator):
+        torch.randn((1,) + tuple(shape[1:]), generator=item_generator, device=device, dtype=dtype, out=noise[i:i + 1])
+    return noise
+
+
+def sample_noise(shape, noise_sampling_method="vanilla", noise_alpha=1.0, generator=None, device=None, dtype=None):
+    """
+    Samples video noise of `shape` (b, c, f, h, w).
+
+    - "vanilla": i.i.d. gaussian noise
+    - "pyoco_mixed": noise shared by all frames plus per-frame noise (PYoCo mixed noise)
+    - "pyoco_progressive": every frame is the previous frame scaled by sqrt(alpha^2 / (1 + alpha^2)) plus new
+      noise (PYoCo progressive noise). The recurrence is evaluated frame by frame over the whole batch, written
+      in place, since a closed form (a matmul or cumulative sum over frames) rounds differently.
+
+    The random draws and the arithmetic are the same as the previous per-method implementations, so a given
+    generator state yields bit-identical noise.
+
+    Args:
+        generator: None, a `torch.Generator` or a list of generators, one per batch item
+    """
+    noise_alpha_squared = noise_alpha ** 2
+    if noise_sampling_method == "vanilla":
+        return randn(shape, generator=generator, device=device, dtype=dtype)
+    elif noise_sampling_method == "pyoco_mixed":
+        base_shape = tuple(shape[:2]) + (1,) + tuple(shape[3:])
+        base_noise = randn(base_shape, generator=generator, device=device, dtype=dtype) * math.sqrt(noise_alpha_squared / (1 + noise_alpha_squared))
+        ind_noise = randn(shape, generator=generator, device=device, dtype=dtype) * math.sqrt(1 / (1 + noise_alpha_squared))
+        return base_noise + ind_noise
+    elif noise_sampling_method == "pyoco_progressive":
+        decay = math.sqrt(noise_alpha_squared / (1 + noise_alpha_squared))
+        noise = randn(shape, generator=generator, device=device, dtype=dtype)
+        ind_noise = randn(shape, generator=generator, device=device, dtype=dtype) * math.sqrt(1 / (1 + noise_alpha_squared))
+        # the multiplication and the addition are rounded separately, as in `noise[:, :, j - 1] * decay + ind_noise[:, :, j]`
+        for j in range(1, shape[2]):
+            torch.mul(noise[:, :, j - 1], decay, out=noise[:, :, j])
+            noise[:, :, j] += ind_noise[:, :, j]
+        return noise
+    raise ValueError(f"Unknown noise sampling method {noise_sampling_method}")
@@ -0,0 +1,72 @@
+import torch
+from diffusers.utils import logging
+
+
+logger = logging.get_logger(__name__)  # pylint: disable=invalid-name
+
+# VAE decode chunking: fraction of free device memory to spend on decoder activations, rough number of
+# full-resolution activations alive per frame, and the chunk size used when memory cannot be queried
+DECODE_MEMORY_FRACTION = 0.5
+DECODE_ACTIVATION_FACTOR = 4
+DEFAULT_DECODE_CHUNK_SIZE = 8
+
+
+def get_decode_chunk_size(vae, latents, vae_scale_factor):
+    """
+    Number of frames `vae` can decode at once within the free device memory, for (n, c, h, w) `latents`.
+    """
+    if latents.device.type != "cuda":
+        return DEFAULT_DECODE_CHUNK_SIZE
+    free_memory, _ = torch.cuda.mem_get_info(latents.device)
+    height = latents.shape[-2] * vae_scale_factor
+    width = latents.shape[-1] * vae_scale_factor
+    # the decoder peaks at full resolution, upper bound the width there by the widest block
+    channels = max(vae.config.block_out_channels)
+    bytes_per_frame = DECODE_ACTIVATION_FACTOR * channels * height * width * latents.element_size()
+    return max(1, int(free_memory * DECODE_MEMORY_FRACTION) // bytes_per_frame)
+
+
+def encode_text(tokenizer, text_encoder, text_embedding_cache, texts, device, max_length):
+    """
+    Text encoder outputs for a list of texts, only running the text encoder on the texts missing from
+    `text_embedding_cache` (a `TextEmbeddingCache`). The empty text is pinned in the cache.
+    """
+    keys = [(tokenizer.name_or_path, text, max_length, text_encoder.dtype, device) for text in texts]
+    embeddings = {key: text_embedding_cache.get(key) for key in dict.fromkeys(keys)}
+    missing_keys = [key for key, embedding in embeddings.items() if embedding is None]
+
+    if len(missing_keys) > 0:
+        missing_texts = [key[1] for key in missing_keys]
+        text_inputs = tokenizer(
+            missing_texts,
+            padding="max_length",
+            max_length=max_length,
+            truncation=True,
+            return_tensors="pt",
+        )
+        text_input_ids = text_inputs.input_ids
+        untruncated_ids = tokenizer(missing_texts, padding="longest", return_tensors="pt").input_ids
+
+        if untruncated_ids.shape[-1] >= text_input_ids.shape[-1] and not torch.equal(text_input_ids, untruncated_ids):
+            removed_text = tokenizer.batch_decode(untruncated_ids[:, max_length - 1 : -1])
+            logger.warning(
+                "The following part of your input was truncated because CLIP can only handle sequences up to"
+                f" {max_length} tokens: {removed_text}"
+            )
+
+        if hasattr(text_encoder.config, "use_attention_mask") and text_encoder.config.use_attention_mask:
+            attention_mask = text_inputs.attention_mask.to(device)
+        else:
+            attention_mask = None
+
+        text_embeddings = text_encoder(
+            text_input_ids.to(device),
+            attention_mask=attention_mask,
+        )
+        text_embeddings = text_embeddings[0]
+
+        for key, embedding in zip(missing_keys, text_embeddings):
+            text_embedding_cache.put(key, embedding, pin=key[1] == "")
+            embeddings[key] = embedding
+
+    return torch.stack([embeddings[key] for key in keys])
@@ -39,6 +39,41 @@ def save_videos_grid(videos: torch.Tensor, path: str, rescale=False, n_rows=6, f
     elif format == "mp4":
         torchvision.io.write_video(path, np.array(outputs), fps=fps, video_codec='h264', options={'crf': '10'})
 
+
+def save_videos_stream(frames, path: str, fps=8, format="mp4"):
+    """
+    Write uint8 frame chunks of shape (n, h, w, 3), e.g. from `pipeline.stream(...)`, to a video file as
+    they arrive, without holding the whole video in memory. Encoding settings match `save_videos_grid`.
+    """
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    if format == "gif":
+        with imageio.get_writer(path, mode="I", fps=fps) as writer:
+            for chunk in frames:
+                for frame in chunk:
+                    writer.append_data(frame)
+    elif format == "mp4":
+        import av
+
+        with av.open(path, mode="w") as container:
+            stream = None
+            for chunk in frames:
+                for frame in chunk:
+                    if stream is None:
+                        stream = container.add_stream("h264", rate=fps)
+                        stream.height, stream.width = frame.shape[0], frame.shape[1]
+                        stream.pix_fmt = "yuv420p"
+                        stream.options = {"crf": "10"}
+                    frame = av.VideoFrame.from_ndarray(frame, format="rgb24")
+                    frame.pict_type = "NONE"
+                    for packet in stream.encode(frame):
+                        container.mux(packet)
+            if stream is not None:
+                for packet in stream.encode():
+                    container.mux(packet)
+    else:
+        raise ValueError(f"Unsupported format: {format}")
+
 # DDIM Inversion
 @torch.no_grad()
 def init_prompt(prompt, pipeline):
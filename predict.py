@@ -14,7 +14,7 @@ from consisti2v.models.videoldm_unet import VideoLDMUNet3DConditionModel
 from consisti2v.pipelines.pipeline_conditional_animation import (
     ConditionalAnimationPipeline,
 )
-from consisti2v.utils.util import save_videos_grid
+from consisti2v.utils.util import save_videos_stream
 
 
 URL = {
@@ -104,6 +104,9 @@ class Predictor(BasePredictor):
         image_guidance_scale: float = Input(
             description="Scale for classifier-free guidance from the image", default=1.0
         ),
+        num_frames: int = Input(
+            description="Number of frames to generate, including the input image", ge=2, le=32, default=16
+        ),
         seed: int = Input(
             description="Random seed. Leave blank to randomize the seed", default=None
         ),
@@ -118,20 +121,21 @@ class Predictor(BasePredictor):
             self.pipeline.init_filter(
                 width=self.config.sampling_kwargs.width,
                 height=self.config.sampling_kwargs.height,
-                video_length=self.config.sampling_kwargs.n_frames,
+                video_length=num_frames,
                 filter_params=self.config.frameinit_kwargs.filter_params,
+                freq_mix_mode=self.config.frameinit_kwargs.get("freq_mix_mode", "fft"),
             )
 
-        sample = self.pipeline(
+        frames = self.pipeline.stream(
             prompt,
             negative_prompt=negative_prompt,
             first_frame_paths=str(image),
             num_inference_steps=num_inference_steps,
             guidance_scale_txt=text_guidance_scale,
             guidance_scale_img=image_guidance_scale,
-            width=self.config.sampling_kwargs.width,  # output video only supports 16 frames of 256x256
+            width=self.config.sampling_kwargs.width,  # output video only supports 256x256
             height=self.config.sampling_kwargs.height,
-            video_length=self.config.sampling_kwargs.n_frames,
+            video_length=num_frames,
             noise_sampling_method=self.config.unet_additional_kwargs[
                 "noise_sampling_method"
             ],
@@ -139,13 +143,15 @@ class Predictor(BasePredictor):
             eta=self.config.sampling_kwargs.ddim_eta,
             frame_stride=self.config.sampling_kwargs.frame_stride,
             guidance_rescale=self.config.sampling_kwargs.guidance_rescale,
+            guidance_schedule=self.config.sampling_kwargs.get("guidance_schedule", "constant"),
+            cfg_cutoff=self.config.sampling_kwargs.get("cfg_cutoff", 1.0),
             num_videos_per_prompt=self.config.sampling_kwargs.num_videos_per_prompt,
             use_frameinit=self.config.frameinit_kwargs.enable,
             frameinit_noise_level=self.config.frameinit_kwargs.noise_level,
             camera_motion=self.config.frameinit_kwargs.camera_motion,
-        ).videos
+        )
         out_path = "/tmp/out.mp4"
-        save_videos_grid(sample, out_path, format="mp4")
+        save_videos_stream(frames, out_path, format="mp4")
         return Path(out_path)
 
 
@@ -91,6 +91,7 @@ def main(args, config):
             height        = config.sampling_kwargs.height,
             video_length  = config.sampling_kwargs.n_frames,
             filter_params = config.frameinit_kwargs.filter_params,
+            freq_mix_mode = config.frameinit_kwargs.get("freq_mix_mode", "fft"),
         )
     # -------------------------------------------------------------------------------
     ### <<< create validation pipeline <<< ###
@@ -137,6 +138,9 @@ def main(args, config):
             eta                   = config.sampling_kwargs.ddim_eta,
             frame_stride          = config.sampling_kwargs.frame_stride,
             guidance_rescale      = config.sampling_kwargs.guidance_rescale,
+            guidance_schedule     = config.sampling_kwargs.get("guidance_schedule", "constant"),
+            cfg_cutoff            = config.sampling_kwargs.get("cfg_cutoff", 1.0),
+            cache_first_frame_features = config.sampling_kwargs.get("cache_first_frame_features", False),
             num_videos_per_prompt = config.sampling_kwargs.num_videos_per_prompt,
             autoregress_steps     = config.sampling_kwargs.autoregress_steps,
             use_frameinit          = config.frameinit_kwargs.enable,
@@ -0,0 +1,80 @@
+import argparse
+
+import torch
+from torch.utils.flop_counter import FlopCounterMode
+
+from consisti2v.models.videoldm_unet import VideoLDMUNet3DConditionModel
+from scripts.benchmark_utils import benchmark
+
+
+def count_flops(fn):
+    with FlopCounterMode(display=False) as flop_counter:
+        fn()
+    return flop_counter.get_total_flops()
+
+
+def main(args):
+    device = torch.device(args.device)
+    dtype = getattr(torch, args.dtype)
+
+    for mode in args.modes:
+        torch.manual_seed(args.seed)
+        unet = VideoLDMUNet3DConditionModel(
+            block_out_channels=tuple(args.block_out_channels),
+            attention_head_dim=tuple(args.attention_head_dim),
+            cross_attention_dim=args.cross_attention_dim,
+            n_frames=args.n_frames,
+            first_frame_condition_mode=mode,
+            augment_temporal_attention=True,
+            temp_pos_embedding="rotary",
+            use_frame_stride_condition=True,
+        ).to(device, dtype).eval()
+
+        generator = torch.Generator().manual_seed(args.seed)
+        latent_size = (args.height // 8, args.width // 8)
+        sample = torch.randn(args.batch_size, 4, args.n_frames - 1, *latent_size, generator=generator).to(device, dtype)
+        first_frame_latents = torch.randn(args.batch_size, 4, 1, *latent_size, generator=generator).to(device, dtype)
+        text_embeddings = torch.randn(args.batch_size, 77, args.cross_attention_dim, generator=generator).to(device, dtype)
+
+        def step(timestep=500):
+            return unet(sample, timestep, text_embeddings, first_frame_latents=first_frame_latents, frame_stride=3).sample
+
+        with torch.no_grad():
+            reference = step()
+            uncached_flops = count_flops(step)
+            uncached_ms = benchmark(step, args.n_iters, device)
+
+            with unet.cache_first_frame_features() as first_frame_cache:
+                # the first step fills the cache, later steps only differ in the timestep
+                step(999)
+                output = step()
+                cached_flops = count_flops(step)
+                cached_ms = benchmark(step, args.n_iters, device)
+                stats = first_frame_cache.get_stats()
+
+        max_diff = (reference.float() - output.float()).abs().max().item()
+        saved_flops = uncached_flops - cached_flops
+        print(
+            f"{mode:8s} max_abs_diff={max_diff:.3e} flops/step uncached={uncached_flops / 1e9:.2f}G "
+            f"cached={cached_flops / 1e9:.2f}G saved={saved_flops / 1e9:.3f}G ({100 * saved_flops / uncached_flops:.2f}%) "
+            f"uncached={uncached_ms:.1f}ms cached={cached_ms:.1f}ms cache_stats={stats}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--dtype", type=str, default="float32", choices=["float32", "float16", "bfloat16"])
+    parser.add_argument("--modes", type=str, nargs="+", default=["concat", "conv2d"])
+    parser.add_argument("--block_out_channels", type=int, nargs="+", default=[320, 640, 1280, 1280])
+    parser.add_argument("--attention_head_dim", type=int, nargs="+", default=[5, 10, 20, 20])
+    parser.add_argument("--cross_attention_dim", type=int, default=1024)
+    parser.add_argument("--batch_size", type=int, default=2)
+    parser.add_argument("--n_frames", type=int, default=16, help="number of frames including the first frame")
+    parser.add_argument("--height", type=int, default=256)
+    parser.add_argument("--width", type=int, default=256)
+    parser.add_argument("--n_iters", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    main(args)
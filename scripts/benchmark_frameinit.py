@@ -0,0 +1,56 @@
+import argparse
+
+import torch
+
+from consisti2v.utils.frameinit_utils import get_freq_filter, freq_mix_3d, freq_mix_3d_rfft
+from scripts.benchmark_utils import benchmark
+
+
+def main(args):
+    device = torch.device(args.device)
+    shape = (args.batch_size, args.channels, args.n_frames, args.height // 8, args.width // 8)
+    generator = torch.Generator().manual_seed(args.seed)
+    x = torch.randn(shape, generator=generator).to(device)
+    noise = torch.randn(shape, generator=generator).to(device)
+
+    for method in args.methods:
+        lpf = get_freq_filter(shape, device, method, args.n, args.d_s, args.d_t)
+        lpf_rfft = get_freq_filter(shape, device, method, args.n, args.d_s, args.d_t, rfft=True)
+
+        x_mixed = freq_mix_3d(x, noise, lpf)
+        x_mixed_rfft = freq_mix_3d_rfft(x, noise, lpf_rfft)
+        max_diff = (x_mixed - x_mixed_rfft).abs().max().item()
+        equivalent = torch.allclose(x_mixed, x_mixed_rfft, rtol=1e-5, atol=1e-5)
+
+        x_freq = torch.empty_like(torch.fft.rfftn(x, dim=(-3, -2, -1)))
+        noise_freq = torch.empty_like(x_freq)
+        out = torch.empty_like(x)
+        fft_ms = benchmark(lambda: freq_mix_3d(x, noise, lpf), args.n_iters, device)
+        rfft_ms = benchmark(
+            lambda: freq_mix_3d_rfft(x, noise, lpf_rfft, x_freq=x_freq, noise_freq=noise_freq, out=out),
+            args.n_iters,
+            device,
+        )
+        print(
+            f"{method:12s} shape={tuple(shape)} max_abs_diff={max_diff:.3e} equivalent={equivalent} "
+            f"fft={fft_ms:.3f}ms rfft={rfft_ms:.3f}ms speedup={fft_ms / rfft_ms:.2f}x"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--batch_size", type=int, default=1)
+    parser.add_argument("--channels", type=int, default=4)
+    parser.add_argument("--n_frames", type=int, default=16)
+    parser.add_argument("--height", type=int, default=256)
+    parser.add_argument("--width", type=int, default=256)
+    parser.add_argument("--methods", type=str, nargs="+", default=["gaussian", "butterworth", "ideal", "box"])
+    parser.add_argument("--n", type=int, default=4)
+    parser.add_argument("--d_s", type=float, default=0.25)
+    parser.add_argument("--d_t", type=float, default=0.25)
+    parser.add_argument("--n_iters", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    main(args)
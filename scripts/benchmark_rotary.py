@@ -0,0 +1,75 @@
+import argparse
+
+import torch
+
+from consisti2v.models.rotary_embedding import (
+    RotaryEmbedding,
+    apply_rotary_emb_cached,
+    get_compiled_rotation,
+    rotate_complex,
+    rotate_queries_and_keys_pairs,
+)
+from scripts.benchmark_utils import benchmark
+
+
+def rotate_uncached(rotary_emb, q, k, key_pad_len):
+    # the rotation before the table cache: positions, frequencies and cos / sin for every call
+    seq_pos = rotary_emb.get_seq_pos(q.shape[-2], q.device, q.dtype)
+    key_pos = torch.cat([seq_pos, torch.zeros(key_pad_len, device=q.device, dtype=q.dtype)])
+    return rotary_emb.rotate_queries_or_keys(q, seq_pos=seq_pos), rotary_emb.rotate_queries_or_keys(k, seq_pos=key_pos)
+
+
+def main(args):
+    device = torch.device(args.device)
+    dtype = getattr(torch, args.dtype)
+    latent_size = args.resolution // 8
+
+    # the (b * h * w, t, c) queries and (b * h * w, t + 8, c) keys of the augmented temporal self attention at
+    # every resolution of the UNet
+    for level, channels in enumerate(args.block_out_channels):
+        hw = (latent_size // 2 ** level) ** 2
+        rotary_emb = RotaryEmbedding(channels // 2).to(device)
+        q = torch.randn(args.batch_size * hw, args.n_frames, channels, device=device, dtype=dtype)
+        k = torch.randn(args.batch_size * hw, args.n_frames + args.key_pad_len, channels, device=device, dtype=dtype)
+        q_tables = rotary_emb.get_cos_sin(q.shape[-2], device, dtype)
+        k_tables = rotary_emb.get_cos_sin(k.shape[-2], device, dtype, pad_len=args.key_pad_len)
+
+        reference = rotate_uncached(rotary_emb, q, k, args.key_pad_len)
+        methods = {
+            "uncached": lambda: rotate_uncached(rotary_emb, q, k, args.key_pad_len),
+            "cached": lambda: (apply_rotary_emb_cached(*q_tables, q), apply_rotary_emb_cached(*k_tables, k)),
+        }
+        if dtype in (torch.float32, torch.float64):
+            q_rotation = rotary_emb.get_complex_rotation(q.shape[-2], device, dtype)
+            k_rotation = rotary_emb.get_complex_rotation(k.shape[-2], device, dtype, pad_len=args.key_pad_len)
+            methods["complex"] = lambda: (rotate_complex(q_rotation, q), rotate_complex(k_rotation, k))
+        if args.compile:
+            compiled = get_compiled_rotation(rotate_queries_and_keys_pairs)
+            methods["compiled"] = lambda: compiled(*q_tables, q, *k_tables, k)
+
+        # in half precision the compiled kernel rounds once while the reference rounds after every product
+        rtol, atol = (1e-5, 1e-5) if dtype == torch.float32 else (2e-2, 2e-2)
+        results = []
+        for name, fn in methods.items():
+            q_out, k_out = fn()
+            max_diff = max((reference[0] - q_out).abs().max().item(), (reference[1] - k_out).abs().max().item())
+            equivalent = all(torch.allclose(out.float(), ref.float(), rtol=rtol, atol=atol) for out, ref in zip((q_out, k_out), reference))
+            ms = benchmark(fn, args.n_iters, device)
+            results.append(f"{name}={ms:.3f}ms (max_abs_diff={max_diff:.1e} equivalent={equivalent})")
+        print(f"q={tuple(q.shape)} k={tuple(k.shape)} " + " ".join(results))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--dtype", type=str, default="float32", choices=["float32", "float16", "bfloat16"])
+    parser.add_argument("--batch_size", type=int, default=2)
+    parser.add_argument("--n_frames", type=int, default=16)
+    parser.add_argument("--resolution", type=int, default=256)
+    parser.add_argument("--block_out_channels", type=int, nargs="+", default=[320, 640, 1280, 1280])
+    parser.add_argument("--key_pad_len", type=int, default=8, help="first frame neighbors appended to the keys")
+    parser.add_argument("--compile", action="store_true", help="also benchmark the torch.compile'd rotation")
+    parser.add_argument("--n_iters", type=int, default=20)
+    args = parser.parse_args()
+
+    main(args)
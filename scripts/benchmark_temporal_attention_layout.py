@@ -0,0 +1,125 @@
+import argparse
+
+import torch
+from einops import rearrange
+from torch.utils._python_dispatch import TorchDispatchMode
+
+from consisti2v.models.videoldm_attention import TemporalConditionalAttention
+from consisti2v.models.videoldm_transformer_blocks import get_neighbor_index
+from scripts.benchmark_utils import benchmark
+
+
+COPY_OPS = {
+    torch.ops.aten.clone.default,
+    torch.ops.aten.copy_.default,
+    torch.ops.aten.cat.default,
+}
+
+
+class MemoryTrafficMode(TorchDispatchMode):
+    # bytes written by every op, and by the ops that only move data (layout copies and concatenations)
+    def __init__(self):
+        super().__init__()
+        self.written_bytes = 0
+        self.copied_bytes = 0
+        self.num_copies = 0
+
+    def __torch_dispatch__(self, func, types, args=(), kwargs=None):
+        out = func(*args, **(kwargs or {}))
+        outputs = [t for t in (out if isinstance(out, (tuple, list)) else (out,)) if isinstance(t, torch.Tensor)]
+        nbytes = sum(t.numel() * t.element_size() for t in outputs)
+        # views (outputs aliasing an input) do not write, in place ops do
+        is_view = any(r.alias_info is not None for r in func._schema.returns) and not func._schema.is_mutable
+        if not is_view:
+            self.written_bytes += nbytes
+        if func in COPY_OPS:
+            self.copied_bytes += nbytes
+            self.num_copies += 1
+        return out
+
+
+def temporal_attention_rearranged(attn, hidden_states, adjacent_slices, num_frames):
+    # the temporal attention before the (hw, b, t, c) layout: the frames are gathered into (b hw, t, c) sequences
+    # and the output is copied back to (b t, hw, c)
+    bt, hw, c = hidden_states.shape
+    kwargs = {}
+    hidden_states = rearrange(hidden_states, '(b t) hw c -> b hw t c', t=num_frames)
+    if not attn.use_rotary_emb:
+        pos_embed = attn.pos_enc(num_frames)
+        hidden_states = hidden_states + pos_embed
+    hidden_states = rearrange(hidden_states, 'b hw t c -> (b hw) t c')
+    encoder_hidden_states = None
+    if adjacent_slices is not None:
+        if not attn.use_rotary_emb:
+            adjacent_slices = adjacent_slices + pos_embed[0:1, :]
+        else:
+            kwargs["key_pad_len"] = adjacent_slices.shape[2]
+        adjacent_slices = rearrange(adjacent_slices, 'b hw n c -> (b hw) n c')
+        encoder_hidden_states = torch.cat([hidden_states, adjacent_slices], dim=1)
+    out = attn.processor(attn, hidden_states, encoder_hidden_states=encoder_hidden_states, **kwargs)
+    return rearrange(out, '(b hw) t c -> (b t) hw c', hw=hw)
+
+
+def main(args):
+    device = torch.device(args.device)
+    dtype = getattr(torch, args.dtype)
+    latent_size = args.resolution // 8
+
+    # the first temporal self attention of every resolution of the UNet, followed by its residual connection
+    for level, channels in enumerate(args.block_out_channels):
+        size = latent_size // 2 ** level
+        attn = TemporalConditionalAttention(
+            query_dim=channels,
+            heads=args.heads,
+            dim_head=channels // args.heads,
+            n_frames=args.n_frames,
+            rotary_emb=args.temp_pos_embedding == "rotary",
+        ).to(device, dtype).eval()
+
+        hidden_states = torch.randn(args.batch_size * args.n_frames, size * size, channels, device=device, dtype=dtype)
+        adjacent_slices = None
+        if args.augment_temporal_attention:
+            first_frame = hidden_states.view(args.batch_size, args.n_frames, size * size, channels)[:, 0]
+            adjacent_slices = first_frame.index_select(1, get_neighbor_index(size, size, device))
+            adjacent_slices = adjacent_slices.view(args.batch_size, size * size, 8, channels)
+
+        methods = {
+            "rearranged": lambda: hidden_states + temporal_attention_rearranged(attn, hidden_states, adjacent_slices, args.n_frames),
+            "strided": lambda: hidden_states + attn(hidden_states, adjacent_slices=adjacent_slices, num_frames=args.n_frames),
+        }
+
+        results = []
+        with torch.no_grad():
+            reference = methods["rearranged"]()
+            activation_bytes = hidden_states.numel() * hidden_states.element_size()
+            for name, fn in methods.items():
+                max_diff = (fn() - reference).abs().max().item()
+                with MemoryTrafficMode() as traffic:
+                    fn()
+                if device.type == "cuda":
+                    torch.cuda.reset_peak_memory_stats(device)
+                ms = benchmark(fn, args.n_iters, device)
+                peak = f" peak={torch.cuda.max_memory_allocated(device) / 2 ** 20:.0f}MiB" if device.type == "cuda" else ""
+                results.append(
+                    f"{name}={ms:.3f}ms copies={traffic.num_copies} copied={traffic.copied_bytes / activation_bytes:.2f}x "
+                    f"written={traffic.written_bytes / activation_bytes:.2f}x{peak} (max_abs_diff={max_diff:.1e})"
+                )
+        print(f"hidden_states={tuple(hidden_states.shape)} " + " ".join(results))
+    print("copied and written bytes are in multiples of the size of the hidden states")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--dtype", type=str, default="float32", choices=["float32", "float16", "bfloat16"])
+    parser.add_argument("--batch_size", type=int, default=2)
+    parser.add_argument("--n_frames", type=int, default=16)
+    parser.add_argument("--resolution", type=int, default=256)
+    parser.add_argument("--block_out_channels", type=int, nargs="+", default=[320, 640, 1280, 1280])
+    parser.add_argument("--heads", type=int, default=8)
+    parser.add_argument("--temp_pos_embedding", type=str, default="rotary", choices=["rotary", "sinusoidal"])
+    parser.add_argument("--augment_temporal_attention", action="store_true", help="also attend to the first frame neighbors")
+    parser.add_argument("--n_iters", type=int, default=20)
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,61 @@
+import argparse
+
+import torch
+
+from consisti2v.models.videoldm_unet_blocks import Conv3DLayer, TemporalResnetBlock
+from scripts.benchmark_utils import benchmark
+
+
+def set_matmul(module, enabled):
+    for submodule in module.modules():
+        if isinstance(submodule, Conv3DLayer):
+            submodule.use_matmul = enabled
+
+
+def main(args):
+    device = torch.device(args.device)
+    dtype = getattr(torch, args.dtype)
+    latent_size = args.resolution // 8
+
+    # the temporal resnet of every resolution of the UNet, with its two (3, 1, 1) convolutions
+    for level, channels in enumerate(args.block_out_channels):
+        size = latent_size // 2 ** level
+        resnet = TemporalResnetBlock(in_channels=channels, out_channels=channels, n_frames=args.n_frames).to(device, dtype).eval()
+        # alpha is initialized to 1, which skips the temporal convolutions in the output
+        resnet.alpha.data.fill_(0.5)
+        hidden_states = torch.randn(args.batch_size * args.n_frames, channels, size, size, device=device, dtype=dtype)
+
+        results = []
+        with torch.no_grad():
+            set_matmul(resnet, False)
+            reference = resnet(hidden_states)
+            for memory_format in args.memory_formats:
+                x = hidden_states.contiguous(memory_format=getattr(torch, memory_format))
+                for use_matmul in (False, True):
+                    set_matmul(resnet, use_matmul)
+                    name = f"{memory_format}/{'matmul' if use_matmul else 'conv3d'}"
+                    max_diff = (resnet(x).float() - reference.float()).abs().max().item()
+                    if device.type == "cuda":
+                        torch.cuda.reset_peak_memory_stats(device)
+                    ms = benchmark(lambda: resnet(x), args.n_iters, device)
+                    peak = f" peak={torch.cuda.max_memory_allocated(device) / 2 ** 20:.0f}MiB" if device.type == "cuda" else ""
+                    results.append(f"{name}={ms:.3f}ms{peak} (max_abs_diff={max_diff:.1e})")
+        print(f"hidden_states={tuple(hidden_states.shape)} " + " ".join(results))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--dtype", type=str, default="float32", choices=["float32", "float16", "bfloat16"])
+    parser.add_argument("--batch_size", type=int, default=2)
+    parser.add_argument("--n_frames", type=int, default=16)
+    parser.add_argument("--resolution", type=int, default=256)
+    parser.add_argument("--block_out_channels", type=int, nargs="+", default=[320, 640, 1280, 1280])
+    parser.add_argument(
+        "--memory_formats", type=str, nargs="+", default=["contiguous_format", "channels_last"],
+        choices=["contiguous_format", "channels_last"]
+    )
+    parser.add_argument("--n_iters", type=int, default=10)
+    args = parser.parse_args()
+
+    main(args)
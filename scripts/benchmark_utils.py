@@ -0,0 +1,19 @@
+import time
+
+import torch
+
+
+def benchmark(fn, n_iters, device):
+    """
+    Average wall time of `fn()` in milliseconds over `n_iters` calls, after one warmup call. CUDA work is
+    synchronized before the timer starts and stops.
+    """
+    fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(n_iters):
+        fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / n_iters * 1000
@@ -0,0 +1,76 @@
+import argparse
+import json
+import logging
+import os
+from multiprocessing import Pool
+
+import numpy as np
+from decord import VideoReader
+from tqdm.auto import tqdm
+
+from consisti2v.data.video_utils import VideoIndex, get_video_index_path
+
+logger = logging.getLogger(__name__)
+
+
+def get_video_path(video_folder, video_relative_path):
+    # same path resolution as the datasets in consisti2v/data/dataset.py
+    if video_folder is not None:
+        if video_relative_path[0] == '/':
+            return os.path.join(video_folder, os.path.basename(video_relative_path))
+        return os.path.join(video_folder, video_relative_path)
+    return video_relative_path
+
+
+def probe_video(args):
+    file, video_path = args
+    try:
+        video_reader = VideoReader(video_path)
+        height, width, _ = video_reader[0].shape
+        return file, len(video_reader), height, width, video_reader.get_avg_fps(), np.asarray(video_reader.get_key_indices(), dtype=np.int32)
+    except Exception as e:
+        logger.warning(f"failed to index {video_path}: {e}")
+        return None
+
+
+def main(args):
+    logger.info(f"loading annotations from {args.json_path} ...")
+    with open(args.json_path, 'rb') as json_file:
+        files = [json.loads(json_str)['file'] for json_str in json_file]
+    files = list(dict.fromkeys(files))
+
+    tasks = [(file, get_video_path(args.video_folder, file)) for file in files]
+    with Pool(args.num_workers) as pool:
+        results = [result for result in tqdm(pool.imap(probe_video, tasks, chunksize=64), total=len(tasks)) if result is not None]
+
+    keyframes = [result[5] for result in results]
+    video_index = VideoIndex.from_files(
+        files=[result[0] for result in results],
+        num_frames=np.array([result[1] for result in results], dtype=np.int32),
+        heights=np.array([result[2] for result in results], dtype=np.int32),
+        widths=np.array([result[3] for result in results], dtype=np.int32),
+        fps=np.array([result[4] for result in results], dtype=np.float32),
+        keyframes=np.concatenate(keyframes) if len(keyframes) > 0 else np.zeros(0, dtype=np.int32),
+        keyframe_offsets=np.cumsum([0] + [len(k) for k in keyframes]).astype(np.int64),
+    )
+
+    output_path = args.output_path or get_video_index_path(args.json_path)
+    video_index.save(output_path)
+    logger.info(f"indexed {len(video_index)} of {len(files)} videos, saved to {output_path}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--json_path", type=str, required=True)
+    parser.add_argument("--video_folder", type=str, default=None)
+    parser.add_argument("--output_path", type=str, default=None, help="defaults to <json_path>.index.npz")
+    parser.add_argument("--num_workers", type=int, default=16)
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
+        datefmt="%m/%d/%Y %H:%M:%S",
+        level=logging.INFO,
+    )
+
+    main(args)
@@ -0,0 +1,220 @@
+import argparse
+import json
+import logging
+import os
+
+import numpy as np
+from einops import rearrange
+from omegaconf import OmegaConf
+from tqdm.auto import tqdm
+
+import torch
+
+from diffusers import AutoencoderKL
+from transformers import CLIPTextModel, CLIPTokenizer
+
+from consisti2v.data.dataset import WebVid10M, Pexels, JointDataset
+from consisti2v.data.video_utils import normalize_pixel_values
+
+logger = logging.getLogger(__name__)
+
+
+def get_dataset(train_data):
+    # same dataset setup as in train.py
+    if train_data.dataset == "pexels":
+        train_data.sample_n_frames = train_data.sample_duration * train_data.sample_fps
+    elif train_data.dataset == "joint":
+        if train_data.sample_duration is not None:
+            train_data.sample_n_frames = train_data.sample_duration * train_data.sample_fps
+
+    if train_data.dataset == "webvid":
+        return WebVid10M(**train_data)
+    elif train_data.dataset == "pexels":
+        return Pexels(**train_data)
+    elif train_data.dataset == "joint":
+        return JointDataset(**train_data)
+    raise ValueError(f"Unknown dataset {train_data.dataset}")
+
+
+class ShardWriter:
+    """
+    Writes samples into shards of `shard_size` samples. Every shard is a set of .npy files, one per field,
+    that `LatentDataset` memory-maps.
+    """
+
+    def __init__(self, output_dir, prefix, shard_size, shapes, dtypes):
+        self.output_dir = output_dir
+        self.prefix = prefix
+        self.shard_size = shard_size
+        self.shapes = shapes
+        self.dtypes = dtypes
+        self.shards = []
+        self._arrays = None
+        self._num_samples = 0
+
+    def _open_shard(self):
+        shard_name = f"{self.prefix}-{len(self.shards):05d}"
+        self._arrays = {
+            field: np.lib.format.open_memmap(
+                os.path.join(self.output_dir, f"{shard_name}.{field}.npy"),
+                mode="w+",
+                dtype=self.dtypes[field],
+                shape=(self.shard_size,) + tuple(shape),
+            )
+            for field, shape in self.shapes.items()
+        }
+        self.shards.append({"name": shard_name, "num_samples": 0})
+        self._num_samples = 0
+
+    def write(self, batch):
+        batch_size = len(next(iter(batch.values())))
+        start = 0
+        while start < batch_size:
+            if self._arrays is None or self._num_samples == self.shard_size:
+                self.flush()
+                self._open_shard()
+            n = min(batch_size - start, self.shard_size - self._num_samples)
+            for field, values in batch.items():
+                self._arrays[field][self._num_samples:self._num_samples + n] = values[start:start + n]
+            self._num_samples += n
+            self.shards[-1]["num_samples"] = self._num_samples
+            start += n
+
+    def flush(self):
+        if self._arrays is not None:
+            for array in self._arrays.values():
+                array.flush()
+            self._arrays = None
+
+
+@torch.no_grad()
+def main(args):
+    config = OmegaConf.load(args.config)
+    if args.optional_args:
+        config = OmegaConf.merge(config, OmegaConf.from_dotlist(args.optional_args))
+    train_data = config.train_data
+    use_frame_stride_condition = config.get("unet_additional_kwargs", {}).get("use_frame_stride_condition", False)
+
+    device = torch.device(args.device)
+    dtype = torch.float16 if args.half else torch.float32
+    vae = AutoencoderKL.from_pretrained(config.pretrained_model_path, subfolder="vae").to(device, dtype=dtype)
+    tokenizer = CLIPTokenizer.from_pretrained(config.pretrained_model_path, subfolder="tokenizer")
+    text_encoder = CLIPTextModel.from_pretrained(config.pretrained_model_path, subfolder="text_encoder").to(device, dtype=dtype)
+
+    def encode_text(texts):
+        prompt_ids = tokenizer(
+            texts, max_length=tokenizer.model_max_length, padding="max_length", truncation=True, return_tensors="pt"
+        ).input_ids.to(device)
+        return text_encoder(prompt_ids)[0]
+
+    dataset = get_dataset(train_data)
+    indices = list(range(args.part, len(dataset), args.num_parts))
+    if args.max_samples is not None:
+        indices = indices[:args.max_samples]
+    dataloader = torch.utils.data.DataLoader(
+        torch.utils.data.Subset(dataset, indices),
+        batch_size=args.batch_size,
+        shuffle=False,
+        num_workers=args.num_workers,
+    )
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    if args.num_parts == 1:
+        index_name, prefix = "index", "shard"
+    else:
+        index_name = f"index-{args.part:05d}-of-{args.num_parts:05d}"
+        prefix = f"shard-{args.part:05d}"
+
+    null_text_embeds = encode_text([""])[0].cpu().numpy().astype(args.storage_dtype)
+    np.save(os.path.join(args.output_dir, "null_text_embeds.npy"), null_text_embeds)
+
+    writer = None
+    for _ in range(args.num_clips_per_video):
+        for batch in tqdm(dataloader):
+            pixel_values = normalize_pixel_values(batch["pixel_values"].to(device), dtype)
+            video_length = pixel_values.shape[1]
+            pixel_values = rearrange(pixel_values, "b f c h w -> (b f) c h w")
+            latent_dist = vae.encode(pixel_values).latent_dist
+            latent_mean = rearrange(latent_dist.mean, "(b f) c h w -> b c f h w", f=video_length)
+            latent_std = rearrange(latent_dist.std, "(b f) c h w -> b c f h w", f=video_length)
+            text_embeds = encode_text(batch["text"])
+
+            # frame stride conditioning, -1 if the dataset does not sample with a fixed stride
+            if "stride" in batch:
+                stride = batch["stride"]
+            elif use_frame_stride_condition:
+                raise ValueError(
+                    f"{train_data.dataset} does not return a frame stride, which the config conditions on "
+                    "(unet_additional_kwargs.use_frame_stride_condition)"
+                )
+            else:
+                stride = torch.full((len(batch["text"]),), -1)
+
+            if writer is None:
+                writer = ShardWriter(
+                    args.output_dir,
+                    prefix,
+                    args.shard_size,
+                    shapes={
+                        "latent_mean": latent_mean.shape[1:],
+                        "latent_std": latent_std.shape[1:],
+                        "text_embeds": text_embeds.shape[1:],
+                        "stride": (),
+                    },
+                    dtypes={
+                        "latent_mean": args.storage_dtype,
+                        "latent_std": args.storage_dtype,
+                        "text_embeds": args.storage_dtype,
+                        "stride": "int16",
+                    },
+                )
+            writer.write({
+                "latent_mean": latent_mean.cpu().numpy(),
+                "latent_std": latent_std.cpu().numpy(),
+                "text_embeds": text_embeds.cpu().numpy(),
+                "stride": stride.numpy(),
+            })
+    if writer is None:
+        raise ValueError(
+            f"No samples to latentize: part {args.part} of {args.num_parts} of {train_data.dataset} "
+            f"({len(dataset)} samples) is empty"
+        )
+    writer.flush()
+
+    index = {
+        "num_frames": train_data.sample_n_frames,
+        "latent_shape": list(writer.shapes["latent_mean"]),
+        "scaling_factor": vae.config.scaling_factor,
+        "pretrained_model_path": config.pretrained_model_path,
+        "null_text_embeds": "null_text_embeds.npy",
+        "shards": writer.shards,
+    }
+    with open(os.path.join(args.output_dir, f"{index_name}.json"), "w") as f:
+        json.dump(index, f, indent=2)
+    logger.info(f"wrote {sum(shard['num_samples'] for shard in writer.shards)} samples to {args.output_dir}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, default="configs/training/training.yaml")
+    parser.add_argument("--output_dir", type=str, required=True)
+    parser.add_argument("--device", type=str, default="cuda")
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--num_workers", type=int, default=8)
+    parser.add_argument("--shard_size", type=int, default=4096)
+    parser.add_argument("--num_clips_per_video", type=int, default=1, help="number of random clips sampled from every video")
+    parser.add_argument("--max_samples", type=int, default=None)
+    parser.add_argument("--storage_dtype", type=str, default="float16", choices=["float16", "float32"])
+    parser.add_argument("--half", action="store_true", help="run the VAE and text encoder in fp16")
+    parser.add_argument("--part", type=int, default=0, help="index of this process when latentizing in parallel")
+    parser.add_argument("--num_parts", type=int, default=1, help="number of parallel latentize processes")
+    parser.add_argument("optional_args", nargs='*', default=[])
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
+        datefmt="%m/%d/%Y %H:%M:%S",
+        level=logging.INFO,
+    )
+
+    main(args)
@@ -0,0 +1,175 @@
+import argparse
+import asyncio
+import datetime
+import json
+import logging
+import os
+import uuid
+from omegaconf import OmegaConf
+
+import torch
+
+import diffusers
+from diffusers import AutoencoderKL, DDIMScheduler
+
+from transformers import CLIPTextModel, CLIPTokenizer
+
+from consisti2v.models.videoldm_unet import VideoLDMUNet3DConditionModel
+from consisti2v.pipelines.pipeline_conditional_animation import ConditionalAnimationPipeline
+from consisti2v.utils.batching import BatchingScheduler, GenerationRequest
+from consisti2v.utils.util import save_videos_grid
+from diffusers.utils.import_utils import is_xformers_available
+
+logger = logging.getLogger(__name__)
+
+
+def load_pipeline(config):
+    if config.pipeline_pretrained_path is not None:
+        return ConditionalAnimationPipeline.from_pretrained(config.pipeline_pretrained_path)
+
+    noise_scheduler = DDIMScheduler(**OmegaConf.to_container(config.noise_scheduler_kwargs))
+    tokenizer       = CLIPTokenizer.from_pretrained(config.pretrained_model_path, subfolder="tokenizer", use_safetensors=True)
+    text_encoder    = CLIPTextModel.from_pretrained(config.pretrained_model_path, subfolder="text_encoder")
+    vae             = AutoencoderKL.from_pretrained(config.pretrained_model_path, subfolder="vae", use_safetensors=True)
+    unet            = VideoLDMUNet3DConditionModel.from_pretrained(
+        config.pretrained_model_path,
+        subfolder="unet",
+        variant=config.unet_additional_kwargs['variant'],
+        temp_pos_embedding=config.unet_additional_kwargs['temp_pos_embedding'],
+        augment_temporal_attention=config.unet_additional_kwargs['augment_temporal_attention'],
+        use_temporal=True,
+        n_frames=config.sampling_kwargs['n_frames'],
+        n_temp_heads=config.unet_additional_kwargs['n_temp_heads'],
+        first_frame_condition_mode=config.unet_additional_kwargs['first_frame_condition_mode'],
+        use_frame_stride_condition=config.unet_additional_kwargs['use_frame_stride_condition'],
+        use_safetensors=True
+    )
+
+    if config.unet_path is not None:
+        if os.path.isdir(config.unet_path):
+            unet_dict = VideoLDMUNet3DConditionModel.from_pretrained(config.unet_path)
+            m, u = unet.load_state_dict(unet_dict.state_dict(), strict=False)
+            assert len(u) == 0
+            del unet_dict
+        else:
+            checkpoint_dict = torch.load(config.unet_path, map_location="cpu")
+            state_dict = checkpoint_dict["state_dict"] if "state_dict" in checkpoint_dict else checkpoint_dict
+            if config.unet_ckpt_prefix is not None:
+                state_dict = {k.replace(config.unet_ckpt_prefix, ''): v for k, v in state_dict.items()}
+            m, u = unet.load_state_dict(state_dict, strict=False)
+            assert len(u) == 0
+
+    if is_xformers_available() and int(torch.__version__.split(".")[0]) < 2:
+        unet.enable_xformers_memory_efficient_attention()
+
+    return ConditionalAnimationPipeline(
+        vae=vae, text_encoder=text_encoder, tokenizer=tokenizer, unet=unet, scheduler=noise_scheduler)
+
+
+async def handle_connection(reader, writer, scheduler, config, savedir, format):
+    """
+    Every line sent by the client is a JSON request with the fields of `GenerationRequest` (missing ones
+    default to the inference config) and an optional "id". Every request is answered with one JSON line,
+    {"id": ..., "path": ...} or {"id": ..., "error": ...}, in completion order.
+    """
+    loop = asyncio.get_running_loop()
+    lock = asyncio.Lock()
+
+    async def handle_request(line):
+        request_id = None
+        try:
+            payload = json.loads(line)
+            request_id = payload.pop("id", None) or uuid.uuid4().hex
+            payload.setdefault("height", config.sampling_kwargs.height)
+            payload.setdefault("width", config.sampling_kwargs.width)
+            payload.setdefault("video_length", config.sampling_kwargs.n_frames)
+            payload.setdefault("num_inference_steps", config.sampling_kwargs.steps)
+            payload.setdefault("guidance_scale_txt", config.sampling_kwargs.guidance_scale_txt)
+            payload.setdefault("guidance_scale_img", config.sampling_kwargs.guidance_scale_img)
+            video = await scheduler.submit(GenerationRequest(**payload))
+            path = f"{savedir}/{request_id}.{format}"
+            await loop.run_in_executor(None, lambda: save_videos_grid(video.unsqueeze(0), path, format=format))
+            response = {"id": request_id, "path": path}
+        except Exception as e:
+            logger.exception(f"request {request_id} failed")
+            response = {"id": request_id, "error": str(e)}
+        async with lock:
+            writer.write((json.dumps(response) + "\n").encode())
+            await writer.drain()
+
+    tasks = []
+    while True:
+        line = await reader.readline()
+        if not line:
+            break
+        if line.strip():
+            tasks.append(asyncio.create_task(handle_request(line)))
+    await asyncio.gather(*tasks)
+    writer.close()
+    await writer.wait_closed()
+
+
+async def serve(args, config):
+    time_str = datetime.datetime.now().strftime("%Y-%m-%dT%H-%M-%S")
+    savedir = f"{config.output_dir}/serve-{time_str}"
+    os.makedirs(savedir)
+
+    pipeline = load_pipeline(config).to(args.device)
+    scheduler = BatchingScheduler(
+        pipeline,
+        max_batch_size        = args.max_batch_size,
+        max_wait_time         = args.max_wait_time,
+        filter_params         = config.frameinit_kwargs.filter_params,
+        freq_mix_mode         = config.frameinit_kwargs.get("freq_mix_mode", "fft"),
+        noise_sampling_method = config.unet_additional_kwargs['noise_sampling_method'],
+        noise_alpha           = float(config.unet_additional_kwargs['noise_alpha']),
+        eta                   = config.sampling_kwargs.ddim_eta,
+        frame_stride          = config.sampling_kwargs.frame_stride,
+        guidance_rescale      = config.sampling_kwargs.guidance_rescale,
+        guidance_schedule     = config.sampling_kwargs.get("guidance_schedule", "constant"),
+        cfg_cutoff            = config.sampling_kwargs.get("cfg_cutoff", 1.0),
+        cache_first_frame_features = config.sampling_kwargs.get("cache_first_frame_features", False),
+        use_frameinit         = config.frameinit_kwargs.enable,
+        frameinit_noise_level = config.frameinit_kwargs.noise_level,
+        camera_motion         = config.frameinit_kwargs.camera_motion,
+    )
+    await scheduler.start()
+
+    server = await asyncio.start_server(
+        lambda reader, writer: handle_connection(reader, writer, scheduler, config, savedir, args.format),
+        host=args.host,
+        port=args.port,
+    )
+    logger.info(f"serving on {args.host}:{args.port}, saving to {savedir}")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await scheduler.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--inference_config", type=str, default="configs/inference/inference.yaml")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--device", type=str, default="cuda")
+    parser.add_argument("--max_batch_size", type=int, default=4)
+    parser.add_argument("--max_wait_time", type=float, default=0.1)
+    parser.add_argument("--format", type=str, default="mp4", choices=["gif", "mp4"])
+    parser.add_argument("optional_args", nargs='*', default=[])
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
+        datefmt="%m/%d/%Y %H:%M:%S",
+        level=logging.INFO,
+    )
+    diffusers.utils.logging.set_verbosity_info()
+
+    config = OmegaConf.load(args.inference_config)
+    if args.optional_args:
+        modified_config = OmegaConf.from_dotlist(args.optional_args)
+        config = OmegaConf.merge(config, modified_config)
+
+    asyncio.run(serve(args, config))
@@ -0,0 +1,70 @@
+import json
+import os
+
+import numpy as np
+import pytest
+
+from consisti2v.data.annotation_utils import AnnotationStore, load_annotation_store, read_json_lines
+
+
+RECORDS = [
+    {"file": "videos/a.mp4", "caption": "a cat", "num_frames": 120, "fps": 24.0},
+    {"file": "videos/b.mp4", "caption": "", "fps": 29.97},
+    {"file": "vidéos/ç.mp4", "caption": "ünïcode 動画", "num_frames": 7, "fps": 30.0},
+]
+NUMERIC_FIELDS = {"num_frames": np.int64, "fps": np.float32}
+
+
+def make_store():
+    return AnnotationStore.from_records(RECORDS, string_fields=["file", "caption"], numeric_fields=NUMERIC_FIELDS)
+
+
+def check_store(store):
+    assert len(store) == len(RECORDS)
+    for idx, record in enumerate(RECORDS):
+        row = store[idx]
+        assert row["file"] == record["file"]
+        assert row["caption"] == record["caption"]
+        # missing numeric values are stored as 0
+        assert row["num_frames"] == record.get("num_frames", 0)
+        assert row["fps"] == pytest.approx(record["fps"])
+    with pytest.raises(IndexError):
+        store[len(RECORDS)]
+    with pytest.raises(IndexError):
+        store[-1]
+
+
+def test_annotation_store_from_records():
+    check_store(make_store())
+
+
+def test_annotation_store_save_load(tmp_path):
+    path = str(tmp_path / "store")
+    make_store().save(path, source_key="key")
+    store = AnnotationStore.load(path)
+    check_store(store)
+    assert isinstance(store.columns["num_frames"], np.memmap)
+    assert sorted(os.listdir(tmp_path)) == ["store"]
+
+    # saving over an existing store replaces it
+    AnnotationStore.from_records(RECORDS[:1], string_fields=["file"]).save(path)
+    assert len(AnnotationStore.load(path)) == 1
+
+
+def test_load_annotation_store_rebuilds_on_source_change(tmp_path):
+    json_path = tmp_path / "annotations.jsonl"
+    json_path.write_text("".join(json.dumps(record) + "\n" for record in RECORDS))
+    cache_path = str(tmp_path / "cache")
+    num_builds = []
+
+    def build():
+        num_builds.append(1)
+        return AnnotationStore.from_records(read_json_lines(json_path), ["file", "caption"], NUMERIC_FIELDS)
+
+    check_store(load_annotation_store(build, [json_path], cache_path))
+    check_store(load_annotation_store(build, [json_path], cache_path))
+    assert len(num_builds) == 1
+
+    json_path.write_text("".join(json.dumps(record) + "\n\n" for record in RECORDS[:2]))
+    assert len(load_annotation_store(build, [json_path], cache_path)) == 2
+    assert len(num_builds) == 2
@@ -0,0 +1,160 @@
+import asyncio
+import json
+import time
+
+import numpy as np
+import pytest
+import torch
+from diffusers import AutoencoderKL, DDIMScheduler
+from PIL import Image
+from transformers import CLIPTextConfig, CLIPTextModel, CLIPTokenizer
+from transformers.models.clip.tokenization_clip import bytes_to_unicode
+
+from consisti2v.models.videoldm_unet import VideoLDMUNet3DConditionModel
+from consisti2v.pipelines.pipeline_conditional_animation import ConditionalAnimationPipeline
+from consisti2v.utils.batching import BatchingScheduler, GenerationRequest
+
+
+MAX_BATCH_SIZE = 2
+MAX_WAIT_TIME = 0.2
+VARIANTS = [dict(), dict(num_inference_steps=3), dict(guidance_scale_img=2.0)]
+
+
+def make_tokenizer(tmp_path):
+    # byte level vocabulary without merges, every character is a token
+    characters = list(bytes_to_unicode().values())
+    vocab = characters + [c + "</w>" for c in characters] + ["<|startoftext|>", "<|endoftext|>"]
+    (tmp_path / "vocab.json").write_text(json.dumps({token: i for i, token in enumerate(vocab)}))
+    (tmp_path / "merges.txt").write_text("#version: 0.2\n")
+    return CLIPTokenizer(str(tmp_path / "vocab.json"), str(tmp_path / "merges.txt"), model_max_length=16), len(vocab)
+
+
+@pytest.fixture(scope="module")
+def pipeline(tmp_path_factory):
+    torch.manual_seed(0)
+    tokenizer, vocab_size = make_tokenizer(tmp_path_factory.mktemp("tokenizer"))
+    text_encoder = CLIPTextModel(CLIPTextConfig(
+        vocab_size=vocab_size,
+        hidden_size=32,
+        intermediate_size=64,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        max_position_embeddings=16,
+    ))
+    vae = AutoencoderKL(
+        block_out_channels=(16, 32),
+        down_block_types=("DownEncoderBlock2D", "DownEncoderBlock2D"),
+        up_block_types=("UpDecoderBlock2D", "UpDecoderBlock2D"),
+        latent_channels=4,
+        norm_num_groups=8,
+        sample_size=32,
+    )
+    unet = VideoLDMUNet3DConditionModel(
+        sample_size=16,
+        block_out_channels=(32, 64),
+        layers_per_block=1,
+        down_block_types=("CrossAttnDownBlock2D", "DownBlock2D"),
+        up_block_types=("UpBlock2D", "CrossAttnUpBlock2D"),
+        cross_attention_dim=32,
+        attention_head_dim=8,
+        norm_num_groups=8,
+        n_frames=4,
+        n_temp_heads=4,
+        first_frame_condition_mode="concat",
+    )
+    scheduler = DDIMScheduler(beta_schedule="scaled_linear", clip_sample=False, steps_offset=1)
+    pipeline = ConditionalAnimationPipeline(
+        vae=vae.eval(),
+        text_encoder=text_encoder.eval(),
+        tokenizer=tokenizer,
+        unet=unet.eval(),
+        scheduler=scheduler,
+    )
+    pipeline.set_progress_bar_config(disable=True)
+    return pipeline
+
+
+@pytest.fixture(scope="module")
+def first_frame_paths(tmp_path_factory):
+    tmp_path = tmp_path_factory.mktemp("first_frames")
+    rng = np.random.default_rng(0)
+    paths = []
+    for i in range(3):
+        path = tmp_path / f"{i}.png"
+        Image.fromarray(rng.integers(0, 256, (40, 48, 3), dtype=np.uint8)).save(path)
+        paths.append(str(path))
+    return paths
+
+
+def make_requests(first_frame_paths, num_requests):
+    # interleaved batch keys, and prompts and first frames that differ between the requests of a batch
+    return [
+        GenerationRequest(
+            prompt=f"a video number {i}",
+            first_frame_path=first_frame_paths[i % len(first_frame_paths)],
+            height=32,
+            width=32,
+            video_length=4,
+            seed=i,
+            **{"num_inference_steps": 2, **VARIANTS[i % len(VARIANTS)]},
+        )
+        for i in range(num_requests)
+    ]
+
+
+async def submit_all(scheduler, requests):
+    # concurrent submissions, (video, submit time, result time) per request
+    async def submit(request):
+        start = time.monotonic()
+        video = await scheduler.submit(request)
+        return video, start, time.monotonic()
+
+    await scheduler.start()
+    try:
+        return await asyncio.gather(*(submit(request) for request in requests))
+    finally:
+        await scheduler.stop()
+
+
+def run_requests(pipeline, requests, max_batch_size, max_wait_time):
+    # the pipeline latents passed to the first step callback of every call, (b, c, f - 1, h, w)
+    batch_sizes = []
+
+    def callback(step, timestep, latents):
+        if step == 0:
+            batch_sizes.append(latents.shape[0])
+
+    scheduler = BatchingScheduler(pipeline, max_batch_size=max_batch_size, max_wait_time=max_wait_time, callback=callback)
+    return asyncio.run(submit_all(scheduler, requests)), batch_sizes
+
+
+def test_batched_requests_match_unbatched(pipeline, first_frame_paths):
+    requests = make_requests(first_frame_paths, 7)
+    batched, batch_sizes = run_requests(pipeline, requests, MAX_BATCH_SIZE, MAX_WAIT_TIME)
+    alone, alone_batch_sizes = run_requests(pipeline, requests, 1, 0.0)
+
+    # 7 requests of 3 batch keys fit in 4 calls of at most 2 requests
+    assert sorted(batch_sizes) == [1, 2, 2, 2]
+    assert alone_batch_sizes == [1] * len(requests)
+    for i, (request, (video, _, _)) in enumerate(zip(requests, batched)):
+        assert video.shape == (3, request.video_length, request.height, request.width)
+        assert video.min() >= 0 and video.max() <= 1
+        # every request gets its own video, independently of the requests it was batched with
+        torch.testing.assert_close(video, alone[i][0], rtol=0, atol=1e-5)
+        for j, (other, _, _) in enumerate(alone):
+            if j != i and requests[j].batch_key == request.batch_key:
+                assert not torch.allclose(video, other, rtol=0, atol=1e-2)
+
+
+def test_max_wait_time(pipeline, first_frame_paths):
+    requests = make_requests(first_frame_paths, MAX_BATCH_SIZE * len(VARIANTS))
+    # a lone request waits max_wait_time for others
+    ((_, start, end),), batch_sizes = run_requests(pipeline, requests[:1], MAX_BATCH_SIZE, MAX_WAIT_TIME)
+    assert end - start >= MAX_WAIT_TIME
+    assert batch_sizes == [1]
+
+    # full batches are dispatched without waiting
+    same_key = [request for request in requests if request.batch_key == requests[0].batch_key]
+    results, batch_sizes = run_requests(pipeline, same_key, MAX_BATCH_SIZE, max_wait_time=60.0)
+    assert batch_sizes == [MAX_BATCH_SIZE]
+    assert max(end for _, _, end in results) - min(start for _, start, _ in results) < 60.0
@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+
+from consisti2v.data.bucket_utils import AspectRatioBucketBatchSampler, AspectRatioBuckets, get_buckets
+
+
+BUCKET_IDS = [0] * 10 + [1] * 7 + [2] * 3 + [1] * 2
+
+
+@pytest.mark.parametrize("drop_last", [True, False])
+def test_batches_stay_within_buckets(drop_last):
+    sampler = AspectRatioBucketBatchSampler(BUCKET_IDS, batch_size=4, drop_last=drop_last, seed=1)
+    batches = list(sampler)
+    assert len(batches) == len(sampler)
+    for batch in batches:
+        assert len({BUCKET_IDS[idx] for idx in batch}) == 1
+        assert len(batch) == 4 or not drop_last
+
+    indices = [idx for batch in batches for idx in batch]
+    assert len(indices) == len(set(indices))
+    if drop_last:
+        # 10, 9 and 3 clips per bucket
+        assert len(batches) == 2 + 2 + 0
+    else:
+        assert sorted(indices) == list(range(len(BUCKET_IDS)))
+        assert len(batches) == 3 + 3 + 1
+
+
+def test_shuffling_is_seeded_per_epoch():
+    sampler = AspectRatioBucketBatchSampler(BUCKET_IDS, batch_size=2, seed=3)
+    first_epoch = list(sampler)
+    # `__iter__` advances the epoch by itself
+    assert list(sampler) != first_epoch
+    sampler.set_epoch(0)
+    assert list(sampler) == first_epoch
+    assert list(AspectRatioBucketBatchSampler(BUCKET_IDS, batch_size=2, seed=3)) == first_epoch
+
+
+def test_no_shuffle_keeps_order():
+    sampler = AspectRatioBucketBatchSampler(BUCKET_IDS, batch_size=4, shuffle=False, drop_last=False)
+    assert list(sampler) == [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9], [10, 11, 12, 13], [14, 15, 16, 20], [21], [17, 18, 19]]
+
+
+def test_buckets():
+    buckets = get_buckets(256, [1.0, 0.5625, 1.7778])
+    assert buckets[0] == (256, 256)
+    for height, width in buckets:
+        assert height % 64 == 0 and width % 64 == 0
+        assert abs(height * width / 256 ** 2 - 1) < 0.25
+
+    assignment = AspectRatioBuckets(256, [1.0, 0.5625, 1.7778], heights=[720, 1080, 500], widths=[1280, 1080, 280])
+    assert assignment.bucket_ids.tolist() == [1, 0, 2]
+    assert assignment.get_target_size(1) == (256, 256)
+    np.testing.assert_array_equal(assignment.get_replacement_indices(0), [0])
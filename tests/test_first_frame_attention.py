@@ -0,0 +1,47 @@
+import pytest
+import torch
+from diffusers.models.attention_processor import AttnProcessor2_0
+from einops import repeat
+
+from consisti2v.models.videoldm_attention import ConditionalAttention
+
+
+def make_inputs(batch_size=2, num_frames=5, seq_len=37, dim=64, dtype=torch.float64):
+    torch.manual_seed(0)
+    attn = ConditionalAttention(query_dim=dim, heads=4, dim_head=16).to(dtype)
+    attn.set_processor(AttnProcessor2_0())
+    hidden_states = torch.randn(batch_size * num_frames, seq_len, dim, dtype=dtype)
+    return attn, hidden_states
+
+
+def concat_attention(attn, hidden_states, num_frames):
+    # the first frame repeated to every frame and concatenated to its keys and values
+    first_frame = hidden_states.unflatten(0, (-1, num_frames))[:, 0]
+    encoder_hidden_states = torch.cat((hidden_states, repeat(first_frame, 'b n c -> (b f) n c', f=num_frames)), dim=1)
+    return attn.processor(attn, hidden_states, encoder_hidden_states=encoder_hidden_states)
+
+
+@pytest.mark.parametrize("dtype", [torch.float64, torch.float32])
+def test_first_frame_attention_split_matches_concat(dtype):
+    num_frames = 5
+    attn, hidden_states = make_inputs(num_frames=num_frames, dtype=dtype)
+    first_frame = hidden_states.unflatten(0, (-1, num_frames))[:, 0]
+    with torch.no_grad():
+        output = attn(hidden_states, first_frame_hidden_states=first_frame, num_frames=num_frames)
+        reference = concat_attention(attn, hidden_states, num_frames)
+    atol = 1e-12 if dtype == torch.float64 else 1e-6
+    torch.testing.assert_close(output, reference, rtol=0, atol=atol)
+
+
+def test_first_frame_attention_gradients_match_concat():
+    num_frames = 4
+    attn, hidden_states = make_inputs(num_frames=num_frames)
+    inputs = hidden_states.clone().requires_grad_(), hidden_states.clone().requires_grad_()
+    output = attn(inputs[0], first_frame_hidden_states=inputs[0].unflatten(0, (-1, num_frames))[:, 0], num_frames=num_frames)
+    reference = concat_attention(attn, inputs[1], num_frames)
+    torch.testing.assert_close(output, reference, rtol=0, atol=1e-12)
+
+    grad_output = torch.randn_like(output)
+    grads = [torch.autograd.grad(out, (x, attn.to_k.weight), grad_output) for out, x in zip((output, reference), inputs)]
+    for grad, reference_grad in zip(*grads):
+        torch.testing.assert_close(grad, reference_grad, rtol=0, atol=1e-12)
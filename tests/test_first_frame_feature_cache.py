@@ -0,0 +1,56 @@
+import pytest
+import torch
+
+from consisti2v.models.videoldm_unet import VideoLDMUNet3DConditionModel
+
+
+def make_unet(first_frame_condition_mode):
+    torch.manual_seed(0)
+    return VideoLDMUNet3DConditionModel(
+        sample_size=16,
+        block_out_channels=(32, 64),
+        layers_per_block=1,
+        down_block_types=("CrossAttnDownBlock2D", "DownBlock2D"),
+        up_block_types=("UpBlock2D", "CrossAttnUpBlock2D"),
+        cross_attention_dim=32,
+        attention_head_dim=8,
+        norm_num_groups=8,
+        n_frames=5,
+        n_temp_heads=4,
+        first_frame_condition_mode=first_frame_condition_mode,
+    ).double().eval()
+
+
+@pytest.mark.parametrize("first_frame_condition_mode", ["concat", "conv2d"])
+def test_cached_first_frame_features_match_uncached(first_frame_condition_mode):
+    unet = make_unet(first_frame_condition_mode)
+    generator = torch.Generator().manual_seed(1)
+    sample = torch.randn(2, 4, 4, 16, 16, generator=generator, dtype=torch.float64)
+    first_frame_latents = torch.randn(2, 4, 1, 16, 16, generator=generator, dtype=torch.float64)
+    encoder_hidden_states = torch.randn(2, 7, 32, generator=generator, dtype=torch.float64)
+    timesteps = (999, 500, 10)
+
+    with torch.no_grad():
+        references = [unet(sample, t, encoder_hidden_states, first_frame_latents=first_frame_latents).sample for t in timesteps]
+        with unet.cache_first_frame_features() as cache:
+            outputs = [unet(sample, t, encoder_hidden_states, first_frame_latents=first_frame_latents).sample for t in timesteps]
+            stats = cache.get_stats()
+
+    for output, reference in zip(outputs, references):
+        torch.testing.assert_close(output, reference, rtol=0, atol=1e-12)
+    # conv_in and the first resnet of the first down block, with "conv2d" also the first frame projections of all
+    # five blocks and the first resnets of the second down block and the mid block
+    num_entries = 2 if first_frame_condition_mode == "concat" else 9
+    assert stats["misses"] == num_entries
+    assert stats["hits"] == num_entries * (len(timesteps) - 1)
+    assert stats["saved_gmacs"] > 0
+
+
+def test_first_frame_features_not_cached_with_gradients():
+    unet = make_unet("conv2d")
+    sample = torch.randn(1, 4, 4, 16, 16, dtype=torch.float64)
+    first_frame_latents = torch.randn(1, 4, 1, 16, 16, dtype=torch.float64)
+    encoder_hidden_states = torch.randn(1, 7, 32, dtype=torch.float64)
+    with unet.cache_first_frame_features() as cache:
+        unet(sample, 10, encoder_hidden_states, first_frame_latents=first_frame_latents).sample.sum().backward()
+    assert cache.get_stats()["misses"] == 0
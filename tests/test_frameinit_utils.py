@@ -0,0 +1,30 @@
+import pytest
+import torch
+
+from consisti2v.utils.frameinit_utils import freq_mix_3d, freq_mix_3d_rfft, get_freq_filter
+
+
+@pytest.mark.parametrize("filter_type", ["gaussian", "ideal", "box", "butterworth"])
+@pytest.mark.parametrize("shape", [(2, 4, 16, 8, 8), (1, 3, 5, 7, 9)])
+def test_rfft_freq_mix_matches_fft(filter_type, shape):
+    generator = torch.Generator().manual_seed(0)
+    x = torch.randn(shape, generator=generator, dtype=torch.float64)
+    noise = torch.randn(shape, generator=generator, dtype=torch.float64)
+    kwargs = dict(filter_type=filter_type, n=4, d_s=0.25, d_t=0.25, dtype=torch.float64)
+    lpf = get_freq_filter(shape, "cpu", **kwargs)
+    lpf_rfft = get_freq_filter(shape, "cpu", rfft=True, **kwargs)
+
+    expected = freq_mix_3d(x, noise, lpf)
+    torch.testing.assert_close(freq_mix_3d_rfft(x, noise, lpf_rfft), expected)
+    # with the result written over `x`, as the pipelines do
+    mixed = freq_mix_3d_rfft(x, noise, lpf_rfft, out=x)
+    assert mixed.data_ptr() == x.data_ptr()
+    torch.testing.assert_close(x, expected)
+
+
+def test_freq_filter_is_cached_and_broadcastable():
+    shape = (2, 4, 16, 8, 8)
+    lpf = get_freq_filter(shape, "cpu", "butterworth", n=4, d_s=0.25, d_t=0.25)
+    assert lpf.shape == (1, 1, 16, 8, 8)
+    assert get_freq_filter((3, 2, 16, 8, 8), "cpu", "butterworth", n=4, d_s=0.25, d_t=0.25).data_ptr() == lpf.data_ptr()
+    assert get_freq_filter(shape, "cpu", "butterworth", n=4, d_s=0.25, d_t=0.25, rfft=True).shape == (1, 1, 16, 8, 5)
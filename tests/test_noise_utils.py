@@ -0,0 +1,54 @@
+import math
+
+import pytest
+import torch
+
+from consisti2v.utils.noise_utils import sample_noise
+
+
+def sample_noise_loop(shape, noise_sampling_method, noise_alpha, generators, dtype):
+    # the per-item, per-frame loops of the pipelines before `sample_noise`
+    noise_alpha_squared = noise_alpha ** 2
+    item_shape = (1,) + tuple(shape[1:])
+    noises = []
+    for generator in generators:
+        if noise_sampling_method == "vanilla":
+            noise = torch.randn(item_shape, generator=generator, dtype=dtype)
+        elif noise_sampling_method == "pyoco_mixed":
+            base_shape = item_shape[:2] + (1,) + item_shape[3:]
+            base_noise = torch.randn(base_shape, generator=generator, dtype=dtype) * math.sqrt(noise_alpha_squared / (1 + noise_alpha_squared))
+            ind_noise = torch.randn(item_shape, generator=generator, dtype=dtype) * math.sqrt(1 / (1 + noise_alpha_squared))
+            noise = base_noise + ind_noise
+        else:
+            noise = torch.randn(item_shape, generator=generator, dtype=dtype)
+            ind_noise = torch.randn(item_shape, generator=generator, dtype=dtype) * math.sqrt(1 / (1 + noise_alpha_squared))
+            for j in range(1, item_shape[2]):
+                noise[:, :, j, :, :] = noise[:, :, j - 1, :, :] * math.sqrt(noise_alpha_squared / (1 + noise_alpha_squared)) + ind_noise[:, :, j, :, :]
+        noises.append(noise)
+    return torch.cat(noises, dim=0)
+
+
+@pytest.mark.parametrize("noise_sampling_method", ["vanilla", "pyoco_mixed", "pyoco_progressive"])
+@pytest.mark.parametrize("dtype", [torch.float32, torch.float16, torch.bfloat16])
+def test_sample_noise_matches_loop(noise_sampling_method, dtype):
+    shape = (3, 4, 8, 6, 5)
+    generators = lambda: [torch.Generator().manual_seed(seed) for seed in range(shape[0])]
+    reference = sample_noise_loop(shape, noise_sampling_method, 0.5, generators(), dtype)
+    noise = sample_noise(shape, noise_sampling_method, 0.5, generator=generators(), dtype=dtype)
+    assert torch.equal(noise, reference)
+
+
+def test_sample_noise_single_generator():
+    shape = (2, 4, 8, 6, 5)
+    noise = sample_noise(shape, "pyoco_progressive", 1.0, generator=torch.Generator().manual_seed(0))
+    torch.manual_seed(0)
+    reference = torch.randn(shape)
+    ind_noise = torch.randn(shape) * math.sqrt(1 / 2)
+    for j in range(1, shape[2]):
+        reference[:, :, j] = reference[:, :, j - 1] * math.sqrt(1 / 2) + ind_noise[:, :, j]
+    assert torch.equal(noise, reference)
+
+
+def test_sample_noise_unknown_method():
+    with pytest.raises(ValueError):
+        sample_noise((1, 4, 2, 3, 3), "unknown")
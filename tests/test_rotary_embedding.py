@@ -0,0 +1,56 @@
+import torch
+
+from consisti2v.models.rotary_embedding import RotaryEmbedding
+
+
+def get_cos_sin_uncached(rotary_emb, seq_len, dtype, offset=0, pad_len=0):
+    seq_pos = rotary_emb.get_seq_pos(seq_len - pad_len, "cpu", dtype, offset=offset)
+    seq_pos = torch.cat((seq_pos, torch.zeros(pad_len, dtype=dtype)))
+    freqs = rotary_emb(seq_pos).to(dtype)
+    return freqs.cos(), freqs.sin()
+
+
+def check_tables(rotary_emb, seq_len=8, dtype=torch.float32, **kwargs):
+    cos, sin = rotary_emb.get_cos_sin(seq_len, torch.device("cpu"), dtype, **kwargs)
+    expected_cos, expected_sin = get_cos_sin_uncached(rotary_emb, seq_len, dtype, **kwargs)
+    assert torch.equal(cos, expected_cos) and torch.equal(sin, expected_sin)
+    return cos, sin
+
+
+def test_get_cos_sin_cache_hits():
+    rotary_emb = RotaryEmbedding(16)
+    cos, sin = check_tables(rotary_emb)
+    assert rotary_emb.get_cos_sin(8, torch.device("cpu"), torch.float32)[0] is cos
+    # other lengths, offsets, padding and dtypes get their own tables
+    check_tables(rotary_emb, seq_len=12)
+    check_tables(rotary_emb, offset=3)
+    check_tables(rotary_emb, seq_len=16, pad_len=8)
+    check_tables(rotary_emb, dtype=torch.float64)
+    assert len(rotary_emb.cached_cos_sin) == 5
+
+
+def test_get_cos_sin_invalidated_by_freqs_updates():
+    rotary_emb = RotaryEmbedding(16)
+    cos, _ = check_tables(rotary_emb)
+
+    # in place updates of the frequencies, e.g. when a checkpoint is loaded
+    state_dict = {"freqs": rotary_emb.freqs.detach() * 2}
+    rotary_emb.load_state_dict(state_dict, strict=False)
+    new_cos, _ = check_tables(rotary_emb)
+    assert not torch.equal(new_cos, cos)
+
+    with torch.no_grad():
+        rotary_emb.freqs.div_(2)
+    torch.testing.assert_close(check_tables(rotary_emb)[0], cos)
+
+    # dtype changes of the module
+    rotary_emb.double()
+    check_tables(rotary_emb)
+
+
+def test_learned_freqs_are_not_cached():
+    rotary_emb = RotaryEmbedding(16, learned_freq=True)
+    check_tables(rotary_emb)
+    assert len(rotary_emb.cached_cos_sin) == 0
+    cos, _ = rotary_emb.get_cos_sin(8, torch.device("cpu"), torch.float32)
+    assert cos.requires_grad
@@ -0,0 +1,57 @@
+import pytest
+import torch
+from einops import rearrange
+
+from consisti2v.models.videoldm_attention import TemporalConditionalAttention
+from consisti2v.models.videoldm_transformer_blocks import get_neighbor_index
+
+
+def temporal_attention_rearranged(attn, hidden_states, adjacent_slices, num_frames):
+    # the temporal attention before the strided (hw, b, t, c) layout: the frames are gathered into
+    # (b hw, t, c) sequences and the output is copied back to (b t, hw, c)
+    bt, hw, c = hidden_states.shape
+    kwargs = {}
+    hidden_states = rearrange(hidden_states, '(b t) hw c -> b hw t c', t=num_frames)
+    if not attn.use_rotary_emb:
+        pos_embed = attn.pos_enc(num_frames)
+        hidden_states = hidden_states + pos_embed
+    hidden_states = rearrange(hidden_states, 'b hw t c -> (b hw) t c')
+    encoder_hidden_states = None
+    if adjacent_slices is not None:
+        if not attn.use_rotary_emb:
+            adjacent_slices = adjacent_slices + pos_embed[0:1, :]
+        else:
+            kwargs["key_pad_len"] = adjacent_slices.shape[2]
+        adjacent_slices = rearrange(adjacent_slices, 'b hw n c -> (b hw) n c')
+        encoder_hidden_states = torch.cat([hidden_states, adjacent_slices], dim=1)
+    out = attn.processor(attn, hidden_states, encoder_hidden_states=encoder_hidden_states, **kwargs)
+    return rearrange(out, '(b hw) t c -> (b t) hw c', hw=hw)
+
+
+@pytest.mark.parametrize("rotary_emb", [True, False])
+@pytest.mark.parametrize("augment_temporal_attention", [False, True])
+@pytest.mark.parametrize("grad", [False, True])
+def test_strided_temporal_attention_matches_rearranged(rotary_emb, augment_temporal_attention, grad):
+    torch.manual_seed(0)
+    batch_size, num_frames, size, channels = 2, 5, 4, 32
+    attn = TemporalConditionalAttention(
+        query_dim=channels, heads=4, dim_head=channels // 4, n_frames=num_frames, rotary_emb=rotary_emb
+    ).double()
+    hidden_states = torch.randn(batch_size * num_frames, size * size, channels, dtype=torch.float64, requires_grad=grad)
+    adjacent_slices = None
+    if augment_temporal_attention:
+        first_frame = hidden_states.view(batch_size, num_frames, size * size, channels)[:, 0]
+        adjacent_slices = first_frame.index_select(1, get_neighbor_index(size, size, hidden_states.device))
+        adjacent_slices = adjacent_slices.view(batch_size, size * size, 8, channels)
+
+    with torch.set_grad_enabled(grad):
+        out = attn(hidden_states, adjacent_slices=adjacent_slices, num_frames=num_frames)
+        expected = temporal_attention_rearranged(attn, hidden_states, adjacent_slices, num_frames)
+    torch.testing.assert_close(out, expected)
+
+    if grad:
+        weight = torch.randn_like(out)
+        grads = torch.autograd.grad((out * weight).sum(), [hidden_states, attn.to_q.weight], retain_graph=True)
+        expected_grads = torch.autograd.grad((expected * weight).sum(), [hidden_states, attn.to_q.weight])
+        for grad_value, expected_grad in zip(grads, expected_grads):
+            torch.testing.assert_close(grad_value, expected_grad)
@@ -0,0 +1,49 @@
+import pytest
+import torch
+import torch.nn as nn
+from einops import rearrange
+
+from consisti2v.models.videoldm_unet_blocks import Conv3DLayer
+
+
+@pytest.mark.parametrize("memory_format", [torch.contiguous_format, torch.channels_last])
+@pytest.mark.parametrize("bias", [True, False])
+@pytest.mark.parametrize("batch_size,num_frames", [(1, 1), (1, 4), (3, 5)])
+def test_temporal_conv_matmul_matches_conv3d(memory_format, bias, batch_size, num_frames):
+    torch.manual_seed(0)
+    in_channels, out_channels, height, width = 6, 10, 3, 4
+    conv = Conv3DLayer(in_channels, out_channels, n_frames=num_frames).double()
+    if not bias:
+        conv.bias = None
+    conv.use_matmul = True
+
+    # a plain `nn.Conv3d` with a (3, 1, 1) kernel must load the same weights
+    reference = nn.Conv3d(in_channels, out_channels, kernel_size=(3, 1, 1), padding=(1, 0, 0), bias=bias).double()
+    reference.load_state_dict(conv.state_dict())
+
+    x = torch.randn(batch_size * num_frames, in_channels, height, width, dtype=torch.float64)
+    x = x.contiguous(memory_format=memory_format)
+    with torch.no_grad():
+        out = conv(x, num_frames)
+        expected = reference(rearrange(x, "(b t) c h w -> b c t h w", t=num_frames))
+    expected = rearrange(expected, "b c t h w -> (b t) c h w")
+
+    assert out.is_contiguous(memory_format=memory_format)
+    torch.testing.assert_close(out, expected)
+
+
+def test_temporal_conv_matmul_gradients_match_conv3d():
+    torch.manual_seed(0)
+    num_frames = 4
+    conv = Conv3DLayer(4, 4, n_frames=num_frames).double()
+    conv.use_matmul = True
+    reference = nn.Conv3d(4, 4, kernel_size=(3, 1, 1), padding=(1, 0, 0)).double()
+    reference.load_state_dict(conv.state_dict())
+
+    x = torch.randn(2 * num_frames, 4, 3, 3, dtype=torch.float64)
+    conv(x, num_frames).square().sum().backward()
+    expected = reference(rearrange(x, "(b t) c h w -> b c t h w", t=num_frames))
+    expected.square().sum().backward()
+
+    torch.testing.assert_close(conv.weight.grad, reference.weight.grad)
+    torch.testing.assert_close(conv.bias.grad, reference.bias.grad)
@@ -0,0 +1,152 @@
+import random
+
+import numpy as np
+import pytest
+import torch
+
+from consisti2v.data.video_utils import FailureRegistry, VideoIndex, get_batch_with_retries
+
+
+def make_columns(files):
+    # video i has i + 10 frames, a height of i, a width of 2 * i and i % 3 keyframes at multiples of i + 1
+    rows = range(len(files))
+    keyframes = [np.arange(i % 3, dtype=np.int64) * (i + 1) for i in rows]
+    keyframe_offsets = np.zeros(len(files) + 1, dtype=np.int64)
+    np.cumsum([len(k) for k in keyframes], out=keyframe_offsets[1:])
+    return dict(
+        num_frames=np.array([i + 10 for i in rows], dtype=np.int64),
+        heights=np.array(list(rows), dtype=np.int64),
+        widths=np.array([2 * i for i in rows], dtype=np.int64),
+        fps=np.full(len(files), 24.0),
+        keyframes=np.concatenate(keyframes + [np.zeros(0, dtype=np.int64)]),
+        keyframe_offsets=keyframe_offsets,
+    )
+
+
+def make_index(files):
+    return VideoIndex.from_files(files=files, **make_columns(files))
+
+
+FILES = ["b/clip.mp4", "a.mp4", "ä/ü.mp4", "a/clip.mp4", "c.mp4", "a.mp40", "", "z" * 300]
+
+
+def check_index(index, files):
+    assert len(index) == len(files)
+    for i, file in enumerate(files):
+        assert file in index
+        assert index.get_num_frames(file) == i + 10
+        assert index.get_size(file) == (i, 2 * i)
+        np.testing.assert_array_equal(index.get_keyframes(file), np.arange(i % 3) * (i + 1))
+    for file in ["a", "a.mp", "b", "d.mp4", "zz", "/a.mp4"]:
+        assert file not in index
+        assert index.get_num_frames(file) is None
+        assert index.get_size(file) is None
+        assert index.get_keyframes(file) is None
+
+
+def test_video_index_lookup():
+    check_index(make_index(FILES), FILES)
+
+
+def test_video_index_lookup_single_and_empty():
+    check_index(make_index(["x.mp4"]), ["x.mp4"])
+    empty = make_index([])
+    assert len(empty) == 0
+    assert "x.mp4" not in empty
+
+
+def test_video_index_save_load(tmp_path):
+    path = str(tmp_path / "index.npz")
+    make_index(FILES).save(path)
+    check_index(VideoIndex.load(path), FILES)
+
+
+def test_video_index_load_legacy_files_column(tmp_path):
+    # indexes built before the files were stored as bytes have an unsorted "files" column
+    path = str(tmp_path / "legacy.npz")
+    np.savez(path, files=np.array(FILES), **make_columns(FILES))
+    index = VideoIndex.load(path)
+    check_index(index, FILES)
+    np.testing.assert_array_equal(index.files_data, make_index(FILES).files_data)
+
+
+def test_failure_registry():
+    registry = FailureRegistry(10)
+    assert not registry.is_failed(3)
+    registry.record_failure(3, 0.5)
+    registry.record_failure(3, 0.25)
+    registry.record_failure(7, 1.0)
+    registry.record_retry()
+    assert registry.is_failed(3) and registry.is_failed(7) and not registry.is_failed(4)
+    assert registry.get_failed_samples() == {3: 2, 7: 1}
+    assert registry.get_stats() == {"num_failures": 3, "num_failed_samples": 2, "num_retries": 1, "retry_time": 1.75}
+
+    # the per-sample counts saturate
+    for _ in range(300):
+        registry.record_failure(0, 0.0)
+    assert registry.get_failed_samples()[0] == 255
+
+
+class FailingDataset(torch.utils.data.Dataset):
+    # every fourth sample fails once per epoch
+    def __init__(self, num_samples):
+        self.num_samples = num_samples
+        self.failure_registry = FailureRegistry(num_samples)
+
+    def __len__(self):
+        return self.num_samples
+
+    def __getitem__(self, idx):
+        if idx % 4 == 0:
+            self.failure_registry.record_failure(idx, 0.5)
+        return idx
+
+
+@pytest.mark.parametrize("multiprocessing_context", ["fork", "spawn"])
+def test_failure_registry_shared_with_workers(multiprocessing_context):
+    dataset = FailingDataset(16)
+    dataloader = torch.utils.data.DataLoader(
+        dataset, batch_size=2, num_workers=2, multiprocessing_context=multiprocessing_context
+    )
+    for _ in range(2):
+        assert sorted(idx for batch in dataloader for idx in batch.tolist()) == list(range(16))
+    # the main process sees the failures recorded by the workers of both epochs
+    assert dataset.failure_registry.get_failed_samples() == {0: 2, 4: 2, 8: 2, 12: 2}
+    # the counters are not locked, concurrent increments may be lost
+    assert 0 < dataset.failure_registry.get_stats()["num_failures"] <= 8
+
+
+def test_get_batch_with_retries_replaces_failed_samples():
+    random.seed(0)
+    broken = {1, 2, 5}
+    calls = []
+
+    def get_batch(idx):
+        calls.append(idx)
+        if idx in broken:
+            raise IOError(f"broken sample {idx}")
+        return idx
+
+    registry = FailureRegistry(8)
+    assert get_batch_with_retries(get_batch, 0, 8, registry) == 0
+    # a failing sample is replaced by one of `replacement_indices`
+    assert get_batch_with_retries(get_batch, 1, 8, registry, replacement_indices=[2, 5, 6]) == 6
+    assert registry.is_failed(1)
+
+    # known failures are skipped without loading them again
+    num_calls = len(calls)
+    assert get_batch_with_retries(get_batch, 1, 8, registry, replacement_indices=[6]) == 6
+    assert calls[num_calls:] == [6]
+    stats = registry.get_stats()
+    assert stats["num_failures"] == len([idx for idx in calls if idx in broken])
+    assert stats["num_retries"] >= stats["num_failures"]
+
+
+def test_get_batch_with_retries_gives_up():
+    def get_batch(idx):
+        raise IOError("broken dataset")
+
+    registry = FailureRegistry(4)
+    with pytest.raises(RuntimeError, match="after 4 attempts"):
+        get_batch_with_retries(get_batch, 0, 4, registry, max_retries=3)
+    assert registry.get_stats()["num_failures"] == 4
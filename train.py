@@ -30,11 +30,15 @@ from transformers import CLIPTextModel, CLIPTokenizer
 
 from accelerate import Accelerator, DistributedDataParallelKwargs, InitProcessGroupKwargs
 from accelerate.logging import get_logger
-from accelerate.utils import set_seed
+from accelerate.utils import GradientAccumulationPlugin, set_seed
 
-from consisti2v.data.dataset import WebVid10M, Pexels, JointDataset
+from consisti2v.data.dataset import WebVid10M, Pexels, JointDataset, LatentDataset
+from consisti2v.data.bucket_utils import AspectRatioBucketBatchSampler
+from consisti2v.data.prefetch_utils import BatchPrefetcher
+from consisti2v.data.video_utils import normalize_pixel_values
 from consisti2v.models.videoldm_unet import VideoLDMUNet3DConditionModel
 from consisti2v.pipelines.pipeline_conditional_animation import ConditionalAnimationPipeline
+from consisti2v.utils.noise_utils import sample_noise
 from consisti2v.utils.util import save_videos_grid
 
 logger = get_logger(__name__, log_level="INFO")
@@ -72,6 +76,7 @@ def main(
     trainable_modules: Tuple[str] = (None, ),
     num_workers: int = 32,
     train_batch_size: int = 1,
+    prefetch_batches: bool = True,
     adam_beta1: float = 0.9,
     adam_beta2: float = 0.999,
     adam_weight_decay: float = 1e-2,
@@ -95,8 +100,13 @@ def main(
     ddp_kwargs = DistributedDataParallelKwargs(find_unused_parameters=True if not is_image else False)
     init_kwargs = InitProcessGroupKwargs(timeout=datetime.timedelta(seconds=3600))
 
+    # the prefetcher reads ahead of the training loop, so the end of the dataloader cannot be used to
+    # sync gradients; accumulation is then purely step based
+    gradient_accumulation_plugin = GradientAccumulationPlugin(
+        num_steps=gradient_accumulation_steps, sync_with_dataloader=not prefetch_batches
+    )
     accelerator = Accelerator(
-        gradient_accumulation_steps=gradient_accumulation_steps,
+        gradient_accumulation_plugin=gradient_accumulation_plugin,
         mixed_precision=mixed_precision,
         kwargs_handlers=[ddp_kwargs, init_kwargs],
     )
@@ -265,17 +275,33 @@ def main(
         train_dataset = Pexels(**train_data, is_image=is_image)
     elif train_data['dataset'] == "joint":
         train_dataset = JointDataset(**train_data, is_image=is_image)
+    elif train_data['dataset'] == "latent":
+        # clips precomputed by scripts/latentize.py, the vae and text encoder are not run on training batches
+        train_dataset = LatentDataset(**train_data, is_image=is_image)
+        assert train_dataset.scaling_factor == vae.config.scaling_factor, (
+            f"the latents were scaled for a vae scaling factor of {train_dataset.scaling_factor}, "
+            f"the vae of {pretrained_model_path} uses {vae.config.scaling_factor}"
+        )
     else:
         raise ValueError(f"Unknown dataset {train_data['dataset']}")
 
     # DataLoaders creation:
-    train_dataloader = torch.utils.data.DataLoader(
-        train_dataset,
-        shuffle=True,
-        batch_size=train_batch_size,
-        num_workers=num_workers,
-        pin_memory=True,
-    )
+    if getattr(train_dataset, "buckets", None) is not None:
+        # batches only contain clips of one aspect ratio bucket
+        train_dataloader = torch.utils.data.DataLoader(
+            train_dataset,
+            batch_sampler=AspectRatioBucketBatchSampler(train_dataset.buckets.bucket_ids, train_batch_size, seed=seed or 0),
+            num_workers=num_workers,
+            pin_memory=True,
+        )
+    else:
+        train_dataloader = torch.utils.data.DataLoader(
+            train_dataset,
+            shuffle=True,
+            batch_size=train_batch_size,
+            num_workers=num_workers,
+            pin_memory=True,
+        )
 
     # Get the training iteration
     if max_train_steps == -1:
@@ -301,8 +327,9 @@ def main(
     validation_pipeline.enable_vae_slicing()
 
     # Prepare everything with our `accelerator`.
+    # when prefetching, batches are moved to the device by the prefetcher
     unet, optimizer, train_dataloader, lr_scheduler = accelerator.prepare(
-        unet, optimizer, train_dataloader, lr_scheduler
+        unet, optimizer, train_dataloader, lr_scheduler, device_placement=[True, True, not prefetch_batches, True]
     )
 
     # For mixed precision training we cast the text_encoder and vae weights to half-precision
@@ -320,6 +347,10 @@ def main(
     text_encoder.to(accelerator.device, dtype=weight_dtype)
     vae.to(accelerator.device, dtype=weight_dtype)
 
+    use_latent_dataset = train_data['dataset'] == "latent"
+    if use_latent_dataset:
+        null_text_embeds = train_dataset.null_text_embeds.to(accelerator.device, dtype=weight_dtype)
+
     # We need to recalculate our total training steps as the size of the training dataloader may have changed.
     num_update_steps_per_epoch = math.ceil(len(train_dataloader) / gradient_accumulation_steps)
     # Afterwards we recalculate our number of training epochs
@@ -355,6 +386,19 @@ def main(
     # Only show the progress bar once on each machine.
     progress_bar = tqdm(range(0, max_train_steps), initial=initial_global_step, desc="Steps", disable=not accelerator.is_main_process)
 
+    def preprocess_batch(batch):
+        # null text dropout and tokenization, run ahead of the training step when prefetching
+        if use_latent_dataset:
+            if cfg_random_null_text_ratio > 0.0:
+                batch['null_text_mask'] = torch.tensor([random.random() <= cfg_random_null_text_ratio for _ in range(batch['text_embeds'].shape[0])])
+        else:
+            if cfg_random_null_text_ratio > 0.0:
+                batch['text'] = [name if random.random() > cfg_random_null_text_ratio else "" for name in batch['text']]
+            batch['prompt_ids'] = tokenizer(
+                batch['text'], max_length=tokenizer.model_max_length, padding="max_length", truncation=True, return_tensors="pt"
+            ).input_ids
+        return batch
+
     for epoch in range(first_epoch, num_train_epochs):
         train_loss = 0.0
         train_grad_norm = 0.0
@@ -363,15 +407,20 @@ def main(
         network_forward_time = 0.0
         network_backward_time = 0.0
 
+        if prefetch_batches:
+            train_batches = BatchPrefetcher(train_dataloader, accelerator.device, preprocess_fn=preprocess_batch)
+        else:
+            train_batches = train_dataloader
+
         t0 = time.time()
-        for step, batch in enumerate(train_dataloader):
+        for step, batch in enumerate(train_batches):
             t1 = time.time()
-            if cfg_random_null_text_ratio > 0.0:
-                batch['text'] = [name if random.random() > cfg_random_null_text_ratio else "" for name in batch['text']]
+            if not prefetch_batches:
+                batch = preprocess_batch(batch)
                 
             # Data batch sanity check
-            if accelerator.is_main_process and epoch == first_epoch and step == 0:
-                pixel_values, texts = batch['pixel_values'].cpu(), batch['text']
+            if accelerator.is_main_process and epoch == first_epoch and step == 0 and not use_latent_dataset:
+                pixel_values, texts = normalize_pixel_values(batch['pixel_values']).cpu(), batch['text']
                 pixel_values = rearrange(pixel_values, "b f c h w -> b c f h w")
                 for idx, (pixel_value, text) in enumerate(zip(pixel_values, texts)):
                     pixel_value = pixel_value[None, ...]
@@ -380,12 +429,17 @@ def main(
             ### >>>> Training >>>> ###
             with accelerator.accumulate(unet):
                 # Convert videos to latent space            
-                pixel_values = batch["pixel_values"].to(weight_dtype)
-                video_length = pixel_values.shape[1]
-                pixel_values = rearrange(pixel_values, "b f c h w -> (b f) c h w")
-                latents = vae.encode(pixel_values).latent_dist
-                latents = latents.sample()
-                latents = rearrange(latents, "(b f) c h w -> b c f h w", f=video_length)
+                if use_latent_dataset:
+                    latents = batch["latents"].to(weight_dtype)
+                    video_length = latents.shape[2]
+                else:
+                    # the dataset returns uint8 frames, convert them on the device
+                    pixel_values = normalize_pixel_values(batch["pixel_values"], weight_dtype)
+                    video_length = pixel_values.shape[1]
+                    pixel_values = rearrange(pixel_values, "b f c h w -> (b f) c h w")
+                    latents = vae.encode(pixel_values).latent_dist
+                    latents = latents.sample()
+                    latents = rearrange(latents, "(b f) c h w -> b c f h w", f=video_length)
 
                 latents = latents * vae.config.scaling_factor
 
@@ -394,21 +448,13 @@ def main(
                     first_frame_latents = latents[:, :, 0:1, :, :]
 
                 # Sample noise that we'll add to the latents
-                if unet_additional_kwargs['noise_sampling_method'] == 'vanilla':
-                    noise = torch.randn_like(latents)
-                elif unet_additional_kwargs['noise_sampling_method'] == 'pyoco_mixed':
-                    noise_alpha_squared = float(unet_additional_kwargs['noise_alpha']) ** 2
-                    shared_noise = torch.randn_like(latents[:, :, 0:1, :, :]) * math.sqrt((noise_alpha_squared) / (1 + noise_alpha_squared))
-                    ind_noise = torch.randn_like(latents) * math.sqrt(1 / (1 + noise_alpha_squared))
-                    noise = shared_noise + ind_noise
-                elif unet_additional_kwargs['noise_sampling_method'] == 'pyoco_progressive':
-                    noise_alpha_squared = float(unet_additional_kwargs['noise_alpha']) ** 2
-                    noise = torch.randn_like(latents)
-                    ind_noise = torch.randn_like(latents) * math.sqrt(1 / (1 + noise_alpha_squared))
-                    for i in range(1, noise.shape[2]):
-                        noise[:, :, i, :, :] = noise[:, :, i - 1, :, :] * math.sqrt((noise_alpha_squared) / (1 + noise_alpha_squared)) + ind_noise[:, :, i, :, :]
-                else:
-                    raise ValueError(f"Unknown noise sampling method {unet_additional_kwargs['noise_sampling_method']}")
+                noise = sample_noise(
+                    latents.shape,
+                    unet_additional_kwargs['noise_sampling_method'],
+                    float(unet_additional_kwargs['noise_alpha']),
+                    device=latents.device,
+                    dtype=latents.dtype,
+                )
 
                 bsz = latents.shape[0]
             
@@ -430,10 +476,14 @@ def main(
                     noisy_latents = noisy_latents[:, :, 1:, :, :]
             
                 # Get the text embedding for conditioning
-                prompt_ids = tokenizer(
-                    batch['text'], max_length=tokenizer.model_max_length, padding="max_length", truncation=True, return_tensors="pt"
-                ).input_ids.to(latents.device)
-                encoder_hidden_states = text_encoder(prompt_ids)[0]
+                if use_latent_dataset:
+                    encoder_hidden_states = batch['text_embeds'].to(weight_dtype)
+                    if cfg_random_null_text_ratio > 0.0:
+                        # out of place, `.to` returns the batch tensor itself when it already has `weight_dtype`
+                        null_text_mask = batch['null_text_mask'].to(encoder_hidden_states.device)
+                        encoder_hidden_states = torch.where(null_text_mask[:, None, None], null_text_embeds, encoder_hidden_states)
+                else:
+                    encoder_hidden_states = text_encoder(batch['prompt_ids'].to(latents.device))[0]
                 
                 # Get the target for loss depending on the prediction type
                 if noise_scheduler.config.prediction_type == "epsilon":
@@ -448,6 +498,9 @@ def main(
 
                 frame_stride = None
                 if unet_additional_kwargs["use_frame_stride_condition"]:
+                    # latentized clips of datasets without a fixed stride store -1
+                    if (batch['stride'] < 0).any():
+                        raise ValueError("use_frame_stride_condition is set but the batch has no frame stride")
                     frame_stride = batch['stride'].to(latents.device)
                     frame_stride = frame_stride.long()
                     frame_stride = repeat(frame_stride, "b -> b f", f=video_length)
@@ -506,6 +559,10 @@ def main(
                     wandb.log({"profiling/train_prepare_everything_time": prepare_everything_time}, step=global_step)
                     wandb.log({"profiling/train_network_forward_time": network_forward_time}, step=global_step)
                     wandb.log({"profiling/train_network_backward_time": network_backward_time}, step=global_step)
+                    if not use_latent_dataset:
+                        # shared with the dataloader workers, best-effort counts (see `FailureRegistry`)
+                        failure_stats = train_dataset.failure_registry.get_stats()
+                        wandb.log({f"data/{key}": value for key, value in failure_stats.items()}, step=global_step)
                     # accelerator.log({"train_loss": train_loss}, step=global_step)
                 train_loss = 0.0
                 train_grad_norm = 0.0
@@ -585,6 +642,9 @@ def main(
             if global_step >= max_train_steps:
                 break
             
+        if not use_latent_dataset:
+            logger.info(f"epoch {epoch} data loading failures: {train_dataset.failure_registry.get_stats()}")
+
     # Create the pipeline using the trained modules and save it.
     accelerator.wait_for_everyone()
     if accelerator.is_main_process: